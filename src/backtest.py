@@ -0,0 +1,206 @@
+# coding:utf8
+""" tick回放/回测。
+按时间顺序把历史tick送入MarketDataApi.process_tick和CheckStopThread的止损检查，
+交易所时间由模拟时钟提供，订单在进程内按下一笔tick的价格成交。 """
+import logging
+import datetime
+import itertools
+from time import time
+
+from . import utils
+from .quoteservice import QuoteService, TickObject
+from .marketdata import MarketDataApi
+from .strategy import CheckStopThread
+from .trader import BaseTrader
+from .utils import EPOCH
+
+logger = logging.getLogger(__name__)
+
+
+class SimulatedClock(utils.ExchangeClock):
+    """ 回测用时钟，所有交易所的当前时间都是最近一笔tick的时间 """
+    def __init__(self):
+        super(SimulatedClock, self).__init__()
+        self.current = None
+
+    def set(self, t):
+        self.current = t
+
+    def offset(self, exchangeid):
+        return 0.0
+
+    def now(self, exchangeid):
+        return self.current
+
+
+class ReplayMarketDataApi(MarketDataApi):
+    def subscribe(self, instruments):
+        self.instruments.update(instruments)
+
+    def unsubscribe(self, instruments):
+        self.instruments.difference_update(instruments)
+
+
+class SimulatedBroker(object):
+    """ 进程内撮合：新订单在下一笔tick确认，市价单按对手价成交，
+    限价单在对手价不劣于限价时按对手价成交 """
+
+    def __init__(self, trader):
+        self.trader = trader
+        self.local_ids = itertools.count(1)
+        self.sys_ids = itertools.count(1)
+        self.exec_ids = itertools.count(1)
+        self.new_orders = []    # 等待确认的订单
+        self.working = {}       # local_id -> 订单信息
+
+    def submit(self, secid, price, volume, direction):
+        local_id = 'BT{0}'.format(next(self.local_ids))
+        self.new_orders.append({'local_id': local_id, 'secid': secid, 'price': price,
+                                'volume': abs(volume), 'direction': direction})
+        return local_id
+
+    def cancel(self, orders):
+        canceled = []
+        for order in orders:
+            info = self.working.pop(order.local_id, None)
+            if info is None:
+                pending = [o for o in self.new_orders if o['local_id'] == order.local_id]
+                if not pending:
+                    continue
+                self.new_orders.remove(pending[0])
+            self.trader.on_cancel(order.local_id)
+            canceled.append(order)
+        return canceled
+
+    def on_tick(self, tick, now):
+        new_orders, self.new_orders = self.new_orders, []
+        for info in new_orders:
+            info['sys_id'] = 'BTSYS{0}'.format(next(self.sys_ids))
+            self.trader.on_new_order(info['local_id'], info['secid'], info['sys_id'], info['direction'],
+                                     info['price'], info['volume'], now)
+            self.working[info['local_id']] = info
+        for local_id, info in self.working.items():
+            if info['secid'] != tick.securityID:
+                continue
+            if info['direction']:
+                price = tick.s_price or tick.price
+                if info['price'] and price > info['price']:
+                    continue
+            else:
+                price = tick.b_price or tick.price
+                if info['price'] and price < info['price']:
+                    continue
+            del self.working[local_id]
+            self.trader.on_trade('BTEXEC{0}'.format(next(self.exec_ids)), info['secid'], info['sys_id'],
+                                 price, info['volume'], now)
+
+
+class BacktestTrader(BaseTrader):
+    is_simul = True
+
+    def __init__(self, *args, **kwargs):
+        super(BacktestTrader, self).__init__(*args, **kwargs)
+        self.broker = SimulatedBroker(self)
+        self.account.opened_orders_cache_ttl = 0   # 缓存按真实时间过期，回放时不能用
+        self.is_logged = self.is_ready = True
+
+    def open_market_order(self, inst, volume, direction):
+        return self.broker.submit(inst.secid, 0.0, volume, direction)
+
+    def open_limit_order(self, inst, price, volume, direction):
+        return self.broker.submit(inst.secid, price, volume, direction)
+
+    def close_market_order(self, order, volume):
+        return self.broker.submit(order.instrument.secid, 0.0, volume, not order.is_long)
+
+    def close_limit_order(self, order, price, volume):
+        return self.broker.submit(order.instrument.secid, price, volume, not order.is_long)
+
+    def cancel_orders(self, orders):
+        return self.broker.cancel(orders)
+
+    def wait_for_closed(self, orders):
+        # 平仓单在下一笔tick成交，不能在回放线程里等待
+        return True
+
+
+class BacktestEngine(object):
+    """ 以最快速度回放tick。每笔tick依次：推进模拟时钟、撮合未成交订单、
+    process_tick、止损检查、调用on_tick回调（策略在这里下单）。"""
+
+    def __init__(self, trader, build_bars=False):
+        self.trader = trader
+        self.build_bars = build_bars
+        self.clock = SimulatedClock()
+        self.quote_service = QuoteService()
+        self.mdapi = ReplayMarketDataApi(self.quote_service, [], self.quote_service.interval)
+        self.stop_checker = CheckStopThread(trader)
+        self.on_tick = []   # 回调函数 f(tick)
+        self.instruments = {}
+        self.stats = {}
+
+    def get_instrument(self, secid):
+        if secid not in self.instruments:
+            from .models import Instrument
+            self.instruments[secid] = Instrument.objects.filter(secid=secid).first()
+        return self.instruments[secid]
+
+    def get_offset(self, instrument):
+        offset = self.trader.offsets.get(instrument.symbol)
+        if not offset:
+            try:
+                offset = self.trader.offsets.get(instrument.product.prodid)
+            except AttributeError:
+                offset = None
+        return offset
+
+    def process(self, tick):
+        self.clock.set(tick.entry_time)
+        self.trader.broker.on_tick(tick, tick.entry_time)
+        self.mdapi.process_tick(tick)
+        if self.build_bars:
+            self.quote_service.save_inst_mindata(tick.securityID)
+        instrument = self.get_instrument(tick.securityID)
+        if instrument is not None:
+            offset = self.get_offset(instrument)
+            if offset:
+                self.stop_checker.set_stopprice(instrument, tick.price, *offset)
+                self.stop_checker.check(instrument, tick.price)
+        for callback in self.on_tick:
+            callback(tick)
+
+    def run(self, ticks):
+        """ 回放ticks，返回统计数据 """
+        saved_clock = utils.exchange_clock
+        utils.exchange_clock = self.clock
+        count = 0
+        start = time()
+        try:
+            for tick in ticks:
+                self.process(tick)
+                count += 1
+        finally:
+            utils.exchange_clock = saved_clock
+        elapsed = time() - start
+        self.stats = {
+            'ticks': count,
+            'seconds': elapsed,
+            'ticks_per_sec': count / elapsed if elapsed else 0.0,
+        }
+        logger.info(u'回放{ticks}笔tick，用时{seconds:.3f}秒，每秒{ticks_per_sec:.0f}笔'.format(**self.stats))
+        return self.stats
+
+
+def ticks_from_array(secid, ticks):
+    """ 把TickArchive读出的数组转换为TickObject序列 """
+    for record in ticks:
+        tick = TickObject(
+            securityID=secid,
+            entry_time=EPOCH + datetime.timedelta(microseconds=int(record['entry_time'])),
+            price=float(record['price']),
+            volume=float(record['volume']),
+        )
+        for att in ('b_price', 's_price'):
+            value = float(record[att])
+            tick[att] = value if value == value else tick.price     # NaN
+        yield tick
@@ -0,0 +1,182 @@
+# coding:utf8
+""" 列式K线存储。
+每个合约一个目录，每次保存按日拆分，每天写一个按时间排序的.npy块，文件名为块内首尾时间（微秒）和写入序号；
+查询时用mmap读入，单个块内的查询结果不复制数据，多个块中重复时间的K线保留后写入的。
+后台线程按日合并小块，合并在锁外进行，完成后才替换块列表。 """
+import os
+import logging
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+BAR_DTYPE = np.dtype([
+    ('time', '<i8'),       # 1970-01-01起的微秒数（本地时间）
+    ('open', '<f8'),
+    ('high', '<f8'),
+    ('low', '<f8'),
+    ('close', '<f8'),
+    ('volume', '<f8'),
+])
+
+
+def to_micros(t):
+    return np.datetime64(t, 'us').astype('<i8')
+
+
+DAY = 86400 * 1000000
+
+
+def dedup(bars):
+    """ bars按时间稳定排序，重复时间保留最后一条 """
+    keep = np.ones(len(bars), dtype=bool)
+    keep[:-1] = bars['time'][1:] != bars['time'][:-1]
+    return bars[keep]
+
+
+class BarStore(object):
+    def __init__(self, root, max_chunks=16):
+        self.root = root
+        self.max_chunks = max_chunks
+        self.chunks = {}    # secid -> [(start, end, path, seq), ...] 按start排序
+        self.seqs = {}      # secid -> 最近写入的序号
+        self.lock = threading.RLock()
+        self.evt_stop = threading.Event()
+
+    def chunk_list(self, secid):
+        with self.lock:
+            if secid not in self.chunks:
+                chunks = []
+                dirname = os.path.join(self.root, secid)
+                if os.path.isdir(dirname):
+                    for fn in os.listdir(dirname):
+                        if fn.endswith('.npy'):
+                            parts = fn[:-4].split('-')
+                            seq = int(parts[2]) if len(parts) > 2 else 0
+                            chunks.append((int(parts[0]), int(parts[1]), os.path.join(dirname, fn), seq))
+                self.chunks[secid] = sorted(chunks)
+                self.seqs[secid] = max([c[3] for c in chunks] or [0])
+            return self.chunks[secid]
+
+    def next_seq(self, secid):
+        with self.lock:
+            self.chunk_list(secid)
+            self.seqs[secid] += 1
+            return self.seqs[secid]
+
+    def write_chunk(self, secid, bars, seq):
+        dirname = os.path.join(self.root, secid)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        path = os.path.join(dirname, '{0}-{1}-{2}.npy'.format(bars['time'][0], bars['time'][-1], seq))
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, bars)
+        os.rename(tmp, path)
+        return (int(bars['time'][0]), int(bars['time'][-1]), path, seq)
+
+    def append(self, secid, bars):
+        """ 追加结构化数组形式的K线 """
+        if not len(bars):
+            return
+        bars = dedup(np.sort(np.asarray(bars, dtype=BAR_DTYPE), order='time', kind='mergesort'))
+        days = bars['time'] // DAY
+        bounds = np.flatnonzero(days[1:] != days[:-1]) + 1
+        with self.lock:
+            chunks = self.chunk_list(secid)
+            for part in np.split(bars, bounds):
+                chunks.append(self.write_chunk(secid, part, self.next_seq(secid)))
+            chunks.sort()
+
+    def append_frame(self, df):
+        """ 追加QuoteService.save_inst_mindata生成的DataFrame """
+        for secid, group in df.groupby('securityID'):
+            bars = np.empty(len(group), dtype=BAR_DTYPE)
+            bars['time'] = group.index.values.astype('datetime64[us]').astype('<i8')
+            bars['open'] = group['open_price'].values
+            bars['high'] = group['high_price'].values
+            bars['low'] = group['low_price'].values
+            bars['close'] = group['close_price'].values
+            bars['volume'] = group['volume'].values
+            self.append(secid, bars)
+
+    def query(self, secid, start=None, end=None):
+        """ 返回time在[start, end)之间的K线。结果只在一个块内时不复制数据。"""
+        lo_t = to_micros(start) if start is not None else None
+        hi_t = to_micros(end) if end is not None else None
+        for retry in range(3):
+            with self.lock:
+                chunks = [c for c in self.chunk_list(secid)
+                          if (lo_t is None or c[1] >= lo_t) and (hi_t is None or c[0] < hi_t)]
+            try:
+                parts = self.read_parts(chunks, lo_t, hi_t)
+                break
+            except IOError:
+                # 读取期间块被合并删除，重新取块列表
+                if retry == 2:
+                    raise
+        if not parts:
+            return np.empty(0, dtype=BAR_DTYPE)
+        if len(parts) == 1:
+            return parts[0]
+        bars = np.concatenate(parts)
+        return dedup(bars[np.argsort(bars['time'], kind='mergesort')])
+
+    def read_parts(self, chunks, lo_t, hi_t):
+        parts = []
+        for _, _, path, _ in sorted(chunks, key=lambda c: c[3]):    # 按写入顺序，排序后重复的保留最后一条
+            bars = np.load(path, mmap_mode='r')
+            lo = 0 if lo_t is None else np.searchsorted(bars['time'], lo_t)
+            hi = len(bars) if hi_t is None else np.searchsorted(bars['time'], hi_t)
+            if hi > lo:
+                parts.append(bars[lo:hi])
+        return parts
+
+    def compact(self, secid):
+        """ 按日合并块，重复时间的K线保留后写入的。返回合并的日数 """
+        with self.lock:
+            groups = {}
+            for chunk in self.chunk_list(secid):
+                groups.setdefault(chunk[0] // DAY, []).append(chunk)
+        count = 0
+        for day, chunks in sorted(groups.items()):
+            if len(chunks) < 2:
+                continue
+            chunks.sort(key=lambda c: c[3])
+            bars = np.concatenate([np.load(path) for _, _, path, _ in chunks])
+            bars = dedup(bars[np.argsort(bars['time'], kind='mergesort')])
+            # 沿用最后一块的序号：合并期间新写入的块序号更大，仍然优先
+            merged = self.write_chunk(secid, bars, chunks[-1][3])
+            with self.lock:
+                old = set(chunks)
+                current = self.chunk_list(secid)
+                current[:] = sorted([c for c in current if c not in old and c[2] != merged[2]] + [merged])
+            for _, _, path, _ in chunks:
+                if path != merged[2]:
+                    os.remove(path)
+            count += 1
+            logger.debug(u'合并合约{0}的{1}个K线数据块'.format(secid, len(chunks)))
+        return count
+
+    def compact_all(self):
+        if os.path.isdir(self.root):
+            for secid in os.listdir(self.root):
+                if len(self.chunk_list(secid)) > self.max_chunks:
+                    try:
+                        self.compact(secid)
+                    except Exception, e:
+                        logger.exception(unicode(e))
+
+    def run_compactor(self, interval=60):
+        while not self.evt_stop.wait(interval):
+            self.compact_all()
+
+    def start_compactor(self, interval=60):
+        t = threading.Thread(target=self.run_compactor, args=(interval,), name='BARSTORE-COMPACT')
+        t.daemon = True
+        t.start()
+        return t
+
+    def stop(self):
+        self.evt_stop.set()
@@ -0,0 +1,306 @@
+# coding:utf8
+""" 交易热点路径的性能基准测试。
+默认使用内存存储（storage.use_backend('memory')），每个基准测试在清空的数据库上重新准备数据，
+只计时被测代码，结果保存为JSON并可与基准文件比较：
+
+    python -m sectradelib.benchmark -o bench.json
+    python -m sectradelib.benchmark -b bench.json --tolerance 0.2    # 有退化时返回1
+    python -m sectradelib.benchmark --backend redis --redis-db 15    # 会清空第15号数据库
+
+运行结束后恢复原来的存储后端。
+"""
+import os
+import sys
+import json
+import logging
+import platform
+import argparse
+import itertools
+import subprocess
+from time import time
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+import redisco
+
+from . import storage
+
+logger = logging.getLogger(__name__)
+
+BENCHMARKS = OrderedDict()  # name -> (setup, size)
+START = datetime(2015, 5, 4, 9, 0)
+
+
+def benchmark(name, size):
+    """ 注册基准测试。setup(n)准备数据，返回(被计时的函数, 操作次数) """
+    def decorator(setup):
+        BENCHMARKS[name] = (setup, size)
+        return setup
+    return decorator
+
+
+def _instrument(secid, currency='CNY', price=5000.0):
+    from .models import Instrument
+    inst = Instrument.objects.create(secid=secid, name=secid, symbol=secid, quoted_currency=currency,
+                                     multiplier=1.0, long_margin_ratio=0.1, short_margin_ratio=0.1)
+    db = redisco.get_client()
+    for key in ('current_price', 'current_b_price', 'current_s_price'):
+        db.hset(key, secid, price)
+    return inst
+
+
+def _trader(offsets='XX1505:100'):
+    from .trader import BaseTrader
+
+    class BenchTrader(BaseTrader):
+        local_ids = itertools.count(1)
+
+        def open_market_order(self, inst, volume, direction):
+            return 'BENCH{0}'.format(next(self.local_ids))
+
+        def close_market_order(self, order, volume):
+            return 'BENCH{0}'.format(next(self.local_ids))
+
+        def wait_for_closed(self, orders):
+            return True
+
+    trader = BenchTrader('bench', 'bench', 'CNY', offsets)
+    trader.set_monitors(publish=False)
+    trader.is_logged = trader.is_ready = True
+    return trader
+
+
+def _open_orders(trader, inst, n, price=5000.0):
+    """ 开n张已成交的多头订单 """
+    orders = []
+    for i in xrange(n):
+        order = trader.open_order(inst, 0.0, 1, True, 'bench')
+        sys_id = 'SYS-{0}-{1}'.format(inst.secid, i)
+        trader.on_new_order(order.local_id, inst.secid, sys_id, True, 0.0, 1, START)
+        trader.on_trade('EXEC-{0}-{1}'.format(inst.secid, i), inst.secid, sys_id, price, 1, START)
+        orders.append(order)
+    return orders
+
+
+@benchmark('process_tick', 5000)
+def bench_process_tick(n):
+    from .quoteservice import QuoteService, TickObject
+    from .marketdata import MarketDataApi
+
+    class BenchMarketDataApi(MarketDataApi):
+        def subscribe(self, instruments):
+            pass
+
+    api = BenchMarketDataApi(QuoteService(), [], 60)
+    ticks = [TickObject(securityID='XX1505', entry_time=START + timedelta(milliseconds=500 * i),
+                        price=5000.0 + i % 10, b_price=4999.0, s_price=5001.0, volume=1)
+             for i in xrange(n)]
+
+    def run():
+        for tick in ticks:
+            api.process_tick(tick)
+    return run, n
+
+
+@benchmark('save_inst_mindata', 5000)
+def bench_save_inst_mindata(n):
+    from .quoteservice import QuoteService, TickObject
+    service = QuoteService()
+    service.interval = 60
+    service.tickdata['XX1505'] = [
+        TickObject(securityID='XX1505', entry_time=START + timedelta(milliseconds=500 * i),
+                   price=5000.0 + i % 10, volume=1)
+        for i in xrange(n)]
+    service.market_closed['XX1505'] = True     # 收盘保存全部数据，数据量小时也不会跳过
+
+    def run():
+        if not service.save_inst_mindata('XX1505'):
+            raise RuntimeError(u'没有保存分钟数据')
+    return run, n
+
+
+@benchmark('check_stop', 200)
+def bench_check_stop(n):
+    from .strategy import CheckStopThread
+    inst = _instrument('XX1505')
+    trader = _trader()
+    _open_orders(trader, inst, n)
+    thread = CheckStopThread(trader)
+    count = 20
+
+    def run():
+        for i in xrange(count):
+            thread.check(inst, 4950.0)     # 止损价4900，不触发平仓
+    return run, count
+
+
+@benchmark('account_available', 200)
+def bench_account_available(n):
+    inst = _instrument('XX1505')
+    usd = _instrument('YY1505', 'USD', 100.0)
+    _instrument('USD/CNY', price=6.2)
+    trader = _trader('XX1505:100,YY1505:10')
+    _open_orders(trader, inst, n // 2)
+    _open_orders(trader, usd, n - n // 2, 100.0)
+    count = 10
+
+    def run():
+        for i in xrange(count):
+            trader.account.available
+    return run, count
+
+
+@benchmark('on_trade', 500)
+def bench_on_trade(n):
+    inst = _instrument('XX1505')
+    trader = _trader()
+    sys_ids = []
+    for i in xrange(n):
+        order = trader.open_order(inst, 0.0, 1, True, 'bench')
+        sys_ids.append('SYS{0}'.format(i))
+        trader.on_new_order(order.local_id, inst.secid, sys_ids[-1], True, 0.0, 1, START)
+
+    def run():
+        for i, sys_id in enumerate(sys_ids):
+            trader.on_trade('EXEC{0}'.format(i), inst.secid, sys_id, 5000.0, 1, START)
+    return run, n
+
+
+@benchmark('trade_on_close', 200)
+def bench_trade_on_close(n):
+    """ 一张开仓单分n笔成交，平仓单一笔成交，逐笔匹配开仓成交 """
+    from .models import Order
+    inst = _instrument('XX1505')
+    trader = _trader()
+    order = trader.open_order(inst, 0.0, n, True, 'bench')
+    trader.on_new_order(order.local_id, inst.secid, 'SYSOPEN', True, 0.0, n, START)
+    for i in xrange(n):
+        trader.on_trade('EXECOPEN{0}'.format(i), inst.secid, 'SYSOPEN', 5000.0 + i, 1, START, setstop=False)
+    close = trader.close_order(Order.objects.get_by_id(order.id))
+    trader.on_new_order(close.local_id, inst.secid, 'SYSCLOSE', False, 0.0, n, START)
+    return lambda: trader.on_trade('EXECCLOSE', inst.secid, 'SYSCLOSE', 5100.0, n, START), n
+
+
+def _startup(module):
+    """ 在新进程里导入模块，计时包含解释器启动，即辅助进程（如行情重启）的启动时间 """
+    def setup(n):
+        package = __package__ or __name__.rsplit('.', 1)[0]     # python -m运行时__name__为__main__
+        cmd = [sys.executable, '-c', 'import {0}.{1}'.format(package, module)]
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+
+        def run():
+            for i in xrange(n):
+                subprocess.check_call(cmd, env=env)
+        return run, n
+    return setup
+
+
+for _module in ('utils', 'models', 'trader', 'strategy'):
+    benchmark('startup_' + _module, 3)(_startup(_module))
+
+
+def run_benchmarks(names=None, scale=1.0, repeat=3, backend='memory', redis_options=None):
+    """ 返回{name: {'size', 'ops', 'best', 'median', 'per_op_us'}}，时间单位为秒。
+    backend为'redis'时每次都会清空数据库，redis_options必须明确指定专用的db """
+    if backend == 'redis' and (redis_options or {}).get('db') is None:
+        raise ValueError(u'Redis基准测试会清空数据库，必须明确指定专用的db')
+    saved = storage.current_backend()
+    try:
+        storage.use_backend(backend, **(redis_options or {}))
+        return _run_benchmarks(names, scale, repeat)
+    finally:
+        storage.restore_backend(saved)
+
+
+def _run_benchmarks(names, scale, repeat):
+    from .models import order_index
+    results = OrderedDict()
+    for name, (setup, size) in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        n = max(1, int(size * scale))
+        times = []
+        try:
+            for i in xrange(repeat):
+                redisco.get_client().flushdb()
+                order_index.clear()
+                run, ops = setup(n)
+                start = time()
+                run()
+                times.append(time() - start)
+        except Exception, e:
+            logger.exception(u'基准测试{0}失败'.format(name))
+            results[name] = {'size': n, 'error': unicode(e)}
+            continue
+        times.sort()
+        results[name] = {
+            'size': n,
+            'ops': ops,
+            'best': times[0],
+            'median': times[len(times) // 2],
+            'per_op_us': times[0] / ops * 1e6,
+        }
+        logger.info(u'{0}: n={1} 最快{2:.4f}秒 每次{3:.1f}微秒'.format(name, n, times[0], results[name]['per_op_us']))
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """ 返回比基准慢超过tolerance的测试：[(name, 基准每次微秒, 当前每次微秒), ...] """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base or 'per_op_us' not in base or 'per_op_us' not in result:
+            continue
+        if result['per_op_us'] > base['per_op_us'] * (1 + tolerance):
+            regressions.append((name, base['per_op_us'], result['per_op_us']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=u'交易热点路径基准测试')
+    parser.add_argument('names', nargs='*', help=u'只运行指定的测试：' + ', '.join(BENCHMARKS))
+    parser.add_argument('-o', '--output', help=u'结果保存为JSON文件')
+    parser.add_argument('-b', '--baseline', help=u'与之比较的基准JSON文件')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.2, help=u'允许的变慢比例')
+    parser.add_argument('-s', '--scale', type=float, default=1.0, help=u'数据量倍数')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('--backend', default='memory', choices=('memory', 'redis'))
+    parser.add_argument('--redis-host', default='localhost')
+    parser.add_argument('--redis-port', type=int, default=6379)
+    parser.add_argument('--redis-db', type=int, help=u'专用的数据库编号，--backend redis时必须指定（会被清空）')
+    args = parser.parse_args(argv)
+    if args.backend == 'redis' and args.redis_db is None:
+        parser.error(u'--backend redis需要用--redis-db指定专用的数据库（会被清空）'.encode('utf8'))
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    redis_options = {'host': args.redis_host, 'port': args.redis_port, 'db': args.redis_db}
+    results = run_benchmarks(args.names, args.scale, args.repeat, args.backend,
+                             redis_options if args.backend == 'redis' else None)
+    report = {
+        'time': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'backend': args.backend,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    for name, result in results.items():
+        if 'error' in result:
+            line = u'{0:<20} 失败: {1}'.format(name, result['error'])
+        else:
+            line = u'{0:<20} {1:>12.1f} us/op  (n={2})'.format(name, result['per_op_us'], result['size'])
+        print line.encode('utf8')
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for name, base, current in regressions:
+            print u'性能退化 {0}: {1:.1f} -> {2:.1f} us/op'.format(name, base, current).encode('utf8')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
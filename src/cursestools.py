@@ -1,10 +1,40 @@
 # coding: utf8
 import logging
+import threading
 import curses
 import curses.panel
 import curses.textpad
+import unicodedata
+from time import sleep
+from collections import namedtuple
+
+from .utils import monotonic
 
 logger = logging.getLogger(__name__)
+# curses不是线程安全的，RowWin在刷新线程里绘制，其他窗口的绘制也要持有这个锁
+screen_lock = threading.RLock()
+
+def char_width(ch):
+    """ 字符在终端上占的列数：全角（中文等）2列，组合字符0列 """
+    if unicodedata.combining(ch):
+        return 0
+    return 2 if unicodedata.east_asian_width(ch) in ('W', 'F') else 1
+
+
+def fit_width(text, width):
+    """ 按显示宽度截断并用空格补齐到width列，不会截断半个字符 """
+    if not isinstance(text, unicode):
+        text = str(text).decode('utf8', 'replace')
+    chars = []
+    used = 0
+    for ch in text:
+        w = char_width(ch)
+        if used + w > width:
+            break
+        chars.append(ch)
+        used += w
+    return u''.join(chars) + u' ' * (width - used)
+
 
 def init_colors(COLOR_PAIR, COLORS):
     """initialize curses color pairs and give them names. The color pair
@@ -50,21 +80,23 @@ class Win(object):
 
     def do_paint(self):
         """call this if you want the window to repaint itself"""
-        curses.curs_set(0)
-        if self.win:
-            try:
-                self.paint()
-            except Exception, e:
-                logger.exception(unicode(e))
-            self.done_paint()
+        with screen_lock:
+            curses.curs_set(0)
+            if self.win:
+                try:
+                    self.paint()
+                except Exception, e:
+                    logger.exception(unicode(e))
+                self.done_paint()
 
     # method could be a function - pylint: disable=R0201
     def done_paint(self):
         """update the sreen after paint operations, this will invoke all
         necessary stuff to refresh all (possibly overlapping) windows in
         the right order and then push it to the screen"""
-        curses.panel.update_panels()
-        curses.doupdate()
+        with screen_lock:
+            curses.panel.update_panels()
+            curses.doupdate()
 
     def paint(self):
         """paint the window. Override this with your own implementation.
@@ -142,6 +174,144 @@ class Win(object):
         self.calc_size()
         
 
+def diff_rows(old, new):
+    """ 比较两次的行（每行是单元格元组），返回(需要重写的[(行, 列序号, 单元格)], 需要清除的[(行, 列序号)])，
+    清除从该列到行尾：行变短时为多出来的列，行被删除时为整行 """
+    changes = []
+    cleared = []
+    for y, row in enumerate(new):
+        prev = old[y] if y < len(old) else ()
+        if row == prev:
+            continue
+        for x, cell in enumerate(row):
+            if x >= len(prev) or prev[x] != cell:
+                changes.append((y, x, cell))
+        if len(row) < len(prev):
+            cleared.append((y, len(row)))
+    cleared.extend((y, 0) for y in range(len(new), len(old)))
+    return changes, cleared
+
+
+class RowWin(Win):
+    """ 按行列显示数据的窗口，增量刷新。
+    build_rows()返回不可变的行（每行是(文字, 属性)单元格的元组），在刷新线程里调用；
+    数据变化时调用invalidate()（只设置标志，可在交易线程调用），刷新线程最多每秒max_fps次
+    重新生成行，只重写与上次不同的单元格。columns是各列宽度。"""
+
+    def __init__(self, stdscr, build_rows, columns, max_fps=4):
+        self.build_rows = build_rows
+        self.columns = columns
+        self.max_fps = max_fps
+        self.rows = ()
+        self.rendered = ()
+        self.dirty = threading.Event()
+        self.evt_stop = threading.Event()
+        self.thread = None
+        super(RowWin, self).__init__(stdscr)
+
+    def invalidate(self):
+        self.dirty.set()
+
+    def offset(self, x):
+        return sum(self.columns[:x])
+
+    def write_cell(self, y, x, cell):
+        text, attr = cell
+        width = self.columns[x] if x < len(self.columns) else self.width
+        self.addstr(y, self.offset(x), fit_width(text, width).encode('utf8'), attr)
+
+    def paint(self):
+        """ 窗口创建或改变大小后重画全部内容 """
+        self.win.erase()
+        for y, row in enumerate(self.rows):
+            for x, cell in enumerate(row):
+                self.write_cell(y, x, cell)
+        self.rendered = self.rows
+
+    def render(self, rows):
+        with screen_lock:
+            if not self.win:
+                return
+            self.rows = rows
+            changes, cleared = diff_rows(self.rendered, rows)
+            for y, x, cell in changes:
+                self.write_cell(y, x, cell)
+            for y, x in cleared:
+                if y < self.height and self.offset(x) < self.width:
+                    self.win.move(y, self.offset(x))
+                    self.win.clrtoeol()
+            self.rendered = rows
+            if changes or cleared:
+                self.done_paint()
+
+    def refresh(self):
+        try:
+            rows = tuple(tuple(row) for row in self.build_rows())
+        except Exception, e:
+            logger.exception(unicode(e))
+            return
+        self.render(rows)
+
+    def run(self):
+        interval = 1.0 / self.max_fps
+        while not self.evt_stop.is_set():
+            if not self.dirty.wait(0.5):
+                continue
+            self.dirty.clear()
+            start = monotonic()
+            self.refresh()
+            sleep(max(interval - (monotonic() - start), 0))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='UI-REFRESH')
+        self.thread.daemon = True
+        self.thread.start()
+        self.invalidate()
+
+    def stop(self):
+        self.evt_stop.set()
+
+
+AccountSnapshot = namedtuple('AccountSnapshot', 'balance available margins float_profits positions')
+
+
+def account_snapshot(trader):
+    """ 读取账户的资金和持仓，返回不可变的快照 """
+    account = trader.account
+    return AccountSnapshot(
+        balance=account.balance,
+        available=account.available,
+        margins=account.margins,
+        float_profits=account.float_profits,
+        positions=tuple((inst.name, volume) for inst, volume in trader.combined_positions() if volume),
+    )
+
+
+def account_rows(snapshot, attr=0):
+    """ AccountSnapshot转换为RowWin的行 """
+    rows = [
+        ((u'余额', attr), (u'{0:.2f}'.format(snapshot.balance), attr)),
+        ((u'可用', attr), (u'{0:.2f}'.format(snapshot.available), attr)),
+        ((u'保证金', attr), (u'{0:.2f}'.format(snapshot.margins), attr)),
+        ((u'浮动盈亏', attr), (u'{0:.2f}'.format(snapshot.float_profits), attr)),
+    ]
+    for name, volume in snapshot.positions:
+        rows.append(((name, attr), (u'{0:g}'.format(volume), attr)))
+    return rows
+
+
+class AccountWin(RowWin):
+    """ 账户信息窗口，设为trader.infowin后成交只调用invalidate()，不在交易线程里绘制 """
+
+    def __init__(self, stdscr, trader, columns=(12, 16), max_fps=4, attr=0):
+        self.trader = trader
+        self.attr = attr
+        super(AccountWin, self).__init__(stdscr, self.build, columns, max_fps)
+
+    def build(self):
+        return account_rows(account_snapshot(self.trader), self.attr)
+
+
 class TextBox(object):
     """wrapper for curses.textpad.Textbox"""
     def __init__(self, dlg, posy, posx, length, initial=''):
@@ -0,0 +1,154 @@
+# coding:utf8
+""" 盘口深度（L2）。
+每个合约一个DepthBook，买卖两边各用两个array('d')保存价位和数量（按价格从优到劣排列），
+由MarketDataApi.process_depth按增量更新（数量为0表示删除该价位），或由process_depth_snapshot整体替换。
+读取时取不可变的DepthSnapshot：同一版本只复制一次，没有读取就不复制，每笔更新不产生额外开销。
+
+    from sectradelib.depth import depth_books
+    book = depth_books.snapshot('IF1505')
+    if book:
+        book.spread(), book.top(5, True), book.vwap(10, True), book.price_for(10, True)
+
+depth_books是进程内的对象，只有与MarketDataApi在同一进程的策略（例如事件循环、回测）可以读取。
+"""
+import bisect
+import threading
+from array import array
+
+from .utils import monotonic
+
+
+class DepthSnapshot(object):
+    """ bids/asks是((价格, 数量), ...)，按价格从优到劣排列，updated是最后更新的monotonic()时刻 """
+    __slots__ = ('secid', 'version', 'bids', 'asks', 'updated')
+
+    def __init__(self, secid, version, bids, asks, updated=None):
+        self.secid = secid
+        self.version = version
+        self.bids = bids
+        self.asks = asks
+        self.updated = updated
+
+    def age(self):
+        """ 距最后一次更新的秒数，没有更新过时为None """
+        return None if self.updated is None else monotonic() - self.updated
+
+    def side(self, is_bid):
+        return self.bids if is_bid else self.asks
+
+    def best(self, is_bid):
+        levels = self.side(is_bid)
+        return levels[0][0] if levels else None
+
+    def spread(self):
+        if self.bids and self.asks:
+            return self.asks[0][0] - self.bids[0][0]
+
+    def top(self, n, is_bid):
+        return self.side(is_bid)[:n]
+
+    def walk(self, volume, is_buy):
+        """ 买入（吃卖盘）或卖出（吃买盘）volume，返回(成交均价, 最差价位)，深度不足时返回None """
+        remaining = abs(volume)
+        amount = 0.0
+        for price, size in self.side(not is_buy):
+            filled = min(size, remaining)
+            amount += filled * price
+            remaining -= filled
+            if remaining <= 0:
+                return amount / abs(volume), price
+        return None
+
+    def vwap(self, volume, is_buy):
+        result = self.walk(volume, is_buy)
+        return result and result[0]
+
+    def price_for(self, volume, is_buy):
+        """ 限价单要一次成交volume所需的价格 """
+        result = self.walk(volume, is_buy)
+        return result and result[1]
+
+
+class DepthBook(object):
+    def __init__(self, secid, max_levels=20):
+        self.secid = secid
+        self.max_levels = max_levels
+        # 买盘价格取负数保存，两边都按键升序排列，键越小越优
+        self.keys = (array('d'), array('d'))     # (卖, 买)
+        self.sizes = (array('d'), array('d'))
+        self.version = 0
+        self.updated = None
+        self.cached = None
+        self.lock = threading.Lock()
+
+    def _update(self, is_bid, price, size):
+        keys, sizes = self.keys[is_bid], self.sizes[is_bid]
+        key = -price if is_bid else price
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            if size > 0:
+                sizes[i] = size
+            else:
+                del keys[i]
+                del sizes[i]
+        elif size > 0 and i < self.max_levels:
+            keys.insert(i, key)
+            sizes.insert(i, size)
+            if len(keys) > self.max_levels:
+                keys.pop()
+                sizes.pop()
+
+    def update(self, updates):
+        """ updates: [(is_bid, 价格, 数量), ...]，数量为0表示删除该价位 """
+        with self.lock:
+            for is_bid, price, size in updates:
+                self._update(is_bid, price, size)
+            self.version += 1
+            self.updated = monotonic()
+
+    def replace(self, bids, asks):
+        """ 用完整的盘口替换，bids/asks: [(价格, 数量), ...] """
+        with self.lock:
+            for is_bid, levels in ((True, bids), (False, asks)):
+                levels = sorted([(-p if is_bid else p, s) for p, s in levels if s > 0])[:self.max_levels]
+                self.keys[is_bid][:] = array('d', [k for k, s in levels])
+                self.sizes[is_bid][:] = array('d', [s for k, s in levels])
+            self.version += 1
+            self.updated = monotonic()
+
+    def snapshot(self):
+        with self.lock:
+            if self.cached is None or self.cached.version != self.version:
+                self.cached = DepthSnapshot(
+                    self.secid, self.version,
+                    tuple(zip([-k for k in self.keys[True]], self.sizes[True])),
+                    tuple(zip(self.keys[False], self.sizes[False])), self.updated)
+            return self.cached
+
+
+class DepthBooks(object):
+    def __init__(self, max_levels=20):
+        self.max_levels = max_levels
+        self.books = {}
+        self.lock = threading.Lock()
+
+    def book(self, secid):
+        book = self.books.get(secid)
+        if book is None:
+            with self.lock:
+                book = self.books.get(secid)
+                if book is None:
+                    book = self.books[secid] = DepthBook(secid, self.max_levels)
+        return book
+
+    def snapshot(self, secid):
+        """ 没有该合约的深度数据时返回None """
+        book = self.books.get(secid)
+        return book.snapshot() if book is not None else None
+
+    def clear(self):
+        with self.lock:
+            self.books.clear()
+
+
+depth_books = DepthBooks()
@@ -0,0 +1,359 @@
+# coding:utf8
+""" 单线程事件循环运行模式。
+Python 2没有asyncio，这里提供同样思路的最小实现：定时器堆、生成器协程（yield秒数或Future）、
+线程安全的call_soon_threadsafe、处理阻塞调用的线程池，以及共用一个连接的发布订阅。
+止损检查、限价单超时、资金检查、未成交订单查询和分钟数据保存都作为循环里的回调运行，
+成千上万个订单定时器只是堆里的条目，不再各占一个线程。
+现有同步网关在自己的线程里回调，通过GatewayAdapter/MarketDataAdapter转到事件循环线程执行。
+
+    loop = EventLoop()
+    trader = MyTrader(...)
+    gateway_callbacks = GatewayAdapter(loop, trader)    # 交给网关作为回调对象
+    TraderLoop(loop, trader, limit_timeout=10, available_interval=60, reserve=20)
+    loop.run()
+"""
+import heapq
+import logging
+import itertools
+import threading
+from collections import deque
+from time import time
+from types import GeneratorType
+
+from . import storage
+from .utils import monotonic, logerror
+from .strategy import CheckStopThread, CheckAvailableThread, CheckUntradedOrderThread, OrderTimeoutThread
+
+logger = logging.getLogger(__name__)
+
+
+class Future(object):
+    def __init__(self, loop):
+        self.loop = loop
+        self.done = False
+        self.result = None
+        self.exception = None
+        self.callbacks = []
+
+    def set_result(self, result):
+        self.result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self.exception = exception
+        self._finish()
+
+    def _finish(self):
+        # 只在事件循环线程调用（线程池通过call_soon_threadsafe转回），与add_done_callback之间没有竞争
+        self.done = True
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            self.loop.call_soon(callback, self)
+
+    def add_done_callback(self, callback):
+        if self.done:
+            self.loop.call_soon(callback, self)
+        else:
+            self.callbacks.append(callback)
+
+    def get(self):
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+
+class Handle(object):
+    __slots__ = ('callback', 'args', 'cancelled')
+
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Task(Future):
+    """ 生成器协程：yield秒数表示休眠，yield Future表示等待其结果（结果作为yield的返回值） """
+
+    def __init__(self, loop, gen):
+        super(Task, self).__init__(loop)
+        self.gen = gen
+        loop.call_soon(self.step)
+
+    def step(self, value=None, exception=None):
+        try:
+            if exception is not None:
+                yielded = self.gen.throw(exception)
+            else:
+                yielded = self.gen.send(value)
+        except StopIteration:
+            self.set_result(None)
+            return
+        except Exception, e:
+            logger.exception(unicode(e))
+            self.set_exception(e)
+            return
+        if isinstance(yielded, Future):
+            yielded.add_done_callback(self.wakeup)
+        elif yielded:
+            self.loop.call_later(yielded, self.step)
+        else:
+            self.loop.call_soon(self.step)
+
+    def wakeup(self, future):
+        self.step(future.result, future.exception)
+
+
+class EventLoop(object):
+    def __init__(self, executor_threads=4, poll_interval=0.01):
+        self.executor_threads = executor_threads
+        self.poll_interval = poll_interval
+        self.ready = deque()
+        self.timers = []            # (monotonic时间, seq, Handle)
+        self.seq = itertools.count()
+        self.threadsafe = deque()
+        self.wakeup = threading.Event()
+        self.channels = {}          # channel -> [callback(data)]
+        self.ps = None
+        self.executor = None
+        self.evt_stop = threading.Event()
+
+    # ---- 调度 ----
+    def call_soon(self, callback, *args):
+        handle = Handle(callback, args)
+        self.ready.append(handle)
+        return handle
+
+    def call_soon_threadsafe(self, callback, *args):
+        handle = Handle(callback, args)
+        self.threadsafe.append(handle)
+        self.wakeup.set()
+        return handle
+
+    def call_at(self, when, callback, *args):
+        handle = Handle(callback, args)
+        heapq.heappush(self.timers, (when, next(self.seq), handle))
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(monotonic() + delay, callback, *args)
+
+    def call_every(self, interval, callback, *args):
+        """ 每interval秒调用一次，返回的Handle用于取消 """
+        handle = Handle(callback, args)
+
+        def run():
+            if handle.cancelled:
+                return
+            try:
+                callback(*args)
+            finally:
+                if not handle.cancelled:
+                    self.call_later(interval, run)
+        self.call_later(interval, run)
+        return handle
+
+    def spawn(self, gen):
+        assert isinstance(gen, GeneratorType), gen
+        return Task(self, gen)
+
+    def run_in_executor(self, fn, *args):
+        """ 在线程池里执行阻塞调用，返回Future """
+        if self.executor is None:
+            from multiprocessing.pool import ThreadPool
+            self.executor = ThreadPool(self.executor_threads)
+        future = Future(self)
+
+        def work():
+            try:
+                result = fn(*args)
+            except Exception, e:
+                logger.exception(unicode(e))
+                self.call_soon_threadsafe(future.set_exception, e)
+            else:
+                self.call_soon_threadsafe(future.set_result, result)
+        self.executor.apply_async(work)
+        return future
+
+    # ---- 发布订阅 ----
+    def subscribe(self, channel, callback):
+        """ callback(data)在事件循环线程里调用 """
+        if self.ps is None:
+            self.ps = storage.pubsub()
+        if channel not in self.channels:
+            self.ps.subscribe(channel)
+        self.channels.setdefault(channel, []).append(callback)
+
+    def dispatch_messages(self, timeout):
+        item = self.ps.get_message(timeout=timeout)
+        while item:
+            if item['type'] == 'message':
+                for callback in self.channels.get(item['channel'], ()):
+                    self.call_soon(callback, item['data'])
+            item = self.ps.get_message()
+
+    # ---- 运行 ----
+    def run_once(self):
+        self.wakeup.clear()
+        while self.threadsafe:
+            self.ready.append(self.threadsafe.popleft())
+        now = monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            self.ready.append(heapq.heappop(self.timers)[2])
+        if self.ready:
+            timeout = 0
+        elif self.timers:
+            timeout = min(self.timers[0][0] - now, 1.0)
+        else:
+            timeout = 1.0
+        if self.ps is not None and self.channels:
+            self.dispatch_messages(min(timeout, self.poll_interval))
+        elif timeout > 0:
+            self.wakeup.wait(timeout)
+        for i in xrange(len(self.ready)):
+            handle = self.ready.popleft()
+            if handle.cancelled:
+                continue
+            try:
+                handle.callback(*handle.args)
+            except Exception, e:
+                logger.exception(unicode(e))
+
+    def run(self):
+        while not self.evt_stop.is_set():
+            self.run_once()
+        if self.executor is not None:
+            self.executor.close()
+
+    def run_until_complete(self, future, timeout=None):
+        deadline = timeout and monotonic() + timeout
+        while not future.done:
+            if deadline and monotonic() > deadline:
+                raise RuntimeError(u'等待超时')
+            self.run_once()
+        return future.get()
+
+    def start(self):
+        t = threading.Thread(target=self.run, name='EVENTLOOP')
+        t.daemon = True
+        t.start()
+        return t
+
+    def stop(self):
+        self.evt_stop.set()
+        self.wakeup.set()
+
+
+class LoopOrderTimer(OrderTimeoutThread):
+    """ 在事件循环里运行的订单定时器，每个截止时间是循环定时器堆里的一个条目，不启动线程 """
+
+    def __init__(self, loop, trader, timeout, cancel_wait_time=0.2, quiet_interval=5):
+        super(LoopOrderTimer, self).__init__(trader, timeout, cancel_wait_time, quiet_interval)
+        self.loop = loop
+
+    def schedule(self, order_id, event, deadline):
+        # trader回调可能在网关线程里调用
+        with self.cond:
+            self.deadlines[(order_id, event)] = deadline
+        self.loop.call_soon_threadsafe(self.loop.call_later, max(deadline - time(), 0),
+                                       self.due, order_id, event, deadline)
+
+    def due(self, order_id, event, deadline):
+        with self.cond:
+            if self.deadlines.get((order_id, event)) != deadline:
+                return      # 已移除或重新登记
+            del self.deadlines[(order_id, event)]
+        self.fire(order_id, event)
+
+
+class GatewayAdapter(object):
+    """ 交给同步网关的回调对象：回调在网关线程里调用，转到事件循环线程执行trader的同名方法 """
+    CALLBACKS = ('on_new_order', 'on_trade', 'on_cancel', 'on_reject', 'on_history_trade',
+                 'on_logon', 'on_logout', 'on_account_changed', 'on_day_switch', 'ready_for_trade')
+
+    def __init__(self, loop, trader, retry_interval=0.01, retry_timeout=30.0):
+        self.loop = loop
+        self.trader = trader
+        self.retry_interval = retry_interval
+        self.retry_timeout = retry_timeout
+
+    def __getattr__(self, name):
+        attr = getattr(self.trader, name)
+        if name not in self.CALLBACKS:
+            return attr
+
+        def callback(*args, **kwargs):
+            self.loop.call_soon_threadsafe(self.call, attr, args, kwargs)
+        return callback
+
+    def call(self, method, args, kwargs, deadline=None):
+        if method(*args, **kwargs) is False:
+            # 订单还没有建立（下单和create_order之间），稍后重试，超过retry_timeout秒则放弃
+            now = monotonic()
+            if deadline is None:
+                deadline = now + self.retry_timeout
+            if now >= deadline:
+                logger.error(u'回调{0}{1}重试{2}秒后仍未成功，放弃'.format(
+                    method.__name__, args, self.retry_timeout))
+                return
+            self.loop.call_later(self.retry_interval, self.call, method, args, kwargs, deadline)
+
+
+class MarketDataAdapter(object):
+    """ 行情网关线程调用process_tick，转到事件循环线程执行 """
+
+    def __init__(self, loop, mdapi):
+        self.loop = loop
+        self.mdapi = mdapi
+
+    def process_tick(self, tick):
+        self.loop.call_soon_threadsafe(self.mdapi.process_tick, tick)
+
+    def __getattr__(self, name):
+        return getattr(self.mdapi, name)
+
+
+class TraderLoop(object):
+    """ 在事件循环里运行一个trader的止损检查、限价单超时、资金检查和未成交订单查询 """
+
+    def __init__(self, loop, trader, limit_timeout=None, available_interval=None, reserve=None,
+                 untraded_interval=None, quote_service=None, save_interval=0.2):
+        self.loop = loop
+        self.trader = trader
+        self.stop_checker = CheckStopThread(trader)
+        self.closing = None
+        loop.subscribe('checkstop', self.on_checkstop)
+        if limit_timeout:
+            self.order_timer = LoopOrderTimer(loop, trader, limit_timeout)
+            loop.call_soon(self.order_timer.load)
+        if available_interval and reserve:
+            self.available_checker = CheckAvailableThread(trader, available_interval, reserve)
+            loop.call_every(available_interval, self.when_ready, self.in_executor, self.available_checker.check)
+        if untraded_interval:
+            # LoopOrderTimer已按每个订单的到期时间查询状态，这里的全量扫描只在需要兜底时打开
+            self.untraded_checker = CheckUntradedOrderThread(trader)
+            loop.call_every(untraded_interval, self.when_ready, self.untraded_checker.check)
+        if quote_service:
+            loop.call_every(save_interval, quote_service.save_all)
+
+    def when_ready(self, fn, *args):
+        if self.trader.can_trade():
+            fn(*args)
+
+    def in_executor(self, fn, *args):
+        # 资金检查触发平仓后要等待成交，放到线程池执行
+        self.loop.run_in_executor(fn, *args)
+
+    @logerror
+    def on_checkstop(self, instid):
+        target = self.stop_checker.prepare(instid)
+        if target:
+            orders = self.stop_checker.close_triggered(*target)
+            if orders:
+                self.loop.run_in_executor(self.wait_for_closed, orders)
+
+    def wait_for_closed(self, orders):
+        if not self.trader.wait_for_closed(orders):
+            logger.warning(u'止损(赢)平仓失败，请检查原因!')
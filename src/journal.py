@@ -0,0 +1,441 @@
+# coding:utf8
+""" 订单/成交状态的预写日志。
+回调线程只把Redis写命令追加到本地日志文件，由后台线程按批fsync并写入Redis；
+启动时recover()把尚未写入Redis的记录重放一遍。
+
+启用日志后，用@journaled装饰的模型（Order、Trade、Account、Balance）的save()、状态和余额修改都只写日志，
+本进程读到的是叠加了待写修改的状态：
+    哈希字段和集合成员的读取（属性、get_by_id、索引集合）由JournalClient从待写命令中取最新值；
+    filter等需要在Redis里计算的查询，先把该模型待写的修改写入Redis再查询。
+其他进程最多晚一个batch_interval看到修改。新对象的id按id_block一次向Redis申请一批；
+redisco保存时的Mutex不再访问Redis，启用日志的进程必须是这些模型唯一的写入者（重放日志同样要求）。 """
+import os
+import json
+import struct
+import zlib
+import logging
+import threading
+from datetime import datetime
+
+import redisco
+
+from redisco.models.managers import Manager, ManagerDescriptor
+from redisco.models.modelset import ModelSet
+
+from . import storage
+from .storage import _encode
+
+logger = logging.getLogger(__name__)
+rdb = storage.lazy_client()
+
+HEADER = struct.Struct('<IIQ')    # payload长度, crc32, 序号
+SYNC_ALWAYS, SYNC_BATCH, SYNC_NONE = 'always', 'batch', 'none'
+
+_active = None
+
+
+def active_journal():
+    return _active
+
+
+def activate(journal):
+    """ 设置当前进程使用的日志，None表示直接同步写Redis """
+    global _active
+    _active = journal
+
+
+class CommandRecorder(object):
+    """ 模拟redis pipeline，只记录写命令，execute()时写入日志 """
+    def __init__(self, journal):
+        self.journal = journal
+        self.commands = []
+
+    def __getattr__(self, name):
+        def record(*args):
+            self.commands.append([name] + list(args))
+            return self
+        return record
+
+    def __delitem__(self, name):
+        self.delete(name)
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return self.journal.execute(commands)
+
+
+def _keys(args):
+    for arg in args:
+        if isinstance(arg, (list, tuple)):
+            for key in arg:
+                yield key
+        else:
+            yield arg
+
+
+class JournalClient(object):
+    """ 启用日志时模型使用的客户端：写命令追加到日志，哈希和集合的读取叠加尚未写入Redis的修改，
+    其他读取命令涉及有待写修改的key时先写入Redis """
+    WRITES = frozenset(['hset', 'hmset', 'sadd', 'srem', 'zadd', 'zrem', 'rpush', 'lpush'])
+
+    def __init__(self, journal):
+        self.journal = journal
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return self.journal.pipeline()
+
+    def incr(self, name, amount=1):
+        if amount == 1 and name.endswith(':id'):
+            return self.journal.next_id(name)
+        self.journal.flush_keys([name])
+        return rdb.incr(name, amount)
+
+    def setnx(self, name, value):
+        if name.endswith(':_lock'):
+            return True     # redisco的Mutex，本进程是唯一的写入者
+        self.journal.flush_keys([name])
+        return rdb.setnx(name, value)
+
+    def delete(self, *names):
+        names = [name for name in names if not name.endswith(':_lock')]
+        if names:
+            self.journal.execute([['delete'] + names])
+        return len(names)
+
+    def __delitem__(self, name):
+        self.delete(name)
+
+    def hget(self, name, key):
+        found, values = self.journal.hash_overlay(name)
+        if found and key in values:
+            return values[key]
+        if found is None:
+            return None     # 已删除或整体替换且没有该字段
+        return rdb.hget(name, key)
+
+    def hmget(self, name, keys, *args):
+        keys = list(_keys([keys] + list(args)))
+        return [self.hget(name, key) for key in keys]
+
+    def hgetall(self, name):
+        found, values = self.journal.hash_overlay(name)
+        if found is None:
+            return values
+        result = rdb.hgetall(name) or {}
+        if found:
+            result.update(values)
+        return result
+
+    def smembers(self, name):
+        found, added, removed = self.journal.set_overlay(name)
+        if found is None:
+            return added
+        members = rdb.smembers(name) or set()
+        if found:
+            members = (members - removed) | added
+        return members
+
+    def sismember(self, name, value):
+        return _encode(value) in self.smembers(name)
+
+    def __getattr__(self, name):
+        if name in self.WRITES:
+            def write(*args):
+                self.journal.execute([[name] + list(args)])
+            return write
+        attr = getattr(rdb, name)
+
+        def call(*args, **kwargs):
+            self.journal.flush_keys(_keys(args))
+            return attr(*args, **kwargs)
+        return call
+
+
+class JournalManager(Manager):
+    """ filter等查询前把本模型待写的修改写入Redis；get_by_id先查日志中的新对象和删除 """
+
+    def get_model_set(self):
+        journal = active_journal()
+        if journal:
+            journal.flush_prefix(self.model_class._key)
+        return ModelSet(self.model_class)
+
+    def get_by_id(self, id):
+        journal = active_journal()
+        if journal:
+            found, values = journal.hash_overlay(self.model_class._key[str(id)])
+            if found is None and not values:
+                return None
+            if found is not False:
+                instance = self.model_class()
+                instance._id = str(id)
+                return instance
+        return ModelSet(self.model_class).get_by_id(id)
+
+
+def _model_db(self):
+    journal = active_journal()
+    return journal.client if journal else redisco.get_client()
+
+
+def _delete_from_indices(self, pipeline):
+    # 与redisco相同，但从self.db读取索引集合，才能看到尚未写入Redis的索引
+    for index in self.db.smembers(self.key()['_indices']):
+        pipeline.srem(index, self.id)
+    for index in self.db.smembers(self.key()['_zindices']):
+        pipeline.zrem(index, self.id)
+    pipeline.delete(self.key()['_indices'])
+    pipeline.delete(self.key()['_zindices'])
+
+
+def journaled(model_class):
+    """ 类装饰器：启用日志时模型通过JournalClient读写，查询通过JournalManager """
+    model_class.db = property(_model_db)
+    model_class._delete_from_indices = _delete_from_indices
+    model_class.objects = ManagerDescriptor(JournalManager(model_class))
+    return model_class
+
+
+class Journal(object):
+    """ 追加写的二进制日志。每条记录为HEADER + JSON。
+    sync: always - 每条记录fsync后才返回；batch - 每条记录写入操作系统缓存，后台线程每批fsync一次；
+          none - 只在后台线程每批flush。"""
+
+    def __init__(self, path, name='default', sync=SYNC_BATCH, batch_interval=0.01, max_bytes=64 * 1024 * 1024,
+                 id_block=100):
+        self.path = path
+        self.name = name
+        self.sync = sync
+        self.batch_interval = batch_interval
+        self.max_bytes = max_bytes
+        self.checkpoint_key = 'journal:{0}:applied'.format(name)
+        self.lock = threading.RLock()
+        self.apply_lock = threading.Lock()     # 保证各批按顺序写入
+        self.pending = []       # [(seq, commands), ...] 尚未写入Redis
+        self.dirty = {}         # key -> 最后一条写该key的记录序号
+        self.hashes = {}        # key -> [是否整体替换, {字段: 值}]，待写的哈希修改
+        self.sets = {}          # key -> [是否整体替换, 加入的成员, 删除的成员]，待写的集合修改
+        self.id_block = id_block
+        self.ids = {}           # id key -> [下一个id, 本批最后一个id]
+        self.client = JournalClient(self)
+        self.seq = 0
+        self.fp = None
+        self.evt_stop = threading.Event()
+        self.thread = None
+
+    def pipeline(self):
+        return CommandRecorder(self)
+
+    def open(self):
+        self.fp = open(self.path, 'ab')
+
+    def close(self):
+        with self.lock:
+            if self.fp:
+                self.fp.flush()
+                os.fsync(self.fp.fileno())
+                self.fp.close()
+                self.fp = None
+
+    def append(self, kind, data):
+        """ 追加一条记录，返回序号。kind为'redis'的记录由后台线程写入Redis，其他记录只用于审计 """
+        with self.lock:
+            self.seq += 1
+            payload = json.dumps([kind, data], default=_json_default)
+            self.fp.write(HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff, self.seq))
+            self.fp.write(payload)
+            if self.sync != SYNC_NONE:
+                self.fp.flush()
+            if self.sync == SYNC_ALWAYS:
+                os.fsync(self.fp.fileno())
+            if kind == 'redis' and data:
+                self.pending.append((self.seq, data))
+                for command in data:
+                    self.overlay(command)
+            return self.seq
+
+    def overlay(self, command):
+        """ 记录待写命令对哈希和集合的修改，调用者持有self.lock """
+        name, args = command[0], command[1:]
+        keys = args if name == 'delete' else args[:1]
+        for key in keys:
+            self.dirty[key] = self.seq
+        key = args[0]
+        if name == 'delete':
+            for key in args:
+                self.hashes[key] = [True, {}]
+                self.sets[key] = [True, set(), set()]
+        elif name in ('hset', 'hmset'):
+            values = self.hashes.setdefault(key, [False, {}])[1]
+            if name == 'hset':
+                values[args[1]] = _encode(args[2])
+            else:
+                values.update((k, _encode(v)) for k, v in args[1].iteritems())
+        elif name in ('sadd', 'srem'):
+            replaced, added, removed = self.sets.setdefault(key, [False, set(), set()])
+            for member in map(_encode, args[1:]):
+                if name == 'sadd':
+                    added.add(member)
+                    removed.discard(member)
+                else:
+                    removed.add(member)
+                    added.discard(member)
+
+    def hash_overlay(self, key):
+        """ 返回(found, {字段: 值})：found为False表示没有待写修改，True表示有部分字段的修改，
+        None表示整个哈希已被替换（不再读Redis） """
+        with self.lock:
+            entry = self.hashes.get(key)
+            if entry is None:
+                return False, {}
+            return (None if entry[0] else True), dict(entry[1])
+
+    def set_overlay(self, key):
+        """ 返回(found, 加入的成员, 删除的成员)，found的含义同hash_overlay """
+        with self.lock:
+            entry = self.sets.get(key)
+            if entry is None:
+                return False, set(), set()
+            return (None if entry[0] else True), set(entry[1]), set(entry[2])
+
+    def next_id(self, key):
+        """ 新对象的id，每id_block个向Redis申请一次 """
+        with self.lock:
+            block = self.ids.get(key)
+            if block is None or block[0] > block[1]:
+                last = int(rdb.incr(key, self.id_block))
+                block = self.ids[key] = [last - self.id_block + 1, last]
+            block[0] += 1
+            return block[0] - 1
+
+    def execute(self, commands):
+        """ 写入日志，由后台线程写入Redis，返回序号 """
+        return self.append('redis', commands)
+
+    def is_dirty(self, key):
+        """ key是否有尚未写入Redis的修改 """
+        return key in self.dirty
+
+    def flush_keys(self, keys):
+        """ 任一key有待写修改时先写入Redis """
+        if self.dirty and any(isinstance(key, basestring) and key in self.dirty for key in keys):
+            self.flush()
+
+    def flush_prefix(self, prefix):
+        prefix = '{0}:'.format(prefix)
+        if any(key.startswith(prefix) for key in self.dirty.keys()):
+            self.flush()
+
+    def read(self, truncate=False):
+        """ 依次返回(seq, kind, data)。遇到不完整或校验失败的记录（崩溃时写了一半）即停止，
+        truncate为True时截掉这部分内容。"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            good = 0
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                length, crc, seq = HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                    break
+                good = f.tell()
+                kind, data = json.loads(payload)
+                yield seq, kind, data
+            tail = os.path.getsize(self.path) - good
+        if truncate and tail:
+            logger.warning(u'日志{0}末尾有{1}字节不完整的记录，已截掉'.format(self.path, tail))
+            with open(self.path, 'r+b') as f:
+                f.truncate(good)
+
+    def applied_seq(self):
+        return int(rdb.get(self.checkpoint_key) or 0)
+
+    def recover(self):
+        """ 把日志中尚未写入Redis的记录写入Redis，返回重放的记录数 """
+        applied = self.applied_seq()
+        count = 0
+        with self.lock:
+            for seq, kind, data in self.read(truncate=True):
+                self.seq = max(self.seq, seq)
+                if seq > applied and kind == 'redis':
+                    self.pending.append((seq, data))
+                    count += 1
+            self.seq = max(self.seq, applied)
+        # apply()先取apply_lock再取lock，不能在持有lock时调用
+        self.flush()
+        if count:
+            logger.info(u'从日志{0}恢复了{1}条记录'.format(self.path, count))
+        return count
+
+    def apply(self, sync_file=True):
+        """ 把待写记录一次性写入Redis，并记录检查点。sync_file为False时不fsync日志文件 """
+        with self.apply_lock:
+            with self.lock:
+                batch, self.pending = self.pending, []
+                if sync_file and self.fp and self.sync != SYNC_ALWAYS:
+                    self.fp.flush()
+                    if self.sync == SYNC_BATCH:
+                        os.fsync(self.fp.fileno())
+            if not batch:
+                return 0
+            last = batch[-1][0]
+            pipeline = rdb.pipeline(transaction=True)
+            for seq, commands in batch:
+                for command in commands:
+                    getattr(pipeline, command[0])(*command[1:])
+            pipeline.set(self.checkpoint_key, last)
+            try:
+                pipeline.execute()
+            except Exception, e:
+                logger.exception(unicode(e))
+                with self.lock:
+                    self.pending[:0] = batch
+                return 0
+            with self.lock:
+                for key, seq in self.dirty.items():
+                    if seq <= last:
+                        del self.dirty[key]
+                        self.hashes.pop(key, None)
+                        self.sets.pop(key, None)
+            self.compact()
+            return len(batch)
+
+    def flush(self):
+        """ 立即写入全部待写记录。需要从Redis读到最新状态前调用 """
+        while self.pending:
+            if not self.apply():
+                break
+
+    def compact(self):
+        with self.lock:
+            if self.fp and not self.pending and self.fp.tell() > self.max_bytes:
+                self.fp.truncate(0)
+                self.fp.seek(0)
+
+    def run(self):
+        while not self.evt_stop.wait(self.batch_interval):
+            self.apply()
+        self.flush()
+
+    def start(self):
+        """ 恢复未写入的记录，然后启动后台写入线程 """
+        self.recover()
+        self.open()
+        self.thread = threading.Thread(target=self.run, name='JOURNAL-' + self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.evt_stop.set()
+        if self.thread:
+            self.thread.join()
+        self.close()
+
+
+def _json_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(repr(obj))
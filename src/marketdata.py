@@ -2,10 +2,12 @@
 import logging
 from abc import ABCMeta, abstractmethod
 
-import redisco
+from . import storage
+from .metrics import metrics
+from .depth import depth_books
 
 logger = logging.getLogger(__name__)
-rdb = redisco.get_client()
+rdb = storage.lazy_client('tick')
 
 
 class MarketDataApi(object):
@@ -23,14 +25,39 @@ class MarketDataApi(object):
     def process_tick(self, tick):
         # logger.debug(str(tick))
         secid = tick.securityID
+        if metrics.enabled:
+            metrics.stamp(('tick', secid))
+        if self.quote_service.tick_bus:
+            self.quote_service.tick_bus.write(tick)
         rdb.hset('current_price', secid, tick.price)
         if hasattr(tick, 'b_price'):
             rdb.hset('current_b_price', secid, tick.b_price)
         if hasattr(tick, 's_price'):
             rdb.hset('current_s_price', secid, tick.s_price)
+        router = self.quote_service.shard_router
+        if self.quote_service.tick_stream:
+            self.quote_service.tick_stream.append(tick)
+        elif router:
+            rdb.publish(router.channel(secid), secid)
+        # AvailableGuardThread和TraderLoop只订阅全局频道，分片或写流时也要发布
         rdb.publish('checkstop', secid)
-        with self.quote_service.tick_lock:
-            self.quote_service.tickdata[secid].append(tick)
+        if metrics.enabled:
+            metrics.elapsed('tick_publish', ('tick', secid))
+        if router:
+            router.route(tick)
+        else:
+            with self.quote_service.tick_lock:
+                self.quote_service.tickdata[secid].append(tick)
+        if self.quote_service.tick_archive:
+            self.quote_service.tick_archive.append(tick)
+
+    def process_depth(self, secid, updates):
+        """ 盘口增量：updates为[(is_bid, 价格, 数量), ...]，数量为0表示删除该价位 """
+        depth_books.book(secid).update(updates)
+
+    def process_depth_snapshot(self, secid, bids, asks):
+        """ 完整盘口（例如每笔行情附带的五档）：bids/asks为[(价格, 数量), ...] """
+        depth_books.book(secid).replace(bids, asks)
 
     @abstractmethod
     def subscribe(self, instruments):
@@ -0,0 +1,277 @@
+# coding:utf8
+""" 模拟交易所撮合引擎。
+每个合约一个订单簿，价格优先、时间优先；成交价为被动方挂单价，支持部分成交；
+市价单（价格为0）对手盘不足时剩余部分立即撤销。
+下单和撤单在调用线程内同步撮合（只操作内存，不访问Redis），产生的回报按顺序放入队列，
+由回报线程像真实网关一样异步调用trader的on_new_order、on_trade、on_cancel、on_reject。
+因此撤单可能与成交竞争：撤单请求到达时订单已全部成交，则不会有撤单回报。
+
+    engine = MatchingEngine()
+    trader = MatchingTrader(engine, 'sim', 'sim', 'CNY', 'IF1505:10')
+    engine.quote('IF1505', 3500.0, 3500.2, 100)    # 模拟其他市场参与者的挂单
+    engine.start()
+"""
+import heapq
+import logging
+import itertools
+import threading
+from collections import deque
+from datetime import datetime
+
+from .trader import BaseTrader
+from .models.order import order_index
+
+logger = logging.getLogger(__name__)
+
+
+class BookOrder(object):
+    __slots__ = ('local_id', 'sys_id', 'secid', 'price', 'volume', 'remaining', 'is_buy', 'owner', 'active')
+
+    def __init__(self, local_id, sys_id, secid, price, volume, is_buy, owner):
+        self.local_id = local_id
+        self.sys_id = sys_id
+        self.secid = secid
+        self.price = price
+        self.volume = volume
+        self.remaining = volume
+        self.is_buy = is_buy
+        self.owner = owner
+        self.active = True
+
+
+class OrderBook(object):
+    """ 单个合约的订单簿。每个价位一个FIFO队列，最优价由堆维护；
+    撤单只做标记，队列头部和堆顶的失效条目在撮合时丢弃。"""
+
+    def __init__(self, secid):
+        self.secid = secid
+        self.levels = ({}, {})      # (卖, 买): price -> deque
+        self.prices = ([], [])      # 卖价最小堆，买价取负的最小堆
+
+    def best_price(self, is_buy):
+        levels, prices = self.levels[is_buy], self.prices[is_buy]
+        while prices:
+            price = -prices[0] if is_buy else prices[0]
+            queue = levels.get(price)
+            while queue and not queue[0].active:
+                queue.popleft()
+            if queue:
+                return price
+            heapq.heappop(prices)
+            levels.pop(price, None)
+        return None
+
+    def best_bid(self):
+        return self.best_price(True)
+
+    def best_ask(self):
+        return self.best_price(False)
+
+    def depth(self, is_buy, price):
+        return sum([o.remaining for o in self.levels[is_buy].get(price, ()) if o.active])
+
+    def add(self, order):
+        levels = self.levels[order.is_buy]
+        queue = levels.get(order.price)
+        if queue is None:
+            queue = levels[order.price] = deque()
+            heapq.heappush(self.prices[order.is_buy], -order.price if order.is_buy else order.price)
+        queue.append(order)
+
+    def match(self, order):
+        """ 用order吃对手盘，返回[(被动方订单, 成交价, 成交量), ...] """
+        fills = []
+        opposite = not order.is_buy
+        while order.remaining > 0:
+            price = self.best_price(opposite)
+            if price is None:
+                break
+            if order.price and (price > order.price if order.is_buy else price < order.price):
+                break
+            queue = self.levels[opposite][price]
+            while queue and order.remaining > 0:
+                resting = queue[0]
+                if not resting.active:
+                    queue.popleft()
+                    continue
+                volume = min(order.remaining, resting.remaining)
+                order.remaining -= volume
+                resting.remaining -= volume
+                if resting.remaining <= 0:
+                    resting.active = False
+                    queue.popleft()
+                fills.append((resting, price, volume))
+        return fills
+
+
+class MatchingEngine(object):
+    EV_NEW, EV_TRADE, EV_CANCEL, EV_REJECT = range(4)
+
+    def __init__(self, now=datetime.now, retry_interval=0.001, max_retries=1000):
+        self.now = now
+        self.retry_interval = retry_interval
+        self.max_retries = max_retries
+        self.books = {}
+        self.orders = {}        # local_id -> BookOrder, 只保存未完成的订单
+        self.halted = set()     # 停牌合约，新订单被拒绝
+        self.lock = threading.Lock()
+        self.local_ids = itertools.count(1)
+        self.sys_ids = itertools.count(1)
+        self.exec_ids = itertools.count(1)
+        self.events = deque()
+        self.cond = threading.Condition()
+        self.evt_stop = threading.Event()
+        self.stats = {'orders': 0, 'trades': 0, 'cancels': 0, 'rejects': 0, 'events': 0}
+
+    def book(self, secid):
+        book = self.books.get(secid)
+        if book is None:
+            book = self.books[secid] = OrderBook(secid)
+        return book
+
+    def emit(self, owner, event, args):
+        if owner is not None:
+            with self.cond:
+                self.events.append((owner, event, args))
+                self.cond.notify()
+
+    def submit(self, secid, price, volume, is_buy, owner=None):
+        """ 下单，返回本地订单号。owner为None的订单（模拟其他市场参与者）没有回报。"""
+        local_id = 'ME{0}'.format(next(self.local_ids))
+        volume = abs(volume)
+        now = self.now()
+        with self.lock:
+            self.stats['orders'] += 1
+            if volume <= 0 or price < 0 or secid in self.halted:
+                self.stats['rejects'] += 1
+                reason = u'合约停牌' if secid in self.halted else u'价格或数量错误'
+                self.emit(owner, self.EV_REJECT, (local_id, 1, reason))
+                return local_id
+            order = BookOrder(local_id, 'MESYS{0}'.format(next(self.sys_ids)), secid, price, volume, is_buy, owner)
+            self.emit(owner, self.EV_NEW, (local_id, secid, order.sys_id, is_buy, price, volume, now))
+            book = self.book(secid)
+            for resting, fill_price, fill_volume in book.match(order):
+                self.stats['trades'] += 1
+                for o in (resting, order):
+                    self.emit(o.owner, self.EV_TRADE, ('MEEXEC{0}'.format(next(self.exec_ids)), secid, o.sys_id,
+                                                       fill_price, fill_volume, now))
+                if not resting.active:
+                    self.orders.pop(resting.local_id, None)
+            if order.remaining > 0:
+                if price:
+                    book.add(order)
+                    self.orders[local_id] = order
+                else:
+                    # 市价单剩余部分撤销
+                    order.active = False
+                    self.stats['cancels'] += 1
+                    self.emit(owner, self.EV_CANCEL, (local_id,))
+            else:
+                order.active = False
+        return local_id
+
+    def cancel(self, local_id):
+        """ 撤单，订单已全部成交或已撤销时返回False """
+        with self.lock:
+            order = self.orders.pop(local_id, None)
+            if order is None or not order.active:
+                return False
+            order.active = False
+            self.stats['cancels'] += 1
+            self.emit(order.owner, self.EV_CANCEL, (local_id,))
+            return True
+
+    def halt(self, secid, halted=True):
+        with self.lock:
+            if halted:
+                self.halted.add(secid)
+            else:
+                self.halted.discard(secid)
+
+    def quote(self, secid, bid, ask, volume):
+        """ 以无回报的订单在买卖两边挂单，为撮合提供流动性 """
+        if bid:
+            self.submit(secid, bid, volume, True)
+        if ask:
+            self.submit(secid, ask, volume, False)
+
+    def deliver(self, owner, event, args):
+        """ 返回False表示trader还不认识该订单（下单和create_order之间），稍后重试 """
+        if event != self.EV_TRADE and order_index.get_by_local_id(args[0]) is None:
+            return False
+        if event == self.EV_NEW:
+            return owner.on_new_order(*args)
+        elif event == self.EV_TRADE:
+            return owner.on_trade(*args)
+        elif event == self.EV_CANCEL:
+            return owner.on_cancel(*args)
+        else:
+            return owner.on_reject(*args)
+
+    def dispatch(self, max_wait=0):
+        """ 按顺序发送回报，直到队列为空。回报返回False时留在队首重试，
+        超过max_retries次后丢弃。"""
+        retries = 0
+        while True:
+            with self.cond:
+                if not self.events and max_wait:
+                    self.cond.wait(max_wait)
+                if not self.events:
+                    return
+                owner, event, args = self.events[0]
+            try:
+                result = self.deliver(owner, event, args)
+            except Exception, e:
+                logger.exception(unicode(e))
+                result = None
+            if result is False:
+                if retries < self.max_retries:
+                    retries += 1
+                    if self.evt_stop.wait(self.retry_interval):
+                        return
+                    continue
+                logger.warning(u'回报{0}{1}重试{2}次仍未成功，丢弃'.format(event, args, retries))
+            retries = 0
+            with self.cond:
+                self.events.popleft()
+            self.stats['events'] += 1
+
+    def run(self):
+        while not self.evt_stop.is_set():
+            self.dispatch(max_wait=0.1)
+
+    def start(self):
+        t = threading.Thread(target=self.run, name='MATCHING-ENGINE')
+        t.daemon = True
+        t.start()
+        return t
+
+    def stop(self):
+        self.evt_stop.set()
+        with self.cond:
+            self.cond.notify_all()
+
+
+class MatchingTrader(BaseTrader):
+    """ 在本地撮合引擎上交易的trader """
+    is_simul = True
+
+    def __init__(self, engine, *args, **kwargs):
+        super(MatchingTrader, self).__init__(*args, **kwargs)
+        self.engine = engine
+        self.is_logged = self.is_ready = True
+
+    def open_market_order(self, inst, volume, direction):
+        return self.engine.submit(inst.secid, 0.0, volume, direction, self)
+
+    def open_limit_order(self, inst, price, volume, direction):
+        return self.engine.submit(inst.secid, price, volume, direction, self)
+
+    def close_market_order(self, order, volume):
+        return self.engine.submit(order.instrument.secid, 0.0, volume, not order.is_long, self)
+
+    def close_limit_order(self, order, price, volume):
+        return self.engine.submit(order.instrument.secid, price, volume, not order.is_long, self)
+
+    def cancel_orders(self, orders):
+        return [order for order in orders if self.engine.cancel(order.local_id)]
@@ -0,0 +1,248 @@
+# coding:utf8
+""" 热点路径延迟统计。
+各阶段用单调时钟打时间戳，延迟（微秒）记入对数分桶直方图（与HdrHistogram相同的分桶方式，
+每个2的幂区间32个桶，相对误差约3%），另外统计每种Redis命令的往返次数和耗时。
+默认关闭，调用处先判断metrics.enabled，关闭时只多一次属性读取：
+
+    from sectradelib.metrics import metrics
+    metrics.enable()
+    metrics.start_server(8765)      # GET http://127.0.0.1:8765/metrics 返回JSON
+    metrics.start_reporter(60)      # 每60秒写一次日志
+
+阶段：
+    tick_publish  process_tick收到tick到发布checkstop消息
+    tick_check    收到tick到CheckStopThread开始检查（同一进程内）
+    stop_check    一次止损检查（不含等待平仓）
+    tick_submit   收到tick到止损平仓单发出（同一进程内）
+    submit_fill   平仓单发出到收到成交回报
+    redis:<命令>  Redis命令往返时间
+    stream_lag:<组>  tick写入流到该消费组处理完的时间（见streams.py）
+计数器（snapshot()['counters']）：
+    stream_acked:<组>    已确认的流消息数
+    stream_dropped:<组>  消费落后太多、被MAXLEN裁剪掉未处理的消息数
+"""
+import json
+import logging
+import threading
+from functools import wraps
+
+from . import storage
+from .utils import monotonic
+
+logger = logging.getLogger(__name__)
+
+SUB_BITS = 5
+SUB_COUNT = 1 << SUB_BITS
+
+
+class Histogram(object):
+    """ 微秒延迟直方图。小于32的值每个值一个桶，之后每个2的幂区间分32个桶 """
+
+    def __init__(self, max_value=60 * 1000000):
+        self.max_index = self.index(max_value)
+        self.counts = [0] * (self.max_index + 1)
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = 0
+
+    @staticmethod
+    def index(value):
+        if value < SUB_COUNT:
+            return value
+        shift = value.bit_length() - SUB_BITS - 1
+        return (shift + 1) * SUB_COUNT + (value >> shift) - SUB_COUNT
+
+    @staticmethod
+    def upper_bound(index):
+        if index < SUB_COUNT:
+            return index
+        shift = index // SUB_COUNT - 1
+        return ((index % SUB_COUNT + SUB_COUNT + 1) << shift) - 1
+
+    def record(self, value):
+        value = max(int(value), 0)
+        self.counts[min(self.index(value), self.max_index)] += 1
+        self.total += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if not self.total:
+            return 0
+        target = max(1, int(round(self.total * p / 100.0)))
+        count = 0
+        for index, n in enumerate(self.counts):
+            count += n
+            if count >= target:
+                return min(self.upper_bound(index), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.total,
+            'min': self.min or 0,
+            'mean': self.sum / float(self.total) if self.total else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+            'max': self.max,
+        }
+
+
+class Metrics(object):
+    def __init__(self, max_stamps=10000):
+        self.enabled = False
+        self.max_stamps = max_stamps
+        self.histograms = {}
+        self.counters = {}
+        self.stamps = {}
+        self.lock = threading.Lock()
+        self.evt_stop = threading.Event()
+        self.server = None
+        self.clients = []
+
+    def enable(self, client=None):
+        """ 开始统计，并统计client（默认为各角色的连接，见storage.all_clients）的命令往返 """
+        self.enabled = True
+        for c in [client] if client else storage.all_clients():
+            self.instrument_client(c)
+
+    def disable(self):
+        self.enabled = False
+        for client in self.clients:
+            for att in ('execute_command', 'pipeline'):
+                client.__dict__.pop(att, None)
+        self.clients = []
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+            self.stamps = {}
+
+    def record(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.record(seconds * 1000000)
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def stamp(self, key):
+        if len(self.stamps) >= self.max_stamps:
+            self.stamps.clear()     # 没有后续阶段的时间戳（例如被撤销的订单）不再保留
+        self.stamps[key] = monotonic()
+
+    def elapsed(self, stage, key, pop=False):
+        """ 记录从stamp(key)到现在的时间 """
+        start = self.stamps.pop(key, None) if pop else self.stamps.get(key)
+        if start is not None:
+            self.record(stage, monotonic() - start)
+
+    def instrument_client(self, client):
+        """ 在客户端对象上包装execute_command和pipeline，统计每种命令的往返时间 """
+        if any(client is c for c in self.clients) or not hasattr(client, 'execute_command'):
+            return
+        self.clients.append(client)
+        execute_command = client.execute_command
+        pipeline = client.pipeline
+        metrics = self
+
+        @wraps(execute_command)
+        def timed_execute_command(*args, **options):
+            if not metrics.enabled:
+                return execute_command(*args, **options)
+            start = monotonic()
+            try:
+                return execute_command(*args, **options)
+            finally:
+                metrics.record('redis:' + str(args[0]).lower(), monotonic() - start)
+
+        @wraps(pipeline)
+        def timed_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+
+            def timed_execute(*a, **kw):
+                if not metrics.enabled:
+                    return execute(*a, **kw)
+                start = monotonic()
+                try:
+                    return execute(*a, **kw)
+                finally:
+                    metrics.record('redis:pipeline', monotonic() - start)
+            pipe.execute = timed_execute
+            return pipe
+
+        client.execute_command = timed_execute_command
+        client.pipeline = timed_pipeline
+
+    def snapshot(self):
+        """ {阶段: 统计}，有计数器时另有'counters': {名称: 计数} """
+        with self.lock:
+            snapshot = dict((stage, h.summary()) for stage, h in self.histograms.items())
+            if self.counters:
+                snapshot['counters'] = dict(self.counters)
+            return snapshot
+
+    def dump(self):
+        snapshot = self.snapshot()
+        counters = snapshot.pop('counters', {})
+        for stage, s in sorted(snapshot.items()):
+            logger.info(u'{0}: 次数={1[count]} 平均={1[mean]:.0f}us p50={1[p50]}us p99={1[p99]}us '
+                        u'最大={1[max]}us'.format(stage, s))
+        for name, count in sorted(counters.items()):
+            logger.info(u'{0}: {1}'.format(name, count))
+
+    def start_reporter(self, interval=60):
+        def run():
+            while not self.evt_stop.wait(interval):
+                self.dump()
+        t = threading.Thread(target=run, name='METRICS-REPORTER')
+        t.daemon = True
+        t.start()
+        return t
+
+    def start_server(self, port=0, host='127.0.0.1'):
+        """ 启动本地HTTP服务，GET /metrics返回各阶段统计（JSON）。返回实际监听的端口 """
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') not in ('', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = json.dumps(metrics.snapshot(), sort_keys=True)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer((host, port), Handler)
+        t = threading.Thread(target=self.server.serve_forever, name='METRICS-SERVER')
+        t.daemon = True
+        t.start()
+        return self.server.server_address[1]
+
+    def stop(self):
+        self.evt_stop.set()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+metrics = Metrics()
@@ -7,8 +7,9 @@ from operator import attrgetter
 from redisco import models
 
 from .instrument import Instrument
-from .order import Order
+from .order import Order, order_index
 from ..utils import current_price
+from ..journal import active_journal, journaled
 
 logger = logging.getLogger(__name__)
 
@@ -25,19 +26,30 @@ def convert_currency(value, from_ccy, to_ccy):
     raise RuntimeError(u'找不到货币{0}兑{1}的汇率'.format(from_ccy, to_ccy))
 
 
+@journaled
 class Balance(models.Model):
     value = models.FloatField()
     currency = models.Attribute()
-        
+
+    def save_value(self):
+        """ 只保存余额，启用预写日志时只写日志 """
+        assert self.is_valid(), self.errors
+        if active_journal():
+            self.db.hset(self.key(), 'value', self.value)
+        else:
+            self.save()
+
     def convert_to(self, to_ccy):
         return convert_currency(self.value, self.currency, to_ccy)
 
 
+@journaled
 class Account(models.Model):
     code = models.Attribute(required=True)
     default_currency = models.Attribute(required=True, indexed=False, default='USD')
     last_trade_time = models.DateTimeField(indexed=False)
     balances = models.ListField(Balance, indexed=False)
+    opened_orders_cache_ttl = 1    # 秒，0表示不缓存（回测）
 
     def __init__(self, *args, **kwargs):
         super(Account, self).__init__(*args, **kwargs)
@@ -49,7 +61,7 @@ class Account(models.Model):
 
     def opened_orders(self, instrument=None, strategy_code=''):
         key = 'opened_orders:{0}:{1}:{2}'.format(self.id, instrument, strategy_code)
-        cached = self.db.get(key)
+        cached = self.opened_orders_cache_ttl and self.db.get(key)
         if cached:
             return [Order.objects.get_by_id(oid) for oid in json.loads(cached)]
         else:
@@ -60,8 +72,9 @@ class Account(models.Model):
                 queryset = queryset.filter(strategy_code=strategy_code)
             orders = list(queryset.filter(status=Order.OS_FILLED))
             orders.extend(list(queryset.filter(status=Order.OS_CLOSING)))
-            cached = json.dumps([o.id for o in orders])
-            self.db.setex(key, cached, 1)
+            if self.opened_orders_cache_ttl:
+                cached = json.dumps([o.id for o in orders])
+                self.db.setex(key, cached, self.opened_orders_cache_ttl)
             return orders
 
     def untraded_orders(self, instrument=None, strategy_code=''):
@@ -121,8 +134,7 @@ class Account(models.Model):
     def book(self, change, currency, memo):
         balance = self.get_balance_object(currency)
         balance.value += float(change)
-        assert balance.is_valid(), balance.errors
-        balance.save()
+        balance.save_value()
         msg = u'{3}：{0}{1}, 余额{2}{1}'.format(change, currency, balance.value, memo)
         if u'利润' in msg:
             logger.info(msg)
@@ -137,8 +149,7 @@ class Account(models.Model):
         currency = currency or self.default_currency
         balance = self.get_balance_object(currency)
         balance.value = float(quantity)
-        assert balance.is_valid(), balance.errors
-        balance.save()
+        balance.save_value()
         logger.debug(u'设置资金余额：{0}{1}'.format(quantity, currency))
 
     def set_available(self, available):
@@ -146,7 +157,7 @@ class Account(models.Model):
 
     def create_order(self, local_order_id, inst=None, price=None, volume=None, is_open=None, strategy_code='', orig_order=None):
         assert is_open is None or is_open == (orig_order is None), (is_open, orig_order)
-        neworder = Order.objects.filter(local_id=local_order_id).first()
+        neworder = order_index.get_by_local_id(local_order_id, self.id)
         if not neworder:
             neworder = Order(local_id=local_order_id, instrument=inst)
             try:
@@ -180,3 +191,4 @@ class Account(models.Model):
         if not self.last_trade_time or self.last_trade_time < tradetime:
             self.last_trade_time = tradetime
             self.save()
+        return trade
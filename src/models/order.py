@@ -1,14 +1,20 @@
 # coding:utf8
 import logging
+import threading
+from collections import OrderedDict
+
 from redisco import models
+from redisco.models.utils import _encode_key
 
 from .instrument import Instrument
+from .. import storage
 from ..utils import current_price
-from .. import STRATEGIES
+from ..journal import active_journal, journaled
 
 logger = logging.getLogger(__name__)
 
 
+@journaled
 class Trade(models.Model):
     exec_id = models.Attribute(required=True)
     order = models.ReferenceField('Order')
@@ -39,6 +45,7 @@ class Trade(models.Model):
         self.commission = self.order.instrument.calc_commission(price, volume, is_open)
         assert self.is_valid(), self.errors
         self.save()
+        order_index.add_exec_id(exec_id)
 
     def on_close(self):
         for orig_trade in self.order.orig_order.trades:
@@ -63,6 +70,7 @@ class Trade(models.Model):
         self.save()
 
 
+@journaled
 class Order(models.Model):
     OS_NONE, OS_NEW, OS_CANCELED, OS_FILLED, OS_CLOSING, OS_CLOSED, OS_REJECTED = range(7)
     account = models.ReferenceField('Account')
@@ -152,11 +160,20 @@ class Order(models.Model):
 
     @property
     def strategy(self):
+        from .. import STRATEGIES   # 延迟导入，避免models依赖包的初始化顺序
         return STRATEGIES.get(self.strategy_code)
 
+    def save(self):
+        result = super(Order, self).save()
+        if result is True:
+            order_index.add(self)
+        return result
+
     def delete(self, *args, **kwargs):
         for t in self.trades:
+            order_index.discard_exec_id(t.exec_id)
             t.delete()
+        order_index.discard(self)
         super(Order, self).delete(*args, **kwargs)
 
     def update_index_value(self, att, value):
@@ -190,7 +207,11 @@ class Order(models.Model):
         pipeline.hset(self.key(), att, value)
         pipeline.execute()
         # set instance value
+        if att in ('local_id', 'sys_id'):
+            order_index.discard(self)
         setattr(self, att, value)
+        if att in ('local_id', 'sys_id'):
+            order_index.add(self)
 
     def update_status(self, value):
         value = int(value)
@@ -251,13 +272,16 @@ class Order(models.Model):
     def on_trade(self, price, volume, tradetime, execid):
         assert self.is_open is not None
         # check duplicate trade
-        if Trade.objects.filter(exec_id=execid):
+        if order_index.has_exec_id(execid, self.account_id):
             logger.debug(u'EXECID {0} 已经存在!'.format(execid))
             return False
         if not self.is_long:
             volume = -volume
         t = Trade(order=self)
         t.on_trade(price, volume, tradetime, execid, self.is_open)
+        journal = active_journal()
+        if journal:
+            journal.append('fill', [self.id, execid, t.price, t.volume, tradetime])
         self.update_status(Order.OS_FILLED)
         logger.info(u'<策略{0}>成交回报: {1}{2}仓 合约={3} 价格={4} 数量={5}'.format(
                 self.strategy_code,
@@ -305,3 +329,128 @@ class Order(models.Model):
             # 平仓单手数大于原订单开仓手数，原订单全部平仓后，将平仓单剩余手数改为开仓单
             #self.change_to_open_order()
             #logger.debug(u'订单{0}转为开仓单'.format(self.sys_id))
+
+
+class OrderIndex(object):
+    """ 进程内的订单号索引：local_id/sys_id -> Order.id，以及最近成交编号的去重集合。
+    load(account)之后，查询该账户的订单号和成交编号未命中时直接返回，无需再查询Redis；
+    其他账户（以及调用时未指定账户）仍按原方式查询Redis。
+    成交编号超过max_exec_ids后淘汰最早的，此时未命中的成交编号仍需查询Redis。"""
+    ALL = '*'
+
+    def __init__(self, max_exec_ids=100000):
+        self.max_exec_ids = max_exec_ids
+        self.by_local_id = {}
+        self.by_sys_id = {}
+        self.exec_ids = OrderedDict()
+        self.exec_ids_complete = True
+        self.accounts = set()       # 已完整加载的账户id，ALL表示全部订单
+        self.lock = threading.RLock()
+
+    def load(self, account=None):
+        """ 从Redis重建索引：订单号和成交编号各用一次pipeline读取 """
+        db = storage.get_client()
+        if account:
+            oids = list(db.smembers(Order._key['account_id'][_encode_key(account.id)]))
+        else:
+            oids = list(db.smembers(Order._key['all']))
+        pipe = db.pipeline(transaction=False)
+        for oid in oids:
+            pipe.hmget(Order._key[oid], ['local_id', 'sys_id'])
+            pipe.smembers(Trade._key['order_id'][_encode_key(oid)])
+        results = pipe.execute()
+        tids = set()
+        for trade_ids in results[1::2]:
+            tids.update(trade_ids)
+        tids = list(tids)
+        for tid in tids:
+            pipe.hget(Trade._key[tid], 'exec_id')
+        exec_ids = pipe.execute()
+        with self.lock:
+            for oid, (local_id, sys_id) in zip(oids, results[::2]):
+                if local_id:
+                    self.by_local_id[local_id] = oid
+                if sys_id:
+                    self.by_sys_id[sys_id] = oid
+            for exec_id in exec_ids:
+                if exec_id:
+                    self.add_exec_id(exec_id)
+            self.mark_loaded(account)
+
+    def mark_loaded(self, account=None):
+        with self.lock:
+            self.accounts.add(account.id if account else self.ALL)
+
+    def is_loaded(self, account_id=None):
+        """ 账户的订单和成交是否已完整加载 """
+        return self.ALL in self.accounts or (account_id is not None and account_id in self.accounts)
+
+    def clear(self):
+        """ 切换存储后调用 """
+        with self.lock:
+            self.by_local_id.clear()
+            self.by_sys_id.clear()
+            self.exec_ids.clear()
+            self.exec_ids_complete = True
+            self.accounts.clear()
+
+    def add(self, order):
+        with self.lock:
+            if order.local_id:
+                self.by_local_id[order.local_id] = order.id
+            if order.sys_id:
+                self.by_sys_id[order.sys_id] = order.id
+
+    def discard(self, order):
+        with self.lock:
+            if self.by_local_id.get(order.local_id) == order.id:
+                del self.by_local_id[order.local_id]
+            if self.by_sys_id.get(order.sys_id) == order.id:
+                del self.by_sys_id[order.sys_id]
+
+    def has_sys_id(self, sys_id, account_id=None):
+        if sys_id in self.by_sys_id:
+            return True
+        if self.is_loaded(account_id):
+            return False
+        return bool(Order.objects.filter(sys_id=sys_id))
+
+    def _get(self, mapping, att, value, account_id):
+        oid = mapping.get(value)
+        if oid is not None:
+            order = Order.objects.get_by_id(oid)
+            if order is not None and getattr(order, att) == value:
+                return order
+        elif self.is_loaded(account_id):
+            return None
+        order = Order.objects.filter(**{att: value}).first()
+        if order:
+            self.add(order)
+        return order
+
+    def get_by_local_id(self, local_id, account_id=None):
+        return self._get(self.by_local_id, 'local_id', local_id, account_id)
+
+    def get_by_sys_id(self, sys_id, account_id=None):
+        return self._get(self.by_sys_id, 'sys_id', sys_id, account_id)
+
+    def add_exec_id(self, exec_id):
+        with self.lock:
+            self.exec_ids[exec_id] = True
+            if len(self.exec_ids) > self.max_exec_ids:
+                self.exec_ids.popitem(last=False)
+                self.exec_ids_complete = False
+
+    def discard_exec_id(self, exec_id):
+        with self.lock:
+            self.exec_ids.pop(exec_id, None)
+
+    def has_exec_id(self, exec_id, account_id=None):
+        if exec_id in self.exec_ids:
+            return True
+        if self.exec_ids_complete and self.is_loaded(account_id):
+            return False
+        return bool(Trade.objects.filter(exec_id=exec_id))
+
+
+order_index = OrderIndex()
@@ -0,0 +1,237 @@
+# coding:utf8
+""" Redis调用分析和N+1查询检测。
+包装Redis客户端的execute_command和pipeline，每条命令记录耗时和调用位置（本库中最近的调用函数，
+例如models/order.py:trades），并归到当前入口（一次回调或一笔tick）。
+同一次入口调用内完全相同的查询重复出现时记为重复查询，通常就是属性访问引起的N+1查询。
+
+    from sectradelib.profiler import profiler
+    profiler.start()        # 默认入口：process_tick、on_trade、on_new_order、止损检查等
+    ...回放...
+    profiler.stop()
+    print profiler.report()
+
+默认包装各角色的客户端（见storage.all_clients），内存存储同样经过execute_command，可以在测试中发现N+1查询。
+"""
+import os
+import sys
+import threading
+from time import time
+from functools import wraps
+from collections import defaultdict
+
+from . import storage
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+THIS_FILE = os.path.splitext(os.path.abspath(__file__))[0]
+NO_ENTRY = '<none>'
+
+# (模块, 类名, 方法名)
+DEFAULT_ENTRY_POINTS = (
+    ('marketdata', 'MarketDataApi', 'process_tick'),
+    ('trader', 'BaseTrader', 'on_new_order'),
+    ('trader', 'BaseTrader', 'on_trade'),
+    ('trader', 'BaseTrader', 'on_cancel'),
+    ('trader', 'BaseTrader', 'on_reject'),
+    ('trader', 'BaseTrader', 'open_order'),
+    ('trader', 'BaseTrader', 'close_order'),
+    ('strategy', 'CheckStopThread', 'set_stopprice'),
+    ('strategy', 'CheckStopThread', 'check'),
+    ('quoteservice', 'QuoteService', 'save_inst_mindata'),
+)
+
+
+class EntryStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.commands = 0
+        self.seconds = 0.0
+        self.sites = defaultdict(lambda: [0, 0.0])   # (命令, 调用位置) -> [次数, 耗时]
+        self.duplicates = defaultdict(int)          # (命令, 调用位置) -> 重复次数
+        self.examples = {}                          # (命令, 调用位置) -> (查询, 调用栈)
+
+
+class Scope(object):
+    """ 一次入口调用 """
+    def __init__(self, name):
+        self.name = name
+        self.queries = defaultdict(int)     # 查询 -> 次数
+        self.sites = {}                     # 查询 -> (调用位置, 调用栈)
+
+
+class RedisProfiler(object):
+    def __init__(self, stack_depth=4):
+        self.stack_depth = stack_depth
+        self.enabled = False
+        self.entries = defaultdict(EntryStats)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.patched = []       # [(对象, 属性名, 原值)]
+        self.filenames = {}     # co_filename -> 相对路径，不是本库文件时为None
+
+    # ---- 入口 ----
+    def scopes(self):
+        if not hasattr(self.local, 'scopes'):
+            self.local.scopes = []
+        return self.local.scopes
+
+    def enter(self, name):
+        scope = Scope(name)
+        self.scopes().append(scope)
+        return scope
+
+    def exit(self, scope):
+        scopes = self.scopes()
+        scopes.remove(scope)
+        with self.lock:
+            stats = self.entries[scope.name]
+            stats.calls += 1
+            for query, count in scope.queries.iteritems():
+                if count > 1:
+                    site, stack = scope.sites[query]
+                    key = (query[0], site)
+                    stats.duplicates[key] += count - 1
+                    stats.examples.setdefault(key, (query, stack))
+
+    def entry(self, name):
+        """ 把函数标记为入口的装饰器 """
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                scope = self.enter(name)
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.exit(scope)
+            return wrapper
+        return decorator
+
+    # ---- 命令记录 ----
+    def caller(self):
+        """ 返回(调用位置, 调用栈)：本库内最近的一帧，以及最多stack_depth帧的本库调用栈 """
+        frame = sys._getframe(2)
+        stack = []
+        while frame is not None and len(stack) < self.stack_depth:
+            filename = self.package_filename(frame.f_code.co_filename)
+            if filename:
+                stack.append('{0}:{1}'.format(filename, frame.f_code.co_name))
+            frame = frame.f_back
+        return (stack[0] if stack else '<external>'), tuple(stack)
+
+    def package_filename(self, filename):
+        try:
+            return self.filenames[filename]
+        except KeyError:
+            path = os.path.abspath(filename)
+            if path.startswith(PACKAGE_DIR + os.sep) and os.path.splitext(path)[0] != THIS_FILE:
+                self.filenames[filename] = os.path.relpath(path, PACKAGE_DIR)
+            else:
+                self.filenames[filename] = None
+            return self.filenames[filename]
+
+    def record(self, query, seconds):
+        site, stack = self.caller()
+        scopes = self.scopes()
+        scope = scopes[-1] if scopes else None
+        with self.lock:
+            stats = self.entries[scope.name if scope else NO_ENTRY]
+            stats.commands += 1
+            stats.seconds += seconds
+            s = stats.sites[(query[0], site)]
+            s[0] += 1
+            s[1] += seconds
+        if scope is not None:
+            scope.queries[query] += 1
+            scope.sites.setdefault(query, (site, stack))
+
+    def wrap_client(self, client):
+        if not hasattr(client, 'execute_command'):
+            raise ValueError(u'只能分析redis-py客户端')
+        execute_command = client.execute_command
+        pipeline = client.pipeline
+        profiler = self
+
+        @wraps(execute_command)
+        def profiled_execute_command(*args, **options):
+            start = time()
+            try:
+                return execute_command(*args, **options)
+            finally:
+                if profiler.enabled:
+                    query = (str(args[0]).upper(),) + tuple(str(a) for a in args[1:])
+                    profiler.record(query, time() - start)
+
+        @wraps(pipeline)
+        def profiled_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+
+            def profiled_execute(*a, **kw):
+                commands = tuple(str(c[0][0]).upper() for c in pipe.command_stack)
+                start = time()
+                try:
+                    return execute(*a, **kw)
+                finally:
+                    if profiler.enabled:
+                        # 管道内的命令每次都不同（id不同），只按命令组成记录
+                        profiler.record(('PIPELINE',) + commands + (str(id(pipe)),), time() - start)
+            pipe.execute = profiled_execute
+            return pipe
+
+        self.patch(client, 'execute_command', profiled_execute_command)
+        self.patch(client, 'pipeline', profiled_pipeline)
+
+    # ---- 安装/卸载 ----
+    def patch(self, obj, name, value):
+        self.patched.append((obj, name, obj.__dict__.get(name)))
+        setattr(obj, name, value)
+
+    def install_entry_points(self, entry_points=DEFAULT_ENTRY_POINTS):
+        package = __name__.rsplit('.', 1)[0]
+        for module_name, class_name, method_name in entry_points:
+            __import__('{0}.{1}'.format(package, module_name))
+            cls = getattr(sys.modules['{0}.{1}'.format(package, module_name)], class_name)
+            method = cls.__dict__[method_name]
+            self.patch(cls, method_name, self.entry('{0}.{1}'.format(class_name, method_name))(method))
+
+    def start(self, client=None, entry_points=DEFAULT_ENTRY_POINTS):
+        for c in [client] if client else storage.all_clients():
+            self.wrap_client(c)
+        self.install_entry_points(entry_points)
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+        while self.patched:
+            obj, name, value = self.patched.pop()
+            if value is None:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, value)
+
+    def reset(self):
+        with self.lock:
+            self.entries = defaultdict(EntryStats)
+
+    # ---- 报告 ----
+    def report(self, top=5):
+        lines = []
+        with self.lock:
+            entries = sorted(self.entries.items(), key=lambda item: -item[1].seconds)
+            for name, stats in entries:
+                per_call = stats.commands / float(stats.calls) if stats.calls else float(stats.commands)
+                lines.append(u'{0}: 调用{1}次 Redis命令{2}条（每次{3:.1f}条） 耗时{4:.3f}秒'.format(
+                    name, stats.calls, stats.commands, per_call, stats.seconds))
+                sites = sorted(stats.sites.items(), key=lambda item: -item[1][1])[:top]
+                for (command, site), (count, seconds) in sites:
+                    lines.append(u'    {0:<10} {1:<40} {2:>8}条 {3:.3f}秒'.format(command, site, count, seconds))
+                duplicates = sorted(stats.duplicates.items(), key=lambda item: -item[1])[:top]
+                for (command, site), count in duplicates:
+                    query, stack = stats.examples[(command, site)]
+                    lines.append(u'    重复查询{0}次: {1} 调用栈: {2}'.format(
+                        count, ' '.join(query)[:80], u' <- '.join(stack)))
+        return u'\n'.join(lines)
+
+
+profiler = RedisProfiler()
@@ -3,19 +3,17 @@ import logging
 import os.path
 import threading
 import Queue
-from time import sleep
+from time import sleep, time
 from collections import defaultdict
 from operator import attrgetter
 from datetime import datetime
 from decimal import Decimal
 
-import pandas as pd
-import redisco
-
 from utils import current_price # for backward compatible
+from . import storage
 
 logger = logging.getLogger(__name__)
-rdb = redisco.get_client()
+rdb = storage.lazy_client('tick')
 
 
 class TickObject(dict):
@@ -32,7 +30,13 @@ class QuoteService(threading.Thread):
         self.market_closed = defaultdict(bool)
         self.last_save_time = {}
         self.interval = 10
+        self.subscribe_window = 0.2     # 秒，合并这段时间内的mdmonitor订阅请求
         self.mdapis = []
+        self.tick_archive = None    # TickArchive, 保存原始tick
+        self.bar_store = None       # BarStore, 保存K线
+        self.shard_router = None    # ShardRouter, 分片部署时tick交给各分片进程
+        self.tick_stream = None     # TickStream, 止损检查改用Redis Streams读取完整的tick
+        self.tick_bus = None        # TickBus, 同机进程通过共享内存读取tick
 
         self.is_running = True
         self.tick_lock = threading.RLock()
@@ -43,28 +47,85 @@ class QuoteService(threading.Thread):
         return self.tickdata.keys()
 
     def subscribe(self, seclist):
+        secids = [inst.secid for inst in seclist]
         for api in self.mdapis:
-            api.subscribe([inst.secid for inst in seclist])
+            api.subscribe(secids)
+            api.instruments.update(secids)
 
     def unsubscribe(self, seclist):
+        secids = [inst.secid for inst in seclist]
         for api in self.mdapis:
-            api.unsubscribe([inst.secid for inst in seclist])
+            api.unsubscribe(secids)
+            api.instruments.difference_update(secids)
 
-    def wait_for_subscribe(self):
+    @property
+    def subscribed(self):
+        return set().union(*[api.instruments for api in self.mdapis])
+
+    def collect_requests(self, ps, window):
+        """ 收到第一条mdmonitor消息后再收集window秒，返回这段时间请求的合约代码；1秒内没有消息时返回空列表 """
+        secids = []
+        deadline = None
+        timeout = 1.0
+        while True:
+            item = ps.get_message(timeout=timeout)
+            if item and item['type'] == 'message':
+                if item['data'] not in secids:
+                    secids.append(item['data'])
+                if deadline is None:
+                    deadline = time() + window
+            if deadline is None:
+                if not item:
+                    return secids
+                continue
+            timeout = deadline - time()
+            if timeout <= 0:
+                return secids
+
+    def subscription_diff(self, secids):
+        """ 返回(要订阅的合约, 要退订的合约)。与原来一样，订阅一个合约时退订同一品种的其他合约（换月） """
         from .models import Instrument
-        ps = rdb.pubsub()
+        subscribed = self.subscribed
+        add, remove = {}, {}
+        siblings = {}   # 品种id -> 该品种的合约
+        for secid in secids:
+            inst = Instrument.objects.filter(secid=secid).first()
+            logger.debug(u'Subscribe market data for:{0}'.format(inst))
+            if not inst:
+                continue
+            product = inst.product
+            if product:
+                if product.id not in siblings:
+                    siblings[product.id] = list(product.instruments)
+                for other in siblings[product.id]:
+                    if other.secid != secid:
+                        add.pop(other.secid, None)
+                        if other.secid in subscribed:
+                            remove[other.secid] = other
+            remove.pop(secid, None)
+            if secid not in subscribed:
+                add[secid] = inst
+        return add.values(), remove.values()
+
+    def wait_for_subscribe(self):
+        ps = storage.pubsub()
         ps.subscribe('mdmonitor')
         while self.is_running:
-            for item in ps.listen():
-                if item['type'] == 'message':
-                    inst = Instrument.objects.filter(secid=item['data']).first()
-                    logger.debug(u'Subscribe market data for:{0}'.format(inst))
-                    if inst:
-                        product = inst.product
-                        if product:
-                            self.unsubscribe(product.instruments)
-                        self.subscribe([inst])
-            sleep(1)
+            secids = self.collect_requests(ps, self.subscribe_window)
+            if not secids:
+                continue
+            add, remove = self.subscription_diff(secids)
+            logger.info(u'收到{0}个订阅请求，订阅{1}个合约，退订{2}个合约'.format(len(secids), len(add), len(remove)))
+            if remove:
+                self.unsubscribe(remove)
+            if add:
+                self.subscribe(add)
+
+    def add_ticks(self, ticks):
+        """ 作为StreamConsumer的handler，从流读取的tick加入缓存 """
+        with self.tick_lock:
+            for tick in ticks:
+                self.tickdata[tick.securityID].append(tick)
 
     def stop(self):
         self.is_running = False
@@ -74,19 +135,27 @@ class QuoteService(threading.Thread):
         threading.Thread(target=self.wait_for_subscribe).start()
         while self.is_running:
             sleep(0.2)
-            saved = False
-            for instid in self.instruments:
-                try:
-                    saved = self.save_inst_mindata(instid) or saved
-                except Exception, e:
-                    logger.exception(unicode(e))
-                    pass
-            if saved:
+            if self.save_all():
                 self.evt_newmindata.set()
                 sleep(0.1)
                 self.evt_newmindata.clear()
+        if self.tick_archive:
+            self.tick_archive.close()
         logger.info('Quote Service exited...')
 
+    def save_all(self):
+        """ 保存所有合约的分钟数据，返回是否有新数据 """
+        if self.tick_archive:
+            self.tick_archive.flush()
+        saved = False
+        for instid in self.instruments:
+            try:
+                saved = self.save_inst_mindata(instid) or saved
+            except Exception, e:
+                logger.exception(unicode(e))
+                pass
+        return saved
+
     def do_save(self, df):
         pass
 
@@ -99,10 +168,13 @@ class QuoteService(threading.Thread):
             # logger.debug('No enough data')
             return False
         logger.info(u'保存合约{0}的分钟数据...'.format(inst))
+        import pandas as pd     # 导入pandas很慢，只有行情服务需要
         df = pd.DataFrame.from_records(ticks, index='entry_time')
         rule = '{0}s'.format(self.interval)
-        df2 = df.resample(rule, label='right', how={'price': 'ohlc'}).price
-        df2['volume'] = df.resample(rule, label='right', how={'volume': 'sum'})
+        # groupby+Grouper在新旧版本pandas里用法相同（resample的how参数已被移除）
+        bars = df.groupby(pd.Grouper(freq=rule, label='right'))
+        df2 = bars.price.ohlc()
+        df2['volume'] = bars.volume.sum()
         df3 = df2.dropna(axis=0)
         logger.debug(df3)
         if not self.market_closed[inst]:
@@ -117,8 +189,10 @@ class QuoteService(threading.Thread):
             'high': 'high_price',
             'low': 'low_price'})
         self.do_save(df3)
-        rdb.hset('last_close_price', inst, df3.irow(len(df3) - 1).close_price)
-        self.last_save_time[inst] = df3.ix[-1].name
+        if self.bar_store:
+            self.bar_store.append_frame(df3)
+        rdb.hset('last_close_price', inst, df3.iloc[-1].close_price)
+        self.last_save_time[inst] = df3.index[-1]
         with self.tick_lock:
             self.tickdata[inst] = [tick for tick in self.tickdata[inst] if tick.entry_time >= self.last_save_time[inst]]
             self.tickdata[inst].sort(key=attrgetter('entry_time'))
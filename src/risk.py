@@ -0,0 +1,179 @@
+# coding:utf8
+import logging
+from collections import defaultdict, deque
+
+from .utils import monotonic, last_close_price
+
+logger = logging.getLogger(__name__)
+
+
+class RiskLimit(object):
+    """ 一组限额，None表示不限制。
+    max_position: 持仓手数（合约为净持仓，策略和账户为各合约净持仓绝对值之和）
+    max_notional: 持仓名义金额
+    max_order_rate: rate_window秒内最多下单次数"""
+    def __init__(self, max_position=None, max_notional=None, max_order_rate=None):
+        self.max_position = max_position
+        self.max_notional = max_notional
+        self.max_order_rate = max_order_rate
+
+    def __repr__(self):
+        return 'RiskLimit(max_position={0.max_position}, max_notional={0.max_notional}, ' \
+               'max_order_rate={0.max_order_rate})'.format(self)
+
+
+class PreTradeRisk(object):
+    """ 开仓前风控检查。
+    持仓和名义金额按预计持仓增量维护：开仓单通过检查时即计入，撤单或被拒绝时扣除未成交部分，
+    平仓单在成交时扣除；检查只做字典查找和算术运算，只有合约还没有价格时才读取昨收价。
+    被拒绝的原因计入rejects。"""
+
+    def __init__(self, trader, account_limit=None, instrument_limits=None, strategy_limits=None, rate_window=1.0):
+        self.trader = trader
+        self.account_limit = account_limit
+        self.instrument_limits = instrument_limits or {}   # secid或symbol -> RiskLimit
+        self.strategy_limits = strategy_limits or {}       # strategy_code -> RiskLimit
+        self.rate_window = rate_window
+        self.positions = defaultdict(float)     # (strategy_code, secid) -> 净持仓
+        self.inst_positions = defaultdict(float)    # secid -> 净持仓
+        self.notionals = defaultdict(float)     # (strategy_code, secid)或secid -> 名义金额
+        self.gross = defaultdict(float)         # ('strategy', code)或('account',) -> 持仓手数合计
+        self.gross_notionals = defaultdict(float)
+        self.prices = {}                        # secid -> 最新成交价
+        self.working = {}                       # 开仓单local_id -> [instrument, strategy_code, 未成交数量（带方向）]
+        self.order_times = defaultdict(deque)
+        self.rejects = defaultdict(int)
+        trader.risk = self
+        trader.trade_listeners.append(self)
+
+    def load(self):
+        """ 从现有持仓和未成交的开仓单重建计数器 """
+        with self.trader.lock:
+            for key in (self.positions, self.inst_positions, self.notionals, self.gross, self.gross_notionals):
+                key.clear()
+            self.working.clear()
+            for order in self.trader.opened_orders():
+                inst = order.instrument
+                self.update(inst, order.strategy_code, order.opened_volume, order.avg_fill_price)
+            for order in self.trader.untraded_orders():
+                if order.is_open:
+                    remaining = order.volume - order.filled_volume
+                    self.working[order.local_id] = [order.instrument, order.strategy_code, remaining]
+                    self.update(order.instrument, order.strategy_code, remaining, order.price)
+
+    def update(self, inst, strategy_code, volume, price):
+        secid = inst.secid
+        if price:
+            self.prices[secid] = price
+        price = self.prices.get(secid)
+        key = (strategy_code, secid)
+        old_pos, old_inst_pos = self.positions[key], self.inst_positions[secid]
+        self.positions[key] += volume
+        self.inst_positions[secid] += volume
+        notional = inst.amount(price, abs(self.positions[key]))
+        inst_notional = inst.amount(price, abs(self.inst_positions[secid]))
+        self.gross[('strategy', strategy_code)] += abs(self.positions[key]) - abs(old_pos)
+        self.gross[('account',)] += abs(self.inst_positions[secid]) - abs(old_inst_pos)
+        self.gross_notionals[('strategy', strategy_code)] += notional - self.notionals[key]
+        self.gross_notionals[('account',)] += inst_notional - self.notionals[secid]
+        self.notionals[key] = notional
+        self.notionals[secid] = inst_notional
+
+    def on_order(self, order, inst, volume, direction, strategy_code=''):
+        """ 由trader.open_order在check通过后调用，order为None表示下单失败，释放check计入的数量 """
+        delta = abs(volume or 0.0) if direction else -abs(volume or 0.0)
+        with self.trader.lock:
+            if order is None:
+                self.update(inst, strategy_code, -delta, None)
+            else:
+                self.working[order.local_id] = [inst, strategy_code, delta]
+
+    def on_order_done(self, order):
+        """ 开仓单撤销或被拒绝：扣除未成交部分 """
+        working = self.working.pop(order.local_id, None)
+        if working and working[2]:
+            self.update(working[0], working[1], -working[2], None)
+
+    def on_trade(self, order, trade):
+        """ 由trader.on_trade调用，trade.volume带方向 """
+        working = self.working.get(order.local_id) if order.is_open else None
+        if working is None:
+            self.update(order.instrument, order.strategy_code, trade.volume, trade.price)
+            return
+        # 开仓单的数量在下单时已经计入，只计入超出未成交数量的部分
+        remaining = working[2] - trade.volume
+        if remaining * working[2] > 0:
+            working[2] = remaining
+            remaining = 0.0
+        else:
+            del self.working[order.local_id]
+        self.update(order.instrument, order.strategy_code, -remaining, trade.price)
+
+    def reject(self, reason, inst, strategy_code, limit):
+        self.rejects[reason] += 1
+        logger.warning(u'<策略{0}>{1}开仓被风控拒绝：{2} {3}'.format(strategy_code, inst.secid, reason, limit))
+        return False
+
+    def check_rate(self, key, limit, now):
+        if limit.max_order_rate is None:
+            return True
+        times = self.order_times[key]
+        while times and now - times[0] > self.rate_window:
+            times.popleft()
+        return len(times) < limit.max_order_rate
+
+    def price(self, inst, price):
+        price = price or self.prices.get(inst.secid)
+        if not price:
+            price = last_close_price(inst.secid)
+            price = price and float(price)
+        return price
+
+    def check(self, inst, price, volume, direction, strategy_code=''):
+        """ 返回是否允许开仓。允许时数量立即计入，调用方下单后必须调用on_order """
+        with self.trader.lock:
+            return self._check(inst, price, volume, direction, strategy_code)
+
+    def _check(self, inst, price, volume, direction, strategy_code):
+        secid = inst.secid
+        delta = abs(volume or 0.0) if direction else -abs(volume or 0.0)
+        key = (strategy_code, secid)
+        new_pos = self.positions[key] + delta
+        new_inst_pos = self.inst_positions[secid] + delta
+        now = monotonic()
+        inst_limit = self.instrument_limits.get(secid) or self.instrument_limits.get(inst.symbol)
+        strategy_limit = self.strategy_limits.get(strategy_code)
+        limits = [limit for limit in (inst_limit, strategy_limit, self.account_limit) if limit]
+        if any(limit.max_notional is not None for limit in limits):
+            # 市价单按最新成交价或昨收价计算，都没有时无法检查名义金额
+            price = self.price(inst, price)
+            if not price:
+                return self.reject('no_price', inst, strategy_code, '')
+        scopes = []
+
+        if inst_limit:
+            scopes.append(('instrument', inst_limit, ('instrument', secid),
+                           abs(new_inst_pos), inst.amount(price, abs(new_inst_pos))))
+        if strategy_limit:
+            gkey = ('strategy', strategy_code)
+            scopes.append(('strategy', strategy_limit, gkey,
+                           self.gross[gkey] + abs(new_pos) - abs(self.positions[key]),
+                           self.gross_notionals[gkey] + inst.amount(price, abs(new_pos)) - self.notionals[key]))
+        if self.account_limit:
+            gkey = ('account',)
+            scopes.append(('account', self.account_limit, gkey,
+                           self.gross[gkey] + abs(new_inst_pos) - abs(self.inst_positions[secid]),
+                           self.gross_notionals[gkey] + inst.amount(price, abs(new_inst_pos)) - self.notionals[secid]))
+
+        for scope, limit, rkey, position, notional in scopes:
+            if limit.max_position is not None and position > limit.max_position:
+                return self.reject(scope + '_position', inst, strategy_code, limit)
+            if limit.max_notional is not None and notional > limit.max_notional:
+                return self.reject(scope + '_notional', inst, strategy_code, limit)
+            if not self.check_rate(rkey, limit, now):
+                return self.reject(scope + '_order_rate', inst, strategy_code, limit)
+        for scope, limit, rkey, position, notional in scopes:
+            if limit.max_order_rate is not None:
+                self.order_times[rkey].append(now)
+        self.update(inst, strategy_code, delta, price)
+        return True
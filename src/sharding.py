@@ -0,0 +1,180 @@
+# coding:utf8
+""" 按合约分片的多进程部署。
+行情进程只更新当前价格，并按一致性哈希把合约分到N个分片：checkstop消息除全局频道外还发到分片自己的频道
+（checkstop:<分片号>），tick经multiprocessing队列交给分片进程。每个分片进程拥有自己合约的
+tick缓存和K线（QuoteService），并可以运行只订阅本分片频道的止损检查（CheckStopThread），
+不同分片的止损检查不再争用同一个GIL。增加分片时只有约1/N的合约换分片。
+
+支持的部署方式：trader_factory在每个分片进程里各建一个trader，订单索引、持仓和资金缓存都是进程内的，
+所以各分片的trader必须使用不同的账户（每个分片一个账户，合约按分片划分）。同一个账户只能有一个完整的
+trader：资金检查（AvailableGuardThread）、未成交订单查询和限价单超时只在主进程运行，分片进程不要启动这些线程，
+也不要对同一账户再建trader；单账户部署时不传trader_factory，止损检查留在主进程（或用streams.py按消费组分摊）。
+
+    def make_trader(shard):     # 必须是模块级函数，在分片进程里调用
+        trader = MyTrader(...)
+        trader.start()
+        return trader
+
+    deployment = ShardedDeployment(4, trader_factory=make_trader, bar_root='/data/bars')
+    deployment.attach(quote_service)    # quote_service.shard_router = deployment.router
+    deployment.start()
+"""
+import bisect
+import hashlib
+import logging
+import multiprocessing
+from Queue import Empty
+
+from . import storage
+
+logger = logging.getLogger(__name__)
+
+
+def checkstop_channel(shard):
+    return 'checkstop:{0}'.format(shard)
+
+
+class HashRing(object):
+    """ 一致性哈希环，每个分片replicas个虚拟节点 """
+
+    def __init__(self, shards, replicas=64):
+        self.shards = range(shards) if isinstance(shards, (int, long)) else list(shards)
+        self.replicas = replicas
+        self.ring = sorted((self.hash('{0}#{1}'.format(shard, i)), shard)
+                           for shard in self.shards for i in xrange(replicas))
+        self.keys = [key for key, shard in self.ring]
+        self.cache = {}
+
+    @staticmethod
+    def hash(key):
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def shard_for(self, secid):
+        try:
+            return self.cache[secid]
+        except KeyError:
+            index = bisect.bisect(self.keys, self.hash(secid)) % len(self.keys)
+            shard = self.cache[secid] = self.ring[index][1]
+            return shard
+
+    def partition(self, secids):
+        """ 返回{分片: [合约, ...]} """
+        result = dict((shard, []) for shard in self.shards)
+        for secid in secids:
+            result[self.shard_for(secid)].append(secid)
+        return result
+
+
+class ShardRouter(object):
+    """ 在行情进程里使用：查合约的分片频道，把tick放入分片的队列 """
+
+    def __init__(self, ring, queues=None):
+        self.ring = ring
+        self.queues = queues or {}      # 分片 -> multiprocessing.Queue
+        self.channels = {}
+
+    def channel(self, secid):
+        try:
+            return self.channels[secid]
+        except KeyError:
+            channel = self.channels[secid] = checkstop_channel(self.ring.shard_for(secid))
+            return channel
+
+    def route(self, tick):
+        queue = self.queues.get(self.ring.shard_for(tick.securityID))
+        if queue is not None:
+            queue.put(dict(tick) if isinstance(tick, dict) else vars(tick))
+
+
+class ShardWorker(multiprocessing.Process):
+    """ 一个分片进程：缓存本分片合约的tick并定时保存K线，可选运行本分片的止损检查。
+    trader_factory(shard)返回的trader只运行止损检查，必须是本分片专用的账户，见模块说明 """
+
+    def __init__(self, shard, queue, trader_factory=None, bar_root=None, save_interval=0.2, redis_kwargs=None):
+        super(ShardWorker, self).__init__(name='SHARD-{0}'.format(shard))
+        self.daemon = True
+        self.shard = shard
+        self.queue = queue
+        self.trader_factory = trader_factory
+        self.bar_root = bar_root
+        self.save_interval = save_interval
+        self.redis_kwargs = redis_kwargs
+        self.quote_service = None
+
+    def setup(self, interval):
+        from .quoteservice import QuoteService
+        self.quote_service = QuoteService()
+        self.quote_service.interval = interval
+        if self.bar_root:
+            from .barstore import BarStore
+            self.quote_service.bar_store = BarStore(self.bar_root)
+        return self.quote_service
+
+    def handle(self, tick):
+        from .quoteservice import TickObject
+        with self.quote_service.tick_lock:
+            self.quote_service.tickdata[tick['securityID']].append(TickObject(tick))
+
+    def poll(self, timeout):
+        """ 取出队列里的tick，返回False表示收到了结束标记 """
+        try:
+            item = self.queue.get(timeout=timeout)
+        except Empty:
+            return True
+        while item is not None:
+            self.handle(item)
+            try:
+                item = self.queue.get_nowait()
+            except Empty:
+                return True
+        return False
+
+    def run(self):
+        from .utils import monotonic
+        if self.redis_kwargs is not None:
+            storage.use_backend('redis', **self.redis_kwargs)
+        interval = self.queue.get()     # 第一条消息是K线周期
+        self.setup(interval)
+        logger.info(u'分片{0}启动'.format(self.shard))
+        if self.trader_factory:
+            from .strategy import CheckStopThread
+            trader = self.trader_factory(self.shard)
+            checker = CheckStopThread(trader, channel=checkstop_channel(self.shard))
+            checker.daemon = True
+            checker.start()
+        next_save = monotonic() + self.save_interval
+        running = True
+        while running:
+            running = self.poll(max(next_save - monotonic(), 0))
+            if monotonic() >= next_save or not running:
+                self.quote_service.save_all()
+                next_save = monotonic() + self.save_interval
+        logger.info(u'分片{0}退出'.format(self.shard))
+
+
+class ShardedDeployment(object):
+    def __init__(self, shards, trader_factory=None, bar_root=None, save_interval=0.2, redis_kwargs=None,
+                 replicas=64):
+        self.ring = HashRing(shards, replicas)
+        self.workers = {}
+        for shard in self.ring.shards:
+            self.workers[shard] = ShardWorker(shard, multiprocessing.Queue(), trader_factory, bar_root,
+                                              save_interval, redis_kwargs)
+        self.router = ShardRouter(self.ring, dict((shard, w.queue) for shard, w in self.workers.items()))
+        self.quote_service = None
+
+    def attach(self, quote_service):
+        self.quote_service = quote_service
+        quote_service.shard_router = self.router
+
+    def start(self):
+        interval = self.quote_service.interval if self.quote_service else 10
+        for worker in self.workers.values():
+            worker.queue.put(interval)
+            worker.start()
+
+    def stop(self, timeout=10):
+        for worker in self.workers.values():
+            worker.queue.put(None)
+        for worker in self.workers.values():
+            worker.join(timeout)
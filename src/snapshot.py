@@ -0,0 +1,149 @@
+# coding:utf8
+""" 快速热启动的状态快照。
+启动时order_index.load()读取账户的全部订单和成交，set_monitors逐个按代码查询合约。
+快照定期保存到一个文件（订单号索引、成交编号、监控合约），启动时一次读入，之后只从Redis读取增量：
+    快照时未完结的订单（完结的订单号不会再变化）；
+    编号大于快照时计数器的订单和成交。
+Redis仍是唯一的权威数据，快照不存在、属于其他账户或与Redis不一致（例如数据库被清空）时按原方式全量加载。
+
+    trader = MyTrader('ctp', '1001', 'CNY', 'IF:10', snapshot_path='/data/ctp.snapshot')
+    SnapshotThread(trader, '/data/ctp.snapshot', interval=60).start()
+"""
+import os
+import json
+import logging
+import threading
+from time import time
+
+from . import storage
+from .models.instrument import Instrument
+from .models.order import Order, Trade, order_index
+from .utils import logerror
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+FINAL_STATUS = (Order.OS_CANCELED, Order.OS_CLOSED, Order.OS_REJECTED)
+
+
+def counter(model):
+    """ 模型的id计数器，新对象的id都大于该值 """
+    return int(storage.get_client().get(model._key['id']) or 0)
+
+
+def take_snapshot(trader):
+    account = trader.account
+    # 先读计数器，之后新建的订单和成交都属于增量
+    max_order_id = counter(Order)
+    max_trade_id = counter(Trade)
+    with order_index.lock:
+        by_local_id = dict(order_index.by_local_id)
+        by_sys_id = dict(order_index.by_sys_id)
+        exec_ids = list(order_index.exec_ids) if order_index.exec_ids_complete else None
+    oids = sorted(set(by_local_id.values()) | set(by_sys_id.values()))
+    pipe = storage.get_client().pipeline()
+    for oid in oids:
+        pipe.hmget(Order._key[oid], ['status', 'account_id'])
+    active = []
+    foreign = set()     # order_index是进程内所有账户共用的
+    for oid, (status, account_id) in zip(oids, pipe.execute()):
+        if account_id != account.id:
+            foreign.add(oid)
+        elif status is None or int(status) not in FINAL_STATUS:
+            active.append(oid)
+    by_local_id = dict((k, v) for k, v in by_local_id.iteritems() if v not in foreign)
+    by_sys_id = dict((k, v) for k, v in by_sys_id.iteritems() if v not in foreign)
+    return {
+        'version': VERSION,
+        'time': time(),
+        'account_id': account.id,
+        'max_order_id': max_order_id,
+        'max_trade_id': max_trade_id,
+        'by_local_id': by_local_id,
+        'by_sys_id': by_sys_id,
+        'active_orders': active,
+        'exec_ids': exec_ids,
+        'instruments': dict((symbol, inst.id) for symbol, inst in trader.monitors.items() if inst),
+    }
+
+
+def save_snapshot(trader, path):
+    snapshot = take_snapshot(trader)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        json.dump(snapshot, f, separators=(',', ':'))
+    os.rename(tmp, path)
+    return snapshot
+
+
+def read_snapshot(path, account):
+    """ 返回可用的快照，不能使用时返回None """
+    try:
+        with open(path, 'rb') as f:
+            snapshot = json.load(f)
+    except (IOError, ValueError), e:
+        logger.info(u'无法读取快照{0}: {1}'.format(path, e))
+        return None
+    if snapshot.get('version') != VERSION or snapshot.get('account_id') != account.id:
+        logger.info(u'快照{0}不属于账户{1}'.format(path, account.code))
+        return None
+    if counter(Order) < snapshot['max_order_id'] or counter(Trade) < snapshot['max_trade_id']:
+        logger.warning(u'快照{0}比数据库新，忽略'.format(path))
+        return None
+    return snapshot
+
+
+def load_snapshot(snapshot, account):
+    """ 用快照和增量重建order_index """
+    with order_index.lock:
+        for local_id, oid in snapshot['by_local_id'].iteritems():
+            order_index.by_local_id[local_id] = oid
+        for sys_id, oid in snapshot['by_sys_id'].iteritems():
+            order_index.by_sys_id[sys_id] = oid
+        if snapshot['exec_ids'] is None:
+            order_index.exec_ids_complete = False
+        else:
+            for exec_id in snapshot['exec_ids']:
+                order_index.add_exec_id(exec_id)
+        # 快照时未完结的订单和之后新建的订单
+        oids = list(snapshot['active_orders'])
+        oids.extend(str(i) for i in xrange(snapshot['max_order_id'] + 1, counter(Order) + 1))
+        for oid in oids:
+            order = Order.objects.get_by_id(oid)
+            if order is not None and order.account_id == account.id:
+                order_index.add(order)
+        for tid in xrange(snapshot['max_trade_id'] + 1, counter(Trade) + 1):
+            trade = Trade.objects.get_by_id(str(tid))
+            if trade is not None:
+                order_index.add_exec_id(trade.exec_id)
+        order_index.mark_loaded(account)
+    logger.info(u'从快照恢复: {0}个未完结订单, {1}个新订单, {2}笔新成交'.format(
+        len(snapshot['active_orders']), len(oids) - len(snapshot['active_orders']),
+        counter(Trade) - snapshot['max_trade_id']))
+
+
+def snapshot_instrument(snapshot, symbol):
+    """ 按快照里的id读取合约，代码不一致时返回None """
+    iid = snapshot['instruments'].get(symbol)
+    if iid:
+        instrument = Instrument.objects.get_by_id(iid)
+        if instrument is not None and instrument.symbol == symbol:
+            return instrument
+
+
+class SnapshotThread(threading.Thread):
+    def __init__(self, trader, path, interval=60):
+        super(SnapshotThread, self).__init__(name='SNAPSHOT-' + trader.name)
+        self.daemon = True
+        self.trader = trader
+        self.path = path
+        self.interval = interval
+
+    @logerror
+    def save(self):
+        save_snapshot(self.trader, self.path)
+
+    def run(self):
+        while not self.trader.evt_stop.wait(self.interval):
+            self.save()
+        self.save()
@@ -0,0 +1,928 @@
+# coding:utf8
+""" 存储后端选择。
+redis：redisco默认的Redis连接；
+memory：纯Python内存实现，提供models和本库用到的Redis命令（字符串、哈希、集合、有序集合、列表、
+SORT、pipeline、发布订阅、流），redisco的filter/索引/order/引用字段以及Order.update_index_value都可直接使用。
+用于回测和单元测试，无需Redis服务器。
+
+    from sectradelib import storage
+    storage.use_backend('memory')   # 在创建任何模型对象之前调用
+
+使用Redis时，tick写入、模型读写和发布订阅各用一个连接池（见configure_pools），
+慢的账户估值不会占用tick写入的连接：
+
+    storage.use_backend('redis', host='localhost', pool_sizes={'model': 32},
+                        unix_socket_path='/tmp/redis.sock')
+    storage.pool_stats()
+"""
+import time
+import bisect
+import fnmatch
+import logging
+import threading
+import Queue
+from collections import defaultdict
+from functools import wraps
+
+import redis
+import redisco
+
+logger = logging.getLogger(__name__)
+
+
+def _encode(value):
+    # 与redis-py一致，所有值都以字符串保存
+    if isinstance(value, str):
+        return value
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _score_bound(value):
+    value = str(value)
+    if value in ('-inf', '+inf', 'inf'):
+        return float(value), False
+    if value.startswith('('):
+        return float(value[1:]), True
+    return float(value), False
+
+
+class MemoryPubSub(object):
+    def __init__(self, db):
+        self.db = db
+        self.channels = set()
+        self.queue = Queue.Queue()
+
+    def subscribe(self, *channels):
+        for channel in channels:
+            self.channels.add(channel)
+            self.queue.put({'type': 'subscribe', 'pattern': None, 'channel': channel,
+                            'data': len(self.channels)})
+        self.db.subscribers.add(self)
+
+    def unsubscribe(self, *channels):
+        for channel in channels or list(self.channels):
+            self.channels.discard(channel)
+        if not self.channels:
+            self.db.subscribers.discard(self)
+
+    def deliver(self, channel, message):
+        if channel in self.channels:
+            self.queue.put({'type': 'message', 'pattern': None, 'channel': channel, 'data': message})
+            return True
+        return False
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0):
+        try:
+            while True:
+                if timeout:
+                    item = self.queue.get(timeout=timeout)
+                else:
+                    item = self.queue.get_nowait()
+                if not ignore_subscribe_messages or item['type'] == 'message':
+                    return item
+        except Queue.Empty:
+            return None
+
+    def listen(self):
+        while self.channels:
+            yield self.queue.get()
+
+    def close(self):
+        self.unsubscribe()
+
+
+class MemoryPipeline(object):
+    """ 缓存命令，execute()时在数据库锁内依次执行 """
+    def __init__(self, db):
+        self.db = db
+        self.commands = []
+
+    def __getattr__(self, name):
+        # 直接排队命令的实现，不经过execute_command，整个pipeline只统计一次
+        impl = MemoryRedis.commands.get(name.upper())
+        if impl is None:
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((name.upper(), impl, args, kwargs))
+            return self
+        return queue
+
+    @property
+    def command_stack(self):
+        """ 与redis-py的pipeline相同：[((命令名,) + 参数, 选项), ...] """
+        return [((name,) + args, kwargs) for name, impl, args, kwargs in self.commands]
+
+    def __delitem__(self, name):
+        self.delete(name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.reset()
+
+    def reset(self):
+        self.commands = []
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        with self.db.lock:
+            return [impl(self.db, *args, **kwargs) for name, impl, args, kwargs in commands]
+
+
+class MemoryRedis(object):
+    """ 线程安全的内存数据库，接口与redis.Redis（redisco使用的旧版参数顺序）一致 """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.data = {}
+        self.expires = {}
+        self.subscribers = set()
+
+    # ---- 通用 ----
+    def _get(self, name, factory=None):
+        expire = self.expires.get(name)
+        if expire is not None and expire <= time.time():
+            del self.expires[name]
+            self.data.pop(name, None)
+        value = self.data.get(name)
+        if value is None and factory is not None:
+            value = self.data[name] = factory()
+        return value
+
+    def _cleanup(self, name):
+        if not self.data.get(name):
+            self.data.pop(name, None)
+            self.expires.pop(name, None)
+
+    def execute_command(self, *args, **options):
+        """ 与redis-py相同的统一入口，所有命令方法都经过这里，metrics和profiler包装该方法 """
+        return self.commands[args[0].upper()](self, *args[1:], **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return MemoryPipeline(self)
+
+    def pubsub(self, **kwargs):
+        return MemoryPubSub(self)
+
+    def publish(self, channel, message):
+        message = _encode(message)
+        return len([s for s in list(self.subscribers) if s.deliver(channel, message)])
+
+    def ping(self):
+        return True
+
+    def flushdb(self):
+        with self.lock:
+            self.data.clear()
+            self.expires.clear()
+        return True
+    flushall = flushdb
+
+    def delete(self, *names):
+        with self.lock:
+            count = 0
+            for name in names:
+                if self._get(name) is not None:
+                    count += 1
+                self.data.pop(name, None)
+                self.expires.pop(name, None)
+            return count
+
+    def __delitem__(self, name):
+        self.delete(name)
+
+    def exists(self, name):
+        with self.lock:
+            return self._get(name) is not None
+
+    def expire(self, name, seconds):
+        with self.lock:
+            if self._get(name) is None:
+                return False
+            self.expires[name] = time.time() + seconds
+            return True
+
+    def keys(self, pattern='*'):
+        with self.lock:
+            return [k for k in self.data.keys() if self._get(k) is not None and fnmatch.fnmatchcase(k, pattern)]
+
+    def type(self, name):
+        value = self._get(name)
+        return {str: 'string', dict: 'hash', set: 'set', list: 'list', SortedSet: 'zset',
+                MemoryStream: 'stream'}.get(type(value), 'none')
+
+    # ---- 字符串 ----
+    def get(self, name):
+        with self.lock:
+            return self._get(name)
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def set(self, name, value, ex=None):
+        with self.lock:
+            self.data[name] = _encode(value)
+            self.expires.pop(name, None)
+            if ex:
+                self.expires[name] = time.time() + ex
+            return True
+
+    def __setitem__(self, name, value):
+        self.set(name, value)
+
+    def setex(self, name, value, time):
+        return self.set(name, value, ex=time)
+
+    def setnx(self, name, value):
+        with self.lock:
+            if self._get(name) is not None:
+                return False
+            return self.set(name, value)
+
+    def getset(self, name, value):
+        with self.lock:
+            old = self._get(name)
+            self.set(name, value)
+            return old
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            value = int(self._get(name) or 0) + amount
+            self.data[name] = str(value)
+            return value
+    incrby = incr
+
+    # ---- 哈希 ----
+    def hget(self, name, key):
+        with self.lock:
+            return (self._get(name) or {}).get(_encode(key))
+
+    def hmget(self, name, keys, *args):
+        keys = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+        keys.extend(args)
+        with self.lock:
+            h = self._get(name) or {}
+            return [h.get(_encode(k)) for k in keys]
+
+    def hgetall(self, name):
+        with self.lock:
+            return dict(self._get(name) or {})
+
+    def hkeys(self, name):
+        return self.hgetall(name).keys()
+
+    def hlen(self, name):
+        return len(self.hgetall(name))
+
+    def hvals(self, name):
+        return self.hgetall(name).values()
+
+    def hexists(self, name, key):
+        return self.hget(name, key) is not None
+
+    def hset(self, name, key, value):
+        with self.lock:
+            h = self._get(name, dict)
+            key = _encode(key)
+            new = key not in h
+            h[key] = _encode(value)
+            return int(new)
+
+    def hsetnx(self, name, key, value):
+        with self.lock:
+            if self.hexists(name, key):
+                return 0
+            return self.hset(name, key, value)
+
+    def hmset(self, name, mapping):
+        with self.lock:
+            h = self._get(name, dict)
+            for k, v in mapping.iteritems():
+                h[_encode(k)] = _encode(v)
+            return True
+
+    def hdel(self, name, *keys):
+        with self.lock:
+            h = self._get(name) or {}
+            count = len([h.pop(_encode(k)) for k in keys if _encode(k) in h])
+            self._cleanup(name)
+            return count
+
+    def hincrby(self, name, key, amount=1):
+        with self.lock:
+            h = self._get(name, dict)
+            value = int(h.get(_encode(key), 0)) + amount
+            h[_encode(key)] = str(value)
+            return value
+
+    def hincrbyfloat(self, name, key, amount=1.0):
+        with self.lock:
+            h = self._get(name, dict)
+            value = float(h.get(_encode(key), 0)) + amount
+            h[_encode(key)] = repr(value)
+            return value
+
+    # ---- 集合 ----
+    def sadd(self, name, *values):
+        with self.lock:
+            s = self._get(name, set)
+            before = len(s)
+            s.update(_encode(v) for v in values)
+            return len(s) - before
+
+    def srem(self, name, *values):
+        with self.lock:
+            s = self._get(name) or set()
+            before = len(s)
+            s.difference_update(_encode(v) for v in values)
+            count = before - len(s)
+            self._cleanup(name)
+            return count
+
+    def smembers(self, name):
+        with self.lock:
+            return set(self._get(name) or ())
+
+    def sismember(self, name, value):
+        with self.lock:
+            return _encode(value) in (self._get(name) or ())
+
+    def spop(self, name):
+        with self.lock:
+            s = self._get(name) or set()
+            value = s.pop() if s else None
+            self._cleanup(name)
+            return value
+
+    def srandmember(self, name):
+        with self.lock:
+            s = self._get(name) or set()
+            return next(iter(s)) if s else None
+
+    def scard(self, name):
+        with self.lock:
+            return len(self._get(name) or ())
+
+    def _sets(self, keys, args):
+        keys = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+        keys.extend(args)
+        return [self._get(k) or set() for k in keys]
+
+    def sinter(self, keys, *args):
+        with self.lock:
+            sets = self._sets(keys, args)
+            return set.intersection(*sets) if sets else set()
+
+    def sunion(self, keys, *args):
+        with self.lock:
+            return set().union(*self._sets(keys, args))
+
+    def sdiff(self, keys, *args):
+        with self.lock:
+            sets = self._sets(keys, args)
+            return sets[0].difference(*sets[1:]) if sets else set()
+
+    def _store(self, dest, values):
+        self.data[dest] = set(values)
+        self.expires.pop(dest, None)
+        self._cleanup(dest)
+        return len(values)
+
+    def sinterstore(self, dest, keys, *args):
+        with self.lock:
+            return self._store(dest, self.sinter(keys, *args))
+
+    def sunionstore(self, dest, keys, *args):
+        with self.lock:
+            return self._store(dest, self.sunion(keys, *args))
+
+    def sdiffstore(self, dest, keys, *args):
+        with self.lock:
+            return self._store(dest, self.sdiff(keys, *args))
+
+    # ---- 有序集合 ----
+    def zadd(self, name, *args, **kwargs):
+        """ 旧版参数顺序：name1, score1, name2, score2, ... """
+        pairs = zip(args[::2], args[1::2]) + kwargs.items()
+        with self.lock:
+            z = self._get(name, SortedSet)
+            return len([m for m, score in pairs if z.add(_encode(m), float(score))])
+
+    def zrem(self, name, *values):
+        with self.lock:
+            z = self._get(name) or SortedSet()
+            count = len([v for v in values if z.remove(_encode(v))])
+            self._cleanup(name)
+            return count
+
+    def zincrby(self, name, value, amount=1):
+        with self.lock:
+            z = self._get(name, SortedSet)
+            value = _encode(value)
+            score = z.scores.get(value, 0.0) + amount
+            z.add(value, score)
+            return score
+
+    def zremrangebyscore(self, name, min, max):
+        with self.lock:
+            members = self.zrangebyscore(name, min, max)
+            return self.zrem(name, *members) if members else 0
+
+    def zscore(self, name, value):
+        with self.lock:
+            return (self._get(name) or SortedSet()).scores.get(_encode(value))
+
+    def zcard(self, name):
+        with self.lock:
+            return len(self._get(name) or ())
+
+    def zrank(self, name, value):
+        with self.lock:
+            members = [m for s, m in (self._get(name) or SortedSet()).items()]
+            value = _encode(value)
+            return members.index(value) if value in members else None
+
+    def zrevrank(self, name, value):
+        rank = self.zrank(name, value)
+        return None if rank is None else self.zcard(name) - rank - 1
+
+    def _zresult(self, items, withscores, score_cast_func=float):
+        if withscores:
+            return [(m, score_cast_func(s)) for s, m in items]
+        return [m for s, m in items]
+
+    def zrange(self, name, start, end, desc=False, withscores=False, score_cast_func=float):
+        with self.lock:
+            items = (self._get(name) or SortedSet()).items()
+            if desc:
+                items.reverse()
+            end = len(items) if end == -1 else end + 1
+            return self._zresult(items[start:end], withscores, score_cast_func)
+
+    def zrevrange(self, name, start, end, withscores=False, score_cast_func=float):
+        return self.zrange(name, start, end, True, withscores, score_cast_func)
+
+    def zrangebyscore(self, name, min, max, start=None, num=None, withscores=False, score_cast_func=float):
+        lo, lo_open = _score_bound(min)
+        hi, hi_open = _score_bound(max)
+        with self.lock:
+            items = [(s, m) for s, m in (self._get(name) or SortedSet()).items()
+                     if (s > lo if lo_open else s >= lo) and (s < hi if hi_open else s <= hi)]
+        if start is not None and num is not None:
+            items = items[start:start + num if num >= 0 else None]
+        return self._zresult(items, withscores, score_cast_func)
+
+    # ---- 流（redis-py 3的方法名和返回格式）----
+    def xadd(self, name, fields, id='*', maxlen=None, approximate=True):
+        with self.lock:
+            stream = self._get(name, MemoryStream)
+            entry_id = stream.add(dict((k, _encode(v)) for k, v in fields.iteritems()), id)
+            if maxlen is not None:
+                stream.trim(maxlen)
+            return entry_id
+
+    def xlen(self, name):
+        with self.lock:
+            return len(self._get(name) or ())
+
+    def xrevrange(self, name, max='+', min='-', count=None):
+        with self.lock:
+            stream = self._get(name)
+            if stream is None:
+                return []
+            hi = (float('inf'),) if max == '+' else _stream_id(max)
+            lo = (0, 0) if min == '-' else _stream_id(min)
+            entries = [(_format_stream_id(entry_id), dict(fields)) for entry_id, fields in reversed(stream.entries)
+                       if lo <= entry_id <= hi]
+            return entries[:count] if count else entries
+
+    def xgroup_create(self, name, groupname, id='$', mkstream=False):
+        with self.lock:
+            stream = self._get(name, MemoryStream if mkstream else None)
+            if stream is None:
+                raise redis.ResponseError('ERR The XGROUP subcommand requires the key to exist')
+            if groupname in stream.groups:
+                raise redis.ResponseError('BUSYGROUP Consumer Group name already exists')
+            stream.groups[groupname] = [stream.last_id if id == '$' else _stream_id(id), {}]
+            return True
+
+    def xreadgroup(self, groupname, consumername, streams, count=None, block=None, noack=False):
+        deadline = time.time() + block / 1000.0 if block else None
+        while True:
+            with self.lock:
+                result = []
+                for name, id in streams.iteritems():
+                    stream = self._get(name)
+                    if stream is None or groupname not in stream.groups:
+                        raise redis.ResponseError('NOGROUP No such key or consumer group')
+                    entries = stream.read_group(groupname, consumername, id, count, noack)
+                    if entries or id != '>':
+                        result.append([name, entries])
+                if result or deadline is None or time.time() >= deadline:
+                    return result
+            time.sleep(0.001)
+
+    def xack(self, name, groupname, *ids):
+        with self.lock:
+            stream = self._get(name)
+            if stream is None or groupname not in stream.groups:
+                return 0
+            pending = stream.groups[groupname][1]
+            return len([i for i in ids if pending.pop(_stream_id(i), None) is not None])
+
+    def xpending(self, name, groupname):
+        with self.lock:
+            pending = self._get(name).groups[groupname][1]
+            ids = sorted(pending)
+            return {'pending': len(ids),
+                    'min': _format_stream_id(ids[0]) if ids else None,
+                    'max': _format_stream_id(ids[-1]) if ids else None}
+
+    # ---- 列表 ----
+    def rpush(self, name, *values):
+        with self.lock:
+            l = self._get(name, list)
+            l.extend(_encode(v) for v in values)
+            return len(l)
+
+    def lpush(self, name, *values):
+        with self.lock:
+            l = self._get(name, list)
+            for v in values:
+                l.insert(0, _encode(v))
+            return len(l)
+
+    def lrange(self, name, start, end):
+        with self.lock:
+            l = self._get(name) or []
+            end = len(l) if end == -1 else end + 1
+            return l[start:end]
+
+    def llen(self, name):
+        with self.lock:
+            return len(self._get(name) or ())
+
+    def lindex(self, name, index):
+        with self.lock:
+            try:
+                return (self._get(name) or [])[index]
+            except IndexError:
+                return None
+
+    def lset(self, name, index, value):
+        with self.lock:
+            self._get(name)[index] = _encode(value)
+            return True
+
+    def lpop(self, name):
+        with self.lock:
+            l = self._get(name) or []
+            value = l.pop(0) if l else None
+            self._cleanup(name)
+            return value
+
+    def rpop(self, name):
+        with self.lock:
+            l = self._get(name) or []
+            value = l.pop() if l else None
+            self._cleanup(name)
+            return value
+
+    def lrem(self, name, value, num=0):
+        """ 旧版参数顺序 """
+        with self.lock:
+            l = self._get(name) or []
+            value = _encode(value)
+            indices = [i for i, v in enumerate(l) if v == value]
+            if num < 0:
+                indices = indices[::-1]
+            if num:
+                indices = indices[:abs(num)]
+            for i in sorted(indices, reverse=True):
+                del l[i]
+            self._cleanup(name)
+            return len(indices)
+
+    def ltrim(self, name, start, end):
+        with self.lock:
+            l = self._get(name) or []
+            end = len(l) if end == -1 else end + 1
+            l[:] = l[start:end]
+            self._cleanup(name)
+            return True
+
+    # ---- SORT ----
+    def _sort_lookup(self, pattern, member):
+        """ SORT的BY/GET模式：#为成员本身，key*->field为哈希字段，否则为字符串 """
+        if pattern == '#':
+            return member
+        if '->' in pattern:
+            key, field = pattern.split('->', 1)
+            return self.hget(key.replace('*', member, 1), field)
+        return self.get(pattern.replace('*', member, 1))
+
+    def sort(self, name, start=None, num=None, by=None, get=None, desc=False, alpha=False, store=None, groups=False):
+        if groups and (not isinstance(get, (list, tuple)) or len(get) < 2):
+            raise redis.DataError('when using "groups" the "get" argument must be specified and contain at least '
+                                  'two keys')
+        with self.lock:
+            value = self._get(name)
+            if isinstance(value, SortedSet):
+                members = [m for s, m in value.items()]
+            else:
+                members = list(value or ())
+            if by is None or '*' in by:
+                def weight(member):
+                    w = member if by is None else self._sort_lookup(by, member)
+                    if alpha:
+                        return w or ''
+                    try:
+                        return float(w)
+                    except (TypeError, ValueError):
+                        return 0.0
+                members.sort(key=weight, reverse=desc)
+            if start is not None and num is not None:
+                members = members[start:start + num]
+            if get is not None:
+                patterns = [get] if isinstance(get, basestring) else list(get)
+                members = [self._sort_lookup(pattern, member) for member in members for pattern in patterns]
+                if groups:
+                    members = zip(*[iter(members)] * len(patterns))
+            if store:
+                self.data[store] = list(members)
+                self.expires.pop(store, None)
+                self._cleanup(store)
+                return len(members)
+            return members
+
+
+def _command(name, impl):
+    @wraps(impl)
+    def command(self, *args, **kwargs):
+        return self.execute_command(name, *args, **kwargs)
+    return command
+
+
+MemoryRedis.commands = {}   # 命令名（大写） -> 实现
+for _name, _impl in MemoryRedis.__dict__.items():
+    if callable(_impl) and not _name.startswith('_') and _name not in ('execute_command', 'pipeline', 'pubsub'):
+        MemoryRedis.commands[_name.upper()] = _impl
+        setattr(MemoryRedis, _name, _command(_name.upper(), _impl))
+
+
+class SortedSet(object):
+    def __init__(self):
+        self.scores = {}
+
+    def __len__(self):
+        return len(self.scores)
+
+    def add(self, member, score):
+        new = member not in self.scores
+        self.scores[member] = score
+        return new
+
+    def remove(self, member):
+        return self.scores.pop(member, None) is not None
+
+    def items(self):
+        return sorted((s, m) for m, s in self.scores.iteritems())
+
+
+def _stream_id(value):
+    if isinstance(value, tuple):
+        return value
+    ms, _, seq = str(value).partition('-')
+    return int(ms), int(seq or 0)
+
+
+def _format_stream_id(value):
+    return '{0}-{1}'.format(*value)
+
+
+class MemoryStream(object):
+    def __init__(self):
+        self.entries = []       # [((毫秒, 序号), fields), ...]
+        self.last_id = (0, 0)
+        self.groups = {}        # 组名 -> [最后发送的id, {待确认id: 消费者}]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, fields, id='*'):
+        if id == '*':
+            ms = int(time.time() * 1000)
+            entry_id = (ms, 0) if ms > self.last_id[0] else (self.last_id[0], self.last_id[1] + 1)
+        else:
+            entry_id = _stream_id(id)
+            if entry_id <= self.last_id:
+                raise redis.ResponseError('ERR The ID specified in XADD is equal or smaller than the target '
+                                          'stream top item')
+        self.entries.append((entry_id, fields))
+        self.last_id = entry_id
+        return _format_stream_id(entry_id)
+
+    def trim(self, maxlen):
+        if len(self.entries) > maxlen:
+            del self.entries[:len(self.entries) - maxlen]
+
+    def fields(self, entry_id):
+        i = bisect.bisect_left(self.entries, (entry_id,))
+        if i < len(self.entries) and self.entries[i][0] == entry_id:
+            return self.entries[i][1]
+
+    def read_group(self, groupname, consumername, id, count, noack):
+        group = self.groups[groupname]
+        if id == '>':
+            start = bisect.bisect_left(self.entries, ((group[0][0], group[0][1] + 1),))
+            entries = self.entries[start:start + count if count else None]
+            if entries:
+                group[0] = entries[-1][0]
+            if not noack:
+                for entry_id, fields in entries:
+                    group[1][entry_id] = consumername
+        else:
+            # 本消费者已读取未确认的消息，用于重新处理；已被裁剪的消息fields为None，与Redis一致
+            after = _stream_id(id)
+            ids = sorted(i for i, consumer in group[1].iteritems() if consumer == consumername and i > after)
+            entries = [(entry_id, self.fields(entry_id)) for entry_id in ids[:count]]
+        return [(_format_stream_id(entry_id), fields and dict(fields)) for entry_id, fields in entries]
+
+
+ROLES = ('tick', 'model', 'pubsub')
+# 订阅者（止损检查、资金风控、行情订阅、交易所时钟、事件循环等，每个交易程序各有几个）在整个生命周期
+# 各占用一个发布订阅连接，None表示不限制连接数，订阅者增多时不会因连接池用尽而阻塞
+DEFAULT_POOL_SIZES = {'tick': 4, 'model': 16, 'pubsub': None}
+
+clients = {}    # role -> 客户端，未设置时使用redisco的连接
+
+
+class InstrumentedPool(redis.BlockingConnectionPool):
+    """ 统计使用情况和等待时间的阻塞连接池。
+    连接空闲超过health_check_interval秒时，取出前先PING，失败则断开重连。"""
+
+    def __init__(self, health_check_interval=30, **kwargs):
+        self.health_check_interval = health_check_interval
+        self.stats_lock = threading.Lock()
+        self.stats = {'checkouts': 0, 'in_use': 0, 'peak': 0, 'waits': 0, 'wait_time': 0.0,
+                      'max_wait': 0.0, 'timeouts': 0, 'reconnects': 0}
+        super(InstrumentedPool, self).__init__(**kwargs)
+
+    def get_connection(self, command_name, *keys, **options):
+        start = time.time()
+        try:
+            connection = super(InstrumentedPool, self).get_connection(command_name, *keys, **options)
+        except redis.ConnectionError:
+            with self.stats_lock:
+                self.stats['timeouts'] += 1
+            raise
+        waited = time.time() - start
+        with self.stats_lock:
+            stats = self.stats
+            stats['checkouts'] += 1
+            stats['in_use'] += 1
+            stats['peak'] = max(stats['peak'], stats['in_use'])
+            if waited > 0.001:
+                stats['waits'] += 1
+                stats['wait_time'] += waited
+                stats['max_wait'] = max(stats['max_wait'], waited)
+        self.check_health(connection)
+        return connection
+
+    def check_health(self, connection):
+        last_used = getattr(connection, 'last_used', None)
+        if not self.health_check_interval or last_used is None or \
+                time.time() - last_used < self.health_check_interval:
+            return
+        try:
+            connection.send_command('PING')
+            connection.read_response()
+        except (redis.ConnectionError, redis.TimeoutError):
+            connection.disconnect()
+            with self.stats_lock:
+                self.stats['reconnects'] += 1
+
+    def release(self, connection):
+        connection.last_used = time.time()
+        with self.stats_lock:
+            self.stats['in_use'] -= 1
+        super(InstrumentedPool, self).release(connection)
+
+    def usage(self):
+        with self.stats_lock:
+            usage = dict(self.stats)
+        usage['max_connections'] = self.max_connections
+        return usage
+
+
+class SubscriberPool(redis.ConnectionPool):
+    """ 不限制连接数的连接池，用于发布订阅 """
+
+    def usage(self):
+        return {'in_use': len(self._in_use_connections), 'created': self._created_connections,
+                'max_connections': None}
+
+
+def get_client(role='model'):
+    assert role in ROLES, role
+    return clients.get(role) or redisco.get_client()
+
+
+def all_clients():
+    """ 各角色使用的客户端（去重），用于统计和分析全部命令 """
+    result = []
+    for role in ROLES:
+        client = get_client(role)
+        if not any(client is c for c in result):
+            result.append(client)
+    return result
+
+
+def pubsub():
+    return get_client('pubsub').pubsub()
+
+
+class LazyClient(object):
+    """ 模块级rdb使用的代理，每次调用时才取get_client(role)，导入模块时不创建客户端 """
+
+    def __init__(self, role='model'):
+        self.role = role
+
+    def __getattr__(self, name):
+        return getattr(get_client(self.role), name)
+
+
+def lazy_client(role='model'):
+    assert role in ROLES, role
+    return LazyClient(role)
+
+
+def pool_stats():
+    """ 各角色连接池的使用情况 """
+    stats = {}
+    for role, client in clients.items():
+        pool = getattr(client, 'connection_pool', None)
+        if isinstance(pool, (InstrumentedPool, SubscriberPool)):
+            stats[role] = pool.usage()
+    return stats
+
+
+def configure_pools(pool_sizes=None, unix_socket_path=None, timeout=5, health_check_interval=30, **kwargs):
+    """ 为每个角色建立独立的连接池。
+    pool_sizes: {角色: 最大连接数，None表示不限制}；timeout: 连接池用尽时等待的秒数；
+    kwargs是redis连接参数（host, port, db, password, socket_timeout, socket_connect_timeout等）。"""
+    sizes = dict(DEFAULT_POOL_SIZES)
+    sizes.update(pool_sizes or {})
+    if unix_socket_path:
+        kwargs['path'] = unix_socket_path
+        kwargs['connection_class'] = redis.UnixDomainSocketConnection
+        for att in ('host', 'port', 'socket_connect_timeout', 'socket_keepalive', 'socket_keepalive_options'):
+            kwargs.pop(att, None)
+    for role in ROLES:
+        if sizes[role] is None:
+            pool = SubscriberPool(**kwargs)
+        else:
+            pool = InstrumentedPool(max_connections=sizes[role], timeout=timeout,
+                                    health_check_interval=health_check_interval, **kwargs)
+        clients[role] = redis.Redis(connection_pool=pool)
+    return clients
+
+
+def use_backend(backend='redis', **kwargs):
+    """ 选择存储后端，返回模型使用的客户端对象。
+    backend为'redis'时kwargs传给configure_pools，每个角色使用独立的连接池；
+    也可以直接传入客户端对象（例如恢复之前的后端），所有角色共用该对象 """
+    clients.clear()
+    if not isinstance(backend, basestring):
+        redisco.connection = backend
+        backend = type(backend).__name__
+    elif backend == 'memory':
+        redisco.connection = MemoryRedis()
+    elif backend == 'redis':
+        redisco.connection = configure_pools(**kwargs)['model']
+    else:
+        raise ValueError(u'未知的存储后端：{0}'.format(backend))
+    from .models import order_index
+    order_index.clear()
+    logger.info(u'使用{0}存储'.format(backend))
+    return redisco.connection
+
+
+def current_backend():
+    """ 保存当前的后端，之后用restore_backend恢复 """
+    return redisco.connection, dict(clients)
+
+
+def restore_backend(state):
+    connection, saved = state
+    clients.clear()
+    clients.update(saved)
+    redisco.connection = connection
+    from .models import order_index
+    order_index.clear()
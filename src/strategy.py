@@ -1,23 +1,30 @@
 # coding:utf8
 import logging
 import threading
+import heapq
+import itertools
 from time import sleep, time
 from collections import defaultdict
 from abc import ABCMeta, abstractmethod
 from datetime import datetime
 
-import redisco
-
 from .quoteservice import current_price
 from .models.instrument import Instrument
 from .models.order import Order
-from .utils import logerror, exchange_time
+from .models.account import convert_currency
+from .utils import logerror, exchange_time, monotonic
+from .metrics import metrics
+from .depth import depth_books
+from . import storage
 
 logger = logging.getLogger(__name__)
-rdb = redisco.get_client()
+rdb = storage.lazy_client()
 
 
 class BaseStrategy(object):
+    chase_steps = 3         # 按盘口追单时，每次最多比原价格差chase_steps个step
+    depth_max_age = 1.0     # 超过这么多秒没有更新的盘口不用于追单
+
     def __init__(self, code, trader, app):
         self.code = str(code)
         self.trader = trader
@@ -55,11 +62,8 @@ class BaseStrategy(object):
                     break
                 if i == count-1:    # last loop
                     break
-                if direction:
-                    price = order.price + step
-                else:
-                    price = order.price - step
                 volume = abs(order.volume) - abs(order.filled_volume)
+                price = self.chase_price(inst, direction, volume, order.price, step)
                 order = Order.objects.get_by_id(order.id)
                 if not self.trader.cancel_order(order):
                     if order.status == Order.OS_NONE:
@@ -99,6 +103,17 @@ class BaseStrategy(object):
                 threading.Thread(target=work, args=(order, delay, step, count, action), name=threading.current_thread().name+'-algo').start()
         return order
 
+    def chase_price(self, inst, direction, volume, price, step):
+        """ 追单的新价格：有最近更新的盘口深度时取一次成交剩余数量所需的对手价，
+        但最多比原价格差chase_steps个step；否则按step调整原价格 """
+        book = depth_books.snapshot(inst.secid)
+        if book and book.updated is not None and book.age() <= self.depth_max_age:
+            target = book.price_for(volume, direction)
+            if target is not None:
+                limit = step * self.chase_steps
+                return min(target, price + limit) if direction else max(target, price - limit)
+        return price + step if direction else price - step
+
     def close(self, inst, price):
         logger.info(u'策略{0}: 平仓{1}'.format(self.code, inst.name))
         for order in self.trader.opened_orders(instrument=inst, strategy_code=self.code):
@@ -145,11 +160,181 @@ class CheckAvailableThread(threading.Thread):
                 self.check()
 
 
+class AvailableGuardThread(threading.Thread):
+    """ 资金风控，替代按固定间隔全量计算的CheckAvailableThread。
+    持仓在成交后按合约重新加载，行情变化时只用缓存的持仓重算该合约的保证金和浮动盈亏；
+    可用资金占比跌破reserve%的瞬间在后台线程平掉全部浮仓，progress记录平仓进度；
+    平仓结束后仍有浮仓且资金未恢复时，每隔retry_interval秒重新平仓。"""
+
+    def __init__(self, trader, reserve, close_timeout=30, retry_interval=5):
+        super(AvailableGuardThread, self).__init__(name='AVGUARD-'+trader.name)
+        self.trader = trader
+        self.reserve = reserve
+        self.close_timeout = close_timeout
+        self.retry_interval = retry_interval
+        self.exposures = {}         # secid -> (instrument, [(opened_volume, opened_amount), ...])
+        self.prices = {}
+        self.margins = {}           # secid -> 保证金（账户本位币）
+        self.float_profits = {}     # secid -> 浮动盈亏（账户本位币）
+        self.balance = 0.0
+        self.dirty = set()          # 有成交、需要重新加载持仓的合约，由trader线程写入
+        self.dirty_lock = threading.Lock()
+        self.reload_all = True
+        self.breached = False
+        self.liquidation = None
+        self.retry_at = 0.0
+        self.progress = {}
+        trader.trade_listeners.append(self)
+
+    def on_trade(self, order, trade):
+        """ 由trader.on_trade调用，只做标记 """
+        with self.dirty_lock:
+            self.dirty.add(order.instrument.secid)
+
+    @property
+    def available(self):
+        account = self.trader.account
+        if getattr(account, '_available', None) is not None:
+            return account._available
+        return self.balance - sum(self.margins.values()) + sum(self.float_profits.values())
+
+    def opened_orders(self, instrument=None):
+        # 不使用Account.opened_orders的缓存，以免成交后1秒内读到过期数据
+        queryset = self.trader.account.orders
+        if instrument:
+            queryset = queryset.filter(instrument_id=instrument.id)
+        orders = list(queryset.filter(status=Order.OS_FILLED))
+        orders.extend(list(queryset.filter(status=Order.OS_CLOSING)))
+        return orders
+
+    def load(self, secids=None):
+        """ 重新加载持仓，secids为None时加载全部合约 """
+        if secids is None:
+            orders = self.opened_orders()
+            self.exposures.clear()
+            self.margins.clear()
+            self.float_profits.clear()
+        else:
+            orders = []
+            for secid in secids:
+                self.exposures.pop(secid, None)
+                self.margins.pop(secid, None)
+                self.float_profits.pop(secid, None)
+                inst = Instrument.objects.filter(secid=secid).first()
+                if inst:
+                    orders.extend(self.opened_orders(inst))
+        for order in orders:
+            inst = order.instrument
+            exposure = self.exposures.setdefault(inst.secid, (inst, []))
+            exposure[1].append((order.opened_volume, order.opened_amount))
+        if secids is None:
+            secids = self.exposures.keys()
+        self.on_prices([secid for secid in secids if secid in self.exposures])
+        self.balance = self.trader.account.balance
+
+    def revalue(self, secid):
+        # 与Order.cur_price一致：多头按买价、空头按卖价计算
+        inst, positions = self.exposures[secid]
+        b_price, s_price = self.prices.get(secid, (None, None))
+        margin = profit = 0.0
+        for volume, amount in positions:
+            price = b_price if volume > 0 else s_price
+            margin += inst.calc_margin(price, volume)
+            profit += inst.amount(price, volume) - amount
+        if inst.indirect_quotation:
+            profit *= -1
+        currency = self.trader.account.default_currency
+        self.margins[secid] = convert_currency(margin, inst.quoted_currency, currency)
+        self.float_profits[secid] = convert_currency(profit, inst.quoted_currency, currency)
+
+    @logerror
+    def on_prices(self, secids):
+        secids = [secid for secid in secids if secid in self.exposures]
+        if not secids:
+            return
+        pipeline = rdb.pipeline()
+        pipeline.hmget('current_b_price', secids)
+        pipeline.hmget('current_s_price', secids)
+        b_prices, s_prices = pipeline.execute()
+        for secid, b_price, s_price in zip(secids, b_prices, s_prices):
+            self.prices[secid] = (b_price and float(b_price), s_price and float(s_price))
+            self.revalue(secid)
+
+    def is_liquidating(self):
+        return self.liquidation is not None and self.liquidation.is_alive()
+
+    @logerror
+    def check(self):
+        with self.dirty_lock:
+            secids, self.dirty = self.dirty, set()
+        if self.reload_all:
+            self.reload_all = False
+            self.load()
+        elif secids:
+            self.load(secids)
+        if self.balance <= 0:
+            return
+        if self.available / self.balance >= self.reserve / 100.0:
+            self.breached = False
+        elif self.is_liquidating():
+            pass
+        elif not self.breached or (self.exposures and monotonic() >= self.retry_at):
+            if self.breached:
+                logger.warning(u'平仓后仍有浮仓，重新平仓')
+            self.breached = True
+            self.liquidation = threading.Thread(target=self.liquidate, name=self.name+'-liquidate')
+            self.liquidation.start()
+
+    def is_closed(self, order):
+        o = Order.objects.get_by_id(order.id)
+        return o is None or o.is_closed() or o.orig_order.is_closed()
+
+    @logerror
+    def liquidate(self):
+        logger.warning(u'资金不足，平掉全部浮仓!')
+        self.trader.close_lock = True
+        try:
+            orders = list(set(self.trader.close_all()))
+            self.progress = {'start': datetime.now(), 'total': len(orders), 'closed': 0, 'done': False}
+            pending = orders
+            for i in range(self.close_timeout):
+                pending = [order for order in pending if not self.is_closed(order)]
+                self.progress['closed'] = len(orders) - len(pending)
+                if not pending or self.trader.evt_stop.wait(1):
+                    break
+            if pending:
+                self.trader.cancel_orders(pending)
+                logger.info(u'平仓失败！未成功平仓订单：{0}'.format(pending))
+            else:
+                logger.info(u'全部平仓成功!')
+        finally:
+            self.progress['done'] = True
+            self.trader.close_lock = False
+            self.reload_all = True
+            self.retry_at = monotonic() + self.retry_interval
+
+    def run(self):
+        ps = storage.pubsub()
+        ps.subscribe('checkstop')
+        while not self.trader.evt_stop.wait(0.05):
+            secids = set()
+            item = ps.get_message()
+            while item:
+                if item['type'] == 'message':
+                    secids.add(item['data'])
+                item = ps.get_message()
+            if not self.trader.can_trade():
+                continue
+            self.on_prices(secids)
+            self.check()
+
+
 class CheckStopThread(threading.Thread):
-    def __init__(self, trader, limit_price_close=False):
+    def __init__(self, trader, limit_price_close=False, channel='checkstop'):
         super(CheckStopThread, self).__init__(name='CKSTOP-'+trader.name)
         self.trader = trader
         self.limit_price_close = limit_price_close
+        self.channel = channel      # 分片部署时为该分片的频道，见sharding.py
 
     @logerror
     def set_stopprice(self, instrument, price, offset_loss, offset_profit=0.0):
@@ -159,11 +344,17 @@ class CheckStopThread(threading.Thread):
                 order.set_stopprice(price, offset_loss, offset_profit)
 
     def close_order(self, order, price=0.0):
-        return self.trader.close_order(order, price, strategy_code=order.strategy_code)
+        neworder = self.trader.close_order(order, price, strategy_code=order.strategy_code)
+        if metrics.enabled and neworder:
+            metrics.elapsed('tick_submit', ('tick', order.instrument.secid))
+            metrics.stamp(('order', neworder.local_id))
+        return neworder
 
-    @logerror
-    def check(self, instrument, price):
-        # 检查是否触及止损或止赢价
+    def close_triggered(self, instrument, price):
+        """ 平掉触及止损或止赢价的订单，返回平仓单列表（不等待成交） """
+        if metrics.enabled:
+            metrics.elapsed('tick_check', ('tick', instrument.secid))
+            start = monotonic()
         to_be_closed = []
         for order in self.trader.opened_orders(instrument=instrument):
             direction = u''
@@ -195,36 +386,60 @@ class CheckStopThread(threading.Thread):
                 neworder = self.close_order(order)
                 if neworder:
                     to_be_closed.append(neworder)
+        if metrics.enabled:
+            metrics.record('stop_check', monotonic() - start)
+        return to_be_closed
+
+    @logerror
+    def check(self, instrument, price):
+        # 检查是否触及止损或止赢价
+        to_be_closed = self.close_triggered(instrument, price)
         if not self.trader.wait_for_closed(to_be_closed):
             logger.warning(u'止损(赢)平仓失败，请检查原因!')
 
+    def check_ticks(self, ticks):
+        """ 作为StreamConsumer的handler，按顺序检查一批tick的每个价格。出错时抛出异常，消息不确认 """
+        to_be_closed = []
+        for tick in ticks:
+            target = self.prepare(tick.securityID, tick.price)
+            if target:
+                to_be_closed.extend(self.close_triggered(*target))
+        if to_be_closed and not self.trader.wait_for_closed(to_be_closed):
+            logger.warning(u'止损(赢)平仓失败，请检查原因!')
+
+    def prepare(self, instid, price=None):
+        """ 处理checkstop消息：更新浮动止损价，返回需要检查的(instrument, 当前价)，无需检查时返回None。
+        price为None时读取当前价格 """
+        if not self.trader.can_trade():
+            # logger.debug(u'交易程序未就绪')
+            return
+        instrument = Instrument.objects.filter(secid=instid).first()
+        if instrument is None:
+            logger.debug(u'非法合约代码: {0}'.format(instid))
+            return
+        offset = self.trader.offsets.get(instrument.symbol)
+        if not offset:
+            try:
+                offset = self.trader.offsets.get(instrument.product.prodid)
+            except AttributeError:
+                offset = None
+        if not offset:
+            #logger.debug(u'收到未监控合约{0}的checkstop消息, monitor={1}'.format(instid, self.trader.monitors))
+            return
+        cur_price = current_price(instid, None) if price is None else price
+        self.set_stopprice(instrument, cur_price, *offset)
+        return instrument, cur_price
+
     def run(self):
-        ps = rdb.pubsub()
-        ps.subscribe('checkstop')
+        ps = storage.pubsub()
+        ps.subscribe(self.channel)
         logger.debug('CheckStopThread started...')
         while not self.trader.evt_stop.wait(0.1):
             item = ps.get_message()
             if item and item['type'] =='message':
-                if not self.trader.can_trade():
-                    # logger.debug(u'交易程序未就绪')
-                    continue
-                instid = item['data']
-                instrument = Instrument.objects.filter(secid=instid).first()
-                if instrument is None:
-                    logger.debug(u'非法合约代码: {0}'.format(instid))
-                    continue
-                offset = self.trader.offsets.get(instrument.symbol)
-                if not offset:
-                    try:
-                        offset = self.trader.offsets.get(instrument.product.prodid)
-                    except AttributeError:
-                        offset = None
-                if not offset:
-                    #logger.debug(u'收到未监控合约{0}的checkstop消息, monitor={1}'.format(instid, self.trader.monitors))
-                    continue
-                cur_price = current_price(instid, None)
-                self.set_stopprice(instrument, cur_price, *offset)
-                self.check(instrument, cur_price)
+                target = self.prepare(item['data'])
+                if target:
+                    self.check(*target)
         logger.debug('CheckStopThread exited.')
 
 
@@ -273,3 +488,102 @@ class CheckLimitOrderThread(threading.Thread):
         while not self.trader.evt_stop.wait(1):
             if self.trader.can_trade():
                 self.check()
+
+
+class OrderTimeoutThread(threading.Thread):
+    """ 按截止时间堆管理未成交订单，替代CheckLimitOrderThread和CheckUntradedOrderThread的定时扫描。
+    trader.on_new_order登记订单，全部成交、撤单或被拒绝时移除：
+    限价单到期立即撤单（平仓单撤单后重下市价平仓单），
+    超过quiet_interval秒没有任何回报的订单才查询状态。"""
+    EV_TIMEOUT, EV_REPLACE, EV_QUERY = range(3)
+
+    def __init__(self, trader, timeout, cancel_wait_time=0.2, quiet_interval=5):
+        super(OrderTimeoutThread, self).__init__(name='CkOrdTmo-'+trader.name)
+        self.trader = trader
+        self.timeout = timeout
+        self.cancel_wait_time = cancel_wait_time
+        self.quiet_interval = quiet_interval
+        self.heap = []
+        self.deadlines = {}     # (order_id, event) -> deadline, 堆中过期的条目据此丢弃
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        trader.order_timer = self
+
+    def schedule(self, order_id, event, deadline):
+        with self.cond:
+            self.deadlines[(order_id, event)] = deadline
+            heapq.heappush(self.heap, (deadline, next(self.seq), order_id, event))
+            self.cond.notify()
+
+    def add(self, order):
+        """ 登记新订单。只在登记时计算一次交易所时间。"""
+        now = time()
+        if order.price and order.order_time:
+            # 市价单不用撤
+            elapsed = (exchange_time(order.instrument.exchangeid) - order.order_time).total_seconds()
+            self.schedule(order.id, self.EV_TIMEOUT, now + max(self.timeout - elapsed, 0.0))
+        self.schedule(order.id, self.EV_QUERY, now + self.quiet_interval)
+
+    def touch(self, order):
+        """ 订单有回报（部分成交），推迟状态查询 """
+        with self.cond:
+            if (order.id, self.EV_QUERY) in self.deadlines:
+                self.schedule(order.id, self.EV_QUERY, time() + self.quiet_interval)
+
+    def remove(self, order):
+        """ 订单全部成交、已撤销或被拒绝。已安排的重下平仓单事件保留。"""
+        with self.cond:
+            self.deadlines.pop((order.id, self.EV_TIMEOUT), None)
+            self.deadlines.pop((order.id, self.EV_QUERY), None)
+
+    def pop_due(self, max_wait=1.0):
+        """ 返回到期的(order_id, event)，最多等待max_wait秒，没有则返回None """
+        with self.cond:
+            while self.heap:
+                deadline, _, order_id, event = self.heap[0]
+                if self.deadlines.get((order_id, event)) != deadline:
+                    heapq.heappop(self.heap)
+                    continue
+                wait = deadline - time()
+                if wait <= 0:
+                    heapq.heappop(self.heap)
+                    del self.deadlines[(order_id, event)]
+                    return order_id, event
+                max_wait = min(wait, max_wait)
+                break
+            self.cond.wait(max_wait)
+
+    @logerror
+    def fire(self, order_id, event):
+        if not self.trader.can_trade():
+            self.schedule(order_id, event, time() + 1)
+            return
+        order = Order.objects.get_by_id(order_id)
+        if order is None:
+            return
+        if event == self.EV_QUERY:
+            if order.can_cancel:
+                self.trader.query_order_status(order)
+                self.schedule(order_id, event, time() + self.quiet_interval)
+        elif event == self.EV_TIMEOUT:
+            if order.can_cancel:
+                logger.debug(u'订单{0}超过{1}秒未成交，撤单'.format(order.sys_id, self.timeout))
+                self.trader.cancel_order(order)
+                if not order.is_open:
+                    self.schedule(order_id, self.EV_REPLACE, time() + self.cancel_wait_time)
+        elif event == self.EV_REPLACE:
+            # 限价平仓单撤销后重下市价平仓单
+            if order.status == Order.OS_CANCELED:
+                self.trader.close_order(order.orig_order, strategy_code=order.strategy_code)
+
+    @logerror
+    def load(self):
+        for order in self.trader.untraded_orders():
+            self.add(order)
+
+    def run(self):
+        self.load()
+        while not self.trader.evt_stop.is_set():
+            item = self.pop_due()
+            if item:
+                self.fire(*item)
@@ -0,0 +1,325 @@
+# coding:utf8
+""" Redis Streams的tick传输。
+checkstop频道只发布合约代码，消费者落后或重启时消息就丢了，价格还要再从哈希表读。
+使用流时process_tick把完整的tick追加到流（XADD MAXLEN ~），止损检查、K线生成和策略各是一个消费组，
+用XREADGROUP COUNT批量读取，按顺序处理每个价格，处理完XACK；重启后先处理本消费者未确认的消息。
+
+每条消息带生产者序号，每个消费者确认后把自己处理到的序号写入<流>:acked哈希表（字段为<组名>:<消费者>，
+组名不能含冒号），同一组的多个消费者互不覆盖。生产者每check_every条比较一次，取各组消费者的最大序号：
+    落后超过max_lag条时报警（只报警，不限流，行情照常写入）；
+    落后条数超过流的长度时，超出部分在处理前已被MAXLEN裁剪，记入stream_dropped计数器。
+消费者重新读取本消费者未确认的消息时，已被裁剪的消息没有内容，直接确认并计入dropped。
+
+handler出错时这批消息不确认，run()每隔retry_interval秒重试，连续失败max_retries次后丢弃并记录错误。
+止损检查应设置max_age：重启或积压后读到的过期tick直接确认，不再用旧价格触发止损。
+
+    stream = TickStream(maxlen=100000)
+    quote_service.tick_stream = stream          # process_tick写流，同时仍发布checkstop供资金检查使用
+    checker = CheckStopThread(trader)
+    StreamConsumer(stream, 'checkstop', checker.check_ticks, max_age=5, evt_stop=trader.evt_stop).start()
+    StreamConsumer(stream, 'bars', quote_service.add_ticks).start()
+
+与sharding.py一起使用时传入HashRing，每个分片一个流（<流>:<分片号>），消费者用shards指定读哪些分片。
+redis-py 2.x没有流命令，通过execute_command调用（需要Redis 5.0以上）。
+"""
+import socket
+import logging
+import threading
+from time import time
+from datetime import datetime
+from collections import defaultdict
+
+import redis
+
+from . import storage
+from .metrics import metrics
+from .quoteservice import TickObject
+
+logger = logging.getLogger(__name__)
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+FLOAT_FIELDS = ('price', 'b_price', 's_price', 'volume')
+
+
+def encode_tick(tick, seq):
+    fields = {'secid': tick.securityID, 'seq': seq,
+              'entry_time': tick.entry_time.strftime(TIME_FORMAT)}
+    for name in FLOAT_FIELDS:
+        value = getattr(tick, name, None)
+        if value is not None:
+            fields[name] = value
+    return fields
+
+
+def decode_tick(fields):
+    tick = TickObject(securityID=fields['secid'],
+                      entry_time=datetime.strptime(fields['entry_time'], TIME_FORMAT))
+    for name in FLOAT_FIELDS:
+        if name in fields:
+            tick[name] = float(fields[name])
+    return tick
+
+
+def _pairs(values):
+    return dict(zip(values[::2], values[1::2]))
+
+
+def xadd(client, name, fields, maxlen=None):
+    if hasattr(client, 'xadd'):
+        return client.xadd(name, fields, maxlen=maxlen, approximate=True)
+    args = ['XADD', name]
+    if maxlen:
+        args += ['MAXLEN', '~', maxlen]
+    args.append('*')
+    for item in fields.iteritems():
+        args.extend(item)
+    return client.execute_command(*args)
+
+
+def xgroup_create(client, name, groupname, id='$'):
+    """ 创建消费组，已存在时返回False """
+    try:
+        if hasattr(client, 'xgroup_create'):
+            client.xgroup_create(name, groupname, id, mkstream=True)
+        else:
+            client.execute_command('XGROUP', 'CREATE', name, groupname, id, 'MKSTREAM')
+    except redis.ResponseError, e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+        return False
+    return True
+
+
+def xreadgroup(client, groupname, consumername, streams, count=None, block=None):
+    """ 返回[(流, 消息id, fields), ...] """
+    if hasattr(client, 'xreadgroup'):
+        response = client.xreadgroup(groupname, consumername, streams, count=count, block=block)
+    else:
+        args = ['XREADGROUP', 'GROUP', groupname, consumername]
+        if count:
+            args += ['COUNT', count]
+        if block:
+            args += ['BLOCK', block]
+        args.append('STREAMS')
+        args.extend(streams.keys())
+        args.extend(streams.values())
+        response = client.execute_command(*args) or []
+        response = [(name, [(id, _pairs(fields or [])) for id, fields in entries]) for name, entries in response]
+    return [(name, id, fields) for name, entries in response or [] for id, fields in entries]
+
+
+def xrevrange(client, name, max='+', min='-', count=None):
+    """ 返回[(消息id, fields), ...]，从新到旧 """
+    if hasattr(client, 'xrevrange'):
+        return client.xrevrange(name, max, min, count=count)
+    args = ['XREVRANGE', name, max, min]
+    if count:
+        args += ['COUNT', count]
+    return [(id, _pairs(fields)) for id, fields in client.execute_command(*args) or []]
+
+
+def xack(client, name, groupname, *ids):
+    if hasattr(client, 'xack'):
+        return client.xack(name, groupname, *ids)
+    return client.execute_command('XACK', name, groupname, *ids)
+
+
+def xlen(client, name):
+    if hasattr(client, 'xlen'):
+        return client.xlen(name)
+    return client.execute_command('XLEN', name)
+
+
+class TickStream(object):
+    def __init__(self, name='ticks', maxlen=100000, ring=None, max_lag=None, check_every=1000, client=None):
+        self.name = name
+        self.maxlen = maxlen
+        self.ring = ring            # sharding.HashRing，每个分片一个流
+        self.max_lag = max_lag or maxlen // 2
+        self.check_every = check_every
+        self.client = client
+        self.seqs = {}              # 流 -> 序号，第一次写入时从流里最后一条消息接着编号
+        self.lagging = {}           # 流 -> {组名: 落后条数}
+        self.trimmed = {}           # (流, 组名) -> 已计入丢失的最大序号
+        self.dropped = defaultdict(int)     # 组名 -> 处理前被裁剪的条数
+
+    def db(self):
+        return self.client or storage.get_client('tick')
+
+    def key(self, shard=None):
+        return self.name if shard is None else '{0}:{1}'.format(self.name, shard)
+
+    def key_for(self, secid):
+        return self.key(self.ring.shard_for(secid) if self.ring else None)
+
+    def append(self, tick):
+        key = self.key_for(tick.securityID)
+        if key not in self.seqs:
+            self.seqs[key] = self.last_seq(key)
+        self.seqs[key] += 1
+        seq = self.seqs[key]
+        xadd(self.db(), key, encode_tick(tick, seq), self.maxlen)
+        if seq % self.check_every == 0:
+            self.check_lag(key)
+
+    def last_seq(self, key):
+        """ 流里最后一条消息的序号。生产者重启后从这里接着编号，否则各组确认的序号都比新序号大，落后和裁剪都统计不到 """
+        entries = xrevrange(self.db(), key, count=1)
+        return int(entries[0][1]['seq']) if entries else 0
+
+    def check_lag(self, key):
+        """ 比较各消费组确认的序号，返回落后超过max_lag条的{组名: 落后条数}，并统计处理前被裁剪的消息 """
+        db = self.db()
+        pipe = db.pipeline(transaction=False)
+        pipe.hgetall(key + ':acked')
+        xlen(pipe, key)
+        acked, length = pipe.execute()
+        groups = {}
+        for field, seq in (acked or {}).iteritems():
+            group = field.split(':', 1)[0]
+            groups[group] = max(groups.get(group, 0), int(seq))
+        seq = self.seqs.get(key, 0)
+        lagging = {}
+        for group, acked in groups.iteritems():
+            if seq - acked > self.max_lag:
+                lagging[group] = seq - acked
+            # 序号在(acked, seq - length]之间的消息已不在流里
+            lost = seq - length
+            counted = max(self.trimmed.get((key, group), acked), acked)
+            if lost > counted:
+                self.trimmed[key, group] = lost
+                self.dropped[group] += lost - counted
+                logger.warning(u'流{0}消费组{1}有{2}条消息未处理就被裁剪'.format(key, group, lost - counted))
+                if metrics.enabled:
+                    metrics.incr('stream_dropped:' + group, lost - counted)
+        if lagging and key not in self.lagging:
+            logger.warning(u'流{0}的消费组处理不及: {1}'.format(key, lagging))
+        elif not lagging and key in self.lagging:
+            logger.info(u'流{0}的消费组已跟上'.format(key))
+        if lagging:
+            self.lagging[key] = lagging
+        else:
+            self.lagging.pop(key, None)
+        return lagging
+
+
+class StreamConsumer(threading.Thread):
+    """ 消费组里的一个消费者，handler(ticks)批量处理一组按顺序排列的tick。
+    max_age秒：写入时间早于此的消息不交给handler，直接确认 """
+
+    def __init__(self, stream, group, handler, consumer=None, shards=None, count=100, block=100, evt_stop=None,
+                 max_age=None, retry_interval=1, max_retries=3):
+        super(StreamConsumer, self).__init__(name='STREAM-' + group)
+        self.daemon = True
+        self.stream = stream
+        self.group = group
+        self.handler = handler
+        self.consumer = consumer or '{0}-{1}'.format(socket.gethostname(), id(self))
+        self.keys = [stream.key(shard) for shard in shards] if shards is not None else [stream.key()]
+        self.count = count
+        self.block = block
+        self.evt_stop = evt_stop or threading.Event()
+        self.max_age = max_age
+        self.retry_interval = retry_interval
+        self.max_retries = max_retries
+        self.failures = 0           # handler连续失败次数，大于0时run()先重试未确认的消息
+        self.last_seq = {}
+        self.acked = 0
+        self.dropped = 0
+        self.skipped = 0
+
+    def ensure_group(self):
+        for key in self.keys:
+            xgroup_create(self.stream.db(), key, self.group)
+
+    def read(self, id='>', block=None):
+        db = self.stream.db()
+        return xreadgroup(db, self.group, self.consumer, dict((key, id) for key in self.keys), self.count, block)
+
+    @staticmethod
+    def written_at(id):
+        # 消息id的前半部分是写入时的毫秒时间
+        return int(id.split('-')[0]) / 1000.0
+
+    def process(self, entries):
+        """ 处理并确认一批消息，返回确认的条数。handler出错时不确认，由run()重试 """
+        if not entries:
+            return 0
+        ticks = []
+        trimmed = skipped = 0
+        expire = time() - self.max_age if self.max_age else None
+        for key, id, fields in entries:
+            if not fields:
+                trimmed += 1    # 未确认期间已被裁剪
+                continue
+            self.last_seq[key] = max(self.last_seq.get(key, 0), int(fields['seq']))
+            if expire and self.written_at(id) < expire:
+                skipped += 1
+                continue
+            ticks.append(decode_tick(fields))
+        if ticks:
+            try:
+                self.handler(ticks)
+            except Exception, e:
+                self.failures += 1
+                logger.exception(unicode(e))
+                if self.failures < self.max_retries:
+                    return 0
+                logger.error(u'流消费组{0}连续{1}次处理失败，丢弃{2}条消息'.format(self.group, self.failures, len(ticks)))
+                self.dropped += len(ticks)
+        self.failures = 0
+        self.ack(entries)
+        if trimmed:
+            self.dropped += trimmed
+            logger.warning(u'消费组{0}有{1}条未确认的消息已被裁剪'.format(self.group, trimmed))
+        if skipped:
+            self.skipped += skipped
+            logger.info(u'消费组{0}跳过{1}条过期tick'.format(self.group, skipped))
+        if metrics.enabled:
+            metrics.incr('stream_acked:' + self.group, len(entries))
+            if trimmed:
+                metrics.incr('stream_dropped:' + self.group, trimmed)
+            metrics.record('stream_lag:' + self.group, max(time() - self.written_at(entries[-1][1]), 0))
+        return len(entries)
+
+    def ack(self, entries):
+        pipe = self.stream.db().pipeline()
+        for key in self.keys:
+            ids = [id for k, id, fields in entries if k == key]
+            if ids:
+                xack(pipe, key, self.group, *ids)
+                if key in self.last_seq:
+                    pipe.hset(key + ':acked', '{0}:{1}'.format(self.group, self.consumer), self.last_seq[key])
+        pipe.execute()
+        self.acked += len(entries)
+
+    def recover(self):
+        """ 处理本消费者已读取未确认的消息，返回确认的条数 """
+        total = 0
+        while not self.evt_stop.is_set():
+            count = self.process(self.read('0'))
+            if not count:
+                break
+            total += count
+        return total
+
+    def poll(self, block=None):
+        return self.process(self.read('>', block))
+
+    def run(self):
+        self.ensure_group()
+        self.recover()
+        while not self.evt_stop.is_set():
+            try:
+                if self.failures:
+                    # 先重试失败的那批，不读新消息，保证按顺序处理
+                    self.evt_stop.wait(self.retry_interval)
+                    self.recover()
+                else:
+                    self.poll(self.block)
+            except Exception, e:
+                logger.exception(unicode(e))
+                self.evt_stop.wait(1)
+
+    def stop(self):
+        self.evt_stop.set()
@@ -0,0 +1,166 @@
+# coding:utf8
+""" 多合约、多参数并行回测。
+参数网格 × 合约分配到multiprocessing进程池，每个工作进程使用独立的内存存储；
+backend='redis'时必须通过redis参数明确指定专用的Redis服务器，各进程使用其中的redis_db_base+i号数据库并清空，
+tick数据由各进程从TickArchive文件mmap读取（共享操作系统页缓存），结果合并为一张表。 """
+import logging
+import datetime
+import itertools
+import multiprocessing
+
+import redisco
+
+from . import storage
+
+logger = logging.getLogger(__name__)
+
+INSTRUMENT_FIELDS = ('secid', 'name', 'symbol', 'exchangeid', 'quoted_currency', 'indirect_quotation',
+                     'ndigits', 'multiplier', 'open_commission_rate', 'close_commission_rate', 'tick_size',
+                     'tick_value', 'min_order_volume', 'max_order_volume', 'is_trading',
+                     'long_margin_ratio', 'short_margin_ratio')
+
+_worker = {}
+
+
+def parameter_grid(offsets_loss, offsets_profit=(0.0,)):
+    """ 返回[(offset_loss, offset_profit), ...] """
+    return list(itertools.product(offsets_loss, offsets_profit))
+
+
+def check_redis_options(redis_options):
+    """ Redis模式会清空数据库，必须明确指定专用服务器 """
+    if not redis_options or not (redis_options.get('unix_socket_path') or
+                                 (redis_options.get('host') and redis_options.get('port'))):
+        raise ValueError(u"backend='redis'需要在redis参数中明确指定专用服务器的host和port（或unix_socket_path）")
+
+
+def use_store(db=None, backend='memory', redis_options=None):
+    """ 切换当前进程使用的存储并清空 """
+    if backend == 'memory':
+        storage.use_backend('memory')
+    elif backend == 'redis':
+        check_redis_options(redis_options)
+        storage.use_backend('redis', db=db, **redis_options)
+    else:
+        raise ValueError(u'未知的存储后端：{0}'.format(backend))
+    redisco.get_client().flushdb()
+
+
+def _init_worker(backend, redis_options, db_base, counter, instruments):
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    _worker['db'] = db_base + index
+    _worker['instruments'] = instruments
+    use_store(_worker['db'], backend, redis_options)
+
+
+def _load_instruments():
+    from .models import Instrument
+    for fields in _worker['instruments']:
+        Instrument.objects.create(**fields)
+
+
+def max_drawdown(equity):
+    peak = None
+    drawdown = 0.0
+    for value in equity:
+        peak = value if peak is None else max(peak, value)
+        drawdown = max(drawdown, peak - value)
+    return drawdown
+
+
+def _run_task(task):
+    from .backtest import BacktestTrader, BacktestEngine, ticks_from_array
+    from .tickarchive import TickArchive
+    from .models import Instrument
+    secid, offset_loss, offset_profit, options = task
+    redisco.get_client().flushdb()
+    _load_instruments()
+    inst = Instrument.objects.filter(secid=secid).first()
+    code = 'sweep-{0}-{1}-{2}'.format(secid, offset_loss, offset_profit)
+    trader = BacktestTrader(code, code, options['currency'],
+                            '{0}:{1}:{2}'.format(inst.symbol, offset_loss, offset_profit))
+    trader.set_monitors(publish=False)
+    engine = BacktestEngine(trader)
+    engine.on_tick.append(options['strategy'](engine, trader, inst))
+    equity = []
+    sample_every = options['sample_every']
+
+    def sample(tick, counter=itertools.count()):
+        if next(counter) % sample_every == 0:
+            equity.append(trader.account.real_profits + trader.account.float_profits)
+    engine.on_tick.append(sample)
+
+    archive = TickArchive(options['archive_root'])
+    ticks = archive.between(secid, options['start'], options['end'])
+    stats = engine.run(ticks_from_array(secid, ticks))
+    equity.append(trader.account.real_profits + trader.account.float_profits)
+    orders = list(trader.account.orders)
+    return {
+        'secid': secid,
+        'offset_loss': offset_loss,
+        'offset_profit': offset_profit,
+        'profit': equity[-1],
+        'real_profit': trader.account.real_profits,
+        'max_drawdown': max_drawdown(equity),
+        'orders': len([o for o in orders if o.is_open]),
+        'commission': sum([o.commission for o in orders]),
+        'ticks': stats['ticks'],
+        'seconds': stats['seconds'],
+    }
+
+
+class SweepRunner(object):
+    """ strategy(engine, trader, inst)须为模块级函数（可pickle），返回每笔tick调用的回调函数。
+    backend='redis'时redis为专用服务器的连接参数，例如{'host': 'sweep-redis', 'port': 6380}。"""
+
+    def __init__(self, archive_root, strategy, start, end, processes=None, redis_db_base=1,
+                 currency='CNY', sample_every=100, backend='memory', redis=None):
+        if backend == 'redis':
+            check_redis_options(redis)
+        elif backend != 'memory':
+            raise ValueError(u'未知的存储后端：{0}'.format(backend))
+        self.processes = processes or multiprocessing.cpu_count()
+        self.backend = backend
+        self.redis_options = redis
+        self.redis_db_base = redis_db_base
+        self.options = {
+            'archive_root': archive_root,
+            'strategy': strategy,
+            'start': start,
+            'end': end,
+            'currency': currency,
+            'sample_every': sample_every,
+        }
+
+    def instrument_definitions(self, secids):
+        from .models import Instrument
+        definitions = []
+        for secid in secids:
+            inst = Instrument.objects.filter(secid=secid).first()
+            if inst is None:
+                raise ValueError(u'找不到合约{0}'.format(secid))
+            definitions.append(dict((f, getattr(inst, f)) for f in INSTRUMENT_FIELDS
+                                    if getattr(inst, f) is not None))
+        return definitions
+
+    def run(self, secids, grid):
+        """ 返回pandas.DataFrame，每行为一个(合约, offset_loss, offset_profit)组合的结果 """
+        import pandas as pd
+        tasks = [(secid, loss, profit, self.options) for secid in secids for loss, profit in grid]
+        counter = multiprocessing.Value('i', 0)
+        pool = multiprocessing.Pool(self.processes, _init_worker,
+                                    (self.backend, self.redis_options, self.redis_db_base, counter,
+                                     self.instrument_definitions(secids)))
+        start = datetime.datetime.now()
+        try:
+            results = pool.map(_run_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = (datetime.datetime.now() - start).total_seconds()
+        logger.info(u'{0}个回测任务，{1}个进程，用时{2:.1f}秒'.format(len(tasks), self.processes, elapsed))
+        columns = ['secid', 'offset_loss', 'offset_profit', 'profit', 'real_profit', 'max_drawdown',
+                   'orders', 'commission', 'ticks', 'seconds']
+        return pd.DataFrame(results, columns=columns).sort_values(['secid', 'offset_loss', 'offset_profit'])
@@ -0,0 +1,9 @@
+import os
+
+from .. import storage
+
+
+def setup_package():
+    # the suite runs on the in-memory store unless SECTRADELIB_BACKEND=redis selects the configured server
+    if os.environ.get('SECTRADELIB_BACKEND', 'memory') == 'memory':
+        storage.use_backend('memory')
@@ -0,0 +1,83 @@
+from datetime import datetime
+
+from nose.tools import eq_, with_setup
+
+from ..models import Instrument, Account
+from ..strategy import AvailableGuardThread
+from ..utils import rdb
+from .utils import TestTrader
+
+def setup_func():
+    Instrument.objects.create(secid='XX1505', name='XX1505', symbol='XX1505', quoted_currency='CNY',
+                              multiplier=10.0, long_margin_ratio=0.1, short_margin_ratio=0.1)
+    rdb.hset('current_b_price', 'XX1505', 5000)
+    rdb.hset('current_s_price', 'XX1505', 5000)
+
+def teardown_func():
+    Instrument.objects.filter(secid='XX1505').first().delete()
+    rdb.hdel('current_b_price', 'XX1505')
+    rdb.hdel('current_s_price', 'XX1505')
+    a = Account.objects.filter(code='test').first()
+    for o in a.orders:
+        o.delete()
+    a.delete()
+
+@with_setup(setup_func, teardown_func)
+def test_incremental_available():
+    trader = TestTrader('test', 'test', 'CNY', 'XX1505:100')
+    trader.account.set_balance(100000.0)
+    trader.set_monitors()
+    guard = AvailableGuardThread(trader, 50, close_timeout=1, retry_interval=0)
+    inst = Instrument.objects.filter(secid='XX1505').first()
+    guard.check()
+    eq_(guard.available, 100000.0)
+
+    order = trader.open_order(inst, 0.0, 2, True, 'anna1')
+    trader.on_new_order(order.local_id, 'XX1505', 'ORDER1', True, 0.0, 2, datetime.now())
+    trader.on_trade('EXEC1', 'XX1505', 'ORDER1', 5000, 2, datetime.now())
+    eq_(guard.dirty, set(['XX1505']))
+    guard.check()
+    eq_(guard.margins['XX1505'], 10000.0)
+    eq_(guard.available, trader.account.available)
+
+    rdb.hset('current_b_price', 'XX1505', 4900)
+    guard.on_prices(['XX1505'])
+    eq_(guard.float_profits['XX1505'], -2000.0)
+    eq_(guard.available, trader.account.available)
+    assert not guard.breached
+
+    rdb.hset('current_b_price', 'XX1505', 500)
+    guard.on_prices(['XX1505'])
+    guard.check()
+    assert guard.breached
+    guard.liquidation.join()
+    assert guard.progress['done']
+    eq_(guard.progress['total'], 1)
+    assert not trader.close_lock
+
+    # the close order was never filled: liquidate again
+    first = guard.liquidation
+    guard.check()
+    assert guard.liquidation is not first
+    guard.liquidation.join()
+    assert guard.progress['done']
+
+
+@with_setup(setup_func, teardown_func)
+def test_price_error_does_not_stop_guard():
+    trader = TestTrader('test', 'test', 'CNY', 'XX1505:100')
+    trader.account.set_balance(100000.0)
+    guard = AvailableGuardThread(trader, 50, close_timeout=1, retry_interval=0)
+    inst = Instrument.objects.filter(secid='XX1505').first()
+    order = trader.open_order(inst, 0.0, 2, True, 'anna1')
+    trader.on_new_order(order.local_id, 'XX1505', 'ORDER1', True, 0.0, 2, datetime.now())
+    trader.on_trade('EXEC1', 'XX1505', 'ORDER1', 5000, 2, datetime.now())
+    guard.check()
+
+    def fail(secid):
+        raise ValueError('boom')
+    guard.revalue = fail
+    guard.on_prices(['XX1505'])     # logged, the guard thread keeps running
+    del guard.revalue
+    guard.on_prices(['XX1505'])
+    eq_(guard.available, trader.account.available)
@@ -0,0 +1,50 @@
+from datetime import datetime, timedelta
+
+from nose.tools import eq_, with_setup
+
+from ..models import Instrument, Account, Order
+from ..quoteservice import TickObject
+from ..backtest import BacktestTrader, BacktestEngine
+from .. import utils
+
+def setup_func():
+    Instrument.objects.create(secid='XX1505', name='XX1505', symbol='XX1505', quoted_currency='CNY', multiplier=1.0)
+
+def teardown_func():
+    Instrument.objects.filter(secid='XX1505').first().delete()
+    a = Account.objects.filter(code='backtest').first()
+    for o in a.orders:
+        o.delete()
+    a.delete()
+
+@with_setup(setup_func, teardown_func)
+def test_stop_loss_replay():
+    trader = BacktestTrader('backtest', 'backtest', 'CNY', 'XX1505:100')
+    trader.set_monitors(publish=False)
+    engine = BacktestEngine(trader)
+    inst = Instrument.objects.filter(secid='XX1505').first()
+    orders = []
+
+    def strategy(tick):
+        eq_(utils.exchange_time('SHFE'), tick.entry_time)
+        if not orders:
+            orders.append(trader.open_order(inst, 0.0, 1, True, 'anna'))
+
+    engine.on_tick.append(strategy)
+    start = datetime(2015, 5, 4, 9, 0)
+    prices = [5000, 5010, 5100, 5050, 4990, 4980, 4970]
+    ticks = [TickObject(securityID='XX1505', entry_time=start + timedelta(seconds=i),
+                        price=p, b_price=p - 1, s_price=p + 1, volume=1)
+             for i, p in enumerate(prices)]
+    stats = engine.run(ticks)
+    eq_(stats['ticks'], len(prices))
+    assert stats['ticks_per_sec'] > 0
+    assert utils.exchange_clock is not engine.clock
+
+    order = Order.objects.get_by_id(orders[0].id)
+    eq_(order.status, Order.OS_CLOSED)
+    eq_(order.avg_fill_price, 5011)     # ask of the tick after the order
+    eq_(order.stoploss, 5000)
+    close_order = order.close_orders[0]
+    eq_(close_order.avg_fill_price, 4979)   # bid of the tick after the stop was hit
+    eq_(close_order.real_profit, -32)
@@ -0,0 +1,60 @@
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from nose.tools import eq_
+
+from ..barstore import BarStore, BAR_DTYPE
+
+
+def make_frame(secid, times, closes):
+    index = pd.DatetimeIndex(times, name='entry_time')
+    return pd.DataFrame({
+        'open_price': closes, 'high_price': closes, 'low_price': closes, 'close_price': closes,
+        'volume': [1.0] * len(closes), 'securityID': secid}, index=index)
+
+
+def test_append_query_compact():
+    root = tempfile.mkdtemp()
+    try:
+        store = BarStore(root, max_chunks=1)
+        store.append_frame(make_frame('XX1505', ['2015-05-04 09:00:10', '2015-05-04 09:00:20'], [1.0, 2.0]))
+        store.append_frame(make_frame('XX1505', ['2015-05-04 09:00:30', '2015-05-04 09:00:40'], [3.0, 4.0]))
+        store.append_frame(make_frame('XX1505', ['2015-05-04 09:00:40', '2015-05-04 09:00:50'], [4.5, 5.0]))
+        eq_(len(store.chunk_list('XX1505')), 3)
+
+        bars = store.query('XX1505', '2015-05-04 09:00:10', '2015-05-04 09:00:30')
+        assert isinstance(bars, np.memmap)
+        eq_(list(bars['close']), [1.0, 2.0])
+        eq_(list(store.query('XX1505', '2015-05-04 09:00:20')['close']), [2.0, 3.0, 4.5, 5.0])
+        eq_(len(store.query('YY1505')), 0)
+
+        store.compact_all()
+        eq_(len(store.chunk_list('XX1505')), 1)
+        eq_(list(store.query('XX1505')['close']), [1.0, 2.0, 3.0, 4.5, 5.0])
+        # a fresh store sees the compacted chunk on disk
+        bars = BarStore(root).query('XX1505', end=np.datetime64('2015-05-04T09:00:30'))
+        eq_(bars.dtype, BAR_DTYPE)
+        eq_(list(bars['close']), [1.0, 2.0])
+    finally:
+        shutil.rmtree(root)
+
+
+def test_later_write_wins():
+    root = tempfile.mkdtemp()
+    try:
+        store = BarStore(root, max_chunks=1)
+        store.append_frame(make_frame('XX1505', ['2015-05-04 09:00:40', '2015-05-04 09:00:50'], [4.0, 5.0]))
+        # rewritten later, but the chunk starts earlier
+        store.append_frame(make_frame('XX1505', ['2015-05-04 09:00:30', '2015-05-04 09:00:40'], [3.0, 4.5]))
+        eq_(list(store.query('XX1505')['close']), [3.0, 4.5, 5.0])
+        # a batch crossing midnight is split into one chunk per day
+        store.append_frame(make_frame('XX1505', ['2015-05-04 23:59:00', '2015-05-05 00:00:00'], [6.0, 7.0]))
+        eq_(len(store.chunk_list('XX1505')), 4)
+        eq_(store.compact('XX1505'), 1)
+        eq_(len(store.chunk_list('XX1505')), 2)
+        eq_(list(store.query('XX1505')['close']), [3.0, 4.5, 5.0, 6.0, 7.0])
+        eq_(list(BarStore(root).query('XX1505')['close']), [3.0, 4.5, 5.0, 6.0, 7.0])
+    finally:
+        shutil.rmtree(root)
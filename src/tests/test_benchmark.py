@@ -0,0 +1,36 @@
+import redisco
+from nose.tools import eq_, raises
+
+from ..benchmark import BENCHMARKS, run_benchmarks, compare
+
+
+def test_compare():
+    baseline = {'a': {'per_op_us': 10.0}, 'b': {'per_op_us': 10.0}, 'c': {'error': 'x'}}
+    results = {'a': {'per_op_us': 11.0}, 'b': {'per_op_us': 13.0}, 'c': {'per_op_us': 1.0}}
+    eq_(compare(results, baseline, 0.2), [('b', 10.0, 13.0)])
+
+
+@raises(ValueError)
+def test_redis_needs_db():
+    run_benchmarks(['on_trade'], backend='redis', redis_options={'host': 'localhost'})
+
+
+def test_run():
+    client = redisco.connection
+    results = run_benchmarks(['on_trade', 'trade_on_close'], scale=0.01, repeat=1)
+    assert redisco.connection is client     # the previous backend is restored
+    eq_(results.keys(), ['on_trade', 'trade_on_close'])
+    eq_(results['on_trade']['ops'], 5)
+    assert results['trade_on_close']['per_op_us'] > 0
+
+
+def test_all_benchmarks():
+    results = run_benchmarks(scale=0.01, repeat=1)
+    eq_(results.keys(), BENCHMARKS.keys())
+    eq_([name for name, result in results.items() if 'error' in result], [])
+
+
+def test_startup():
+    results = run_benchmarks(['startup_strategy'], scale=0.34, repeat=1)
+    eq_(results['startup_strategy']['ops'], 1)
+    assert results['startup_strategy']['per_op_us'] > 0
@@ -0,0 +1,22 @@
+from nose.tools import eq_
+
+from ..cursestools import diff_rows, fit_width
+
+
+def test_diff_rows():
+    old = ((('a', 0), ('1', 0)), (('b', 0), ('2', 0)), (('c', 0),))
+    new = ((('a', 0), ('1', 0)), (('b', 0), ('3', 0), ('x', 0)))
+    changes, cleared = diff_rows(old, new)
+    eq_(changes, [(1, 1, ('3', 0)), (1, 2, ('x', 0))])
+    eq_(cleared, [(2, 0)])
+    eq_(diff_rows(new, new), ([], []))
+    # a shrinking row clears its stale columns
+    eq_(diff_rows(((('a', 0), ('1', 0), ('x', 0)),), ((('a', 0), ('1', 0)),)), ([], [(0, 2)]))
+
+
+def test_fit_width():
+    # CJK characters take two columns and are never cut in half
+    eq_(fit_width(u'\u87ba\u7eb9\u94a2', 5), u'\u87ba\u7eb9 ')
+    eq_(fit_width(u'IF1505', 4), u'IF15')
+    eq_(fit_width('\xe8\x9e\xba', 3), u'\u87ba ')
+    eq_(fit_width(12, 3), u'12 ')
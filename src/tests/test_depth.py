@@ -0,0 +1,51 @@
+from nose.tools import eq_
+
+from ..depth import DepthBook, depth_books
+from ..models.instrument import Instrument
+from ..strategy import BaseStrategy
+
+
+def test_incremental_updates():
+    book = DepthBook('XX1505', max_levels=3)
+    book.update([(True, 99.0, 5), (True, 100.0, 3), (False, 101.0, 2), (False, 102.0, 4), (False, 103.0, 10)])
+    snap = book.snapshot()
+    eq_(snap.bids, ((100.0, 3), (99.0, 5)))
+    eq_(snap.asks, ((101.0, 2), (102.0, 4), (103.0, 10)))
+    eq_(snap.spread(), 1.0)
+    assert book.snapshot() is snap     # not copied again until the next update
+
+    book.update([(False, 101.0, 0), (False, 101.5, 1), (True, 98.0, 1), (True, 97.0, 1)])
+    snap = book.snapshot()
+    eq_(snap.asks, ((101.5, 1), (102.0, 4), (103.0, 10)))
+    eq_(snap.top(2, True), ((100.0, 3), (99.0, 5)))
+    eq_(len(snap.bids), 3)
+
+    eq_(snap.price_for(3, True), 102.0)
+    eq_(snap.vwap(3, True), (101.5 + 2 * 102.0) / 3)
+    eq_(snap.vwap(100, True), None)
+    eq_(snap.price_for(4, False), 99.0)
+
+
+def test_replace():
+    book = DepthBook('XX1505')
+    book.replace([(99.0, 1), (100.0, 2)], [(101.0, 3), (100.5, 0)])
+    snap = book.snapshot()
+    eq_(snap.best(True), 100.0)
+    eq_(snap.asks, ((101.0, 3),))
+
+
+def test_chase_price():
+    depth_books.clear()
+    strategy = BaseStrategy('chase', None, None)
+    inst = Instrument(secid='XX1505')
+    depth_books.book('XX1505').replace([(99.0, 1)], [(101.0, 1), (102.0, 1), (110.0, 5)])
+    eq_(strategy.chase_price(inst, True, 1, 100.0, 1.0), 101.0)
+    # the move is capped at chase_steps * step
+    eq_(strategy.chase_price(inst, True, 3, 100.0, 1.0), 103.0)
+    eq_(strategy.chase_price(inst, False, 1, 100.0, 1.0), 99.0)
+
+    # a book that has not been updated recently is ignored
+    strategy.depth_max_age = 0.0
+    eq_(strategy.chase_price(inst, True, 1, 100.0, 1.0), 101.0)
+    eq_(strategy.chase_price(inst, True, 3, 100.0, 0.5), 100.5)
+    depth_books.clear()
@@ -0,0 +1,108 @@
+import threading
+from datetime import datetime
+
+import redisco
+from nose.tools import eq_, with_setup
+
+from ..models import Instrument, Account, Order
+from ..eventloop import EventLoop, GatewayAdapter, TraderLoop
+from .utils import TestTrader
+
+
+def setup_func():
+    Instrument.objects.create(secid='XX1505', name='XX1505', symbol='XX1505', quoted_currency='CNY', multiplier=1.0)
+
+def teardown_func():
+    Instrument.objects.filter(secid='XX1505').first().delete()
+    a = Account.objects.filter(code='loop').first()
+    for o in a.orders:
+        o.delete()
+    a.delete()
+
+
+def test_tasks():
+    loop = EventLoop()
+    events = []
+
+    def worker():
+        yield 0.01
+        events.append('slept')
+        result = yield loop.run_in_executor(lambda x: x * 2, 21)
+        events.append(result)
+
+    handle = loop.call_every(0.001, events.append, 'tick')
+    loop.run_until_complete(loop.spawn(worker()), timeout=5)
+    handle.cancel()
+    eq_([e for e in events if e != 'tick'], ['slept', 42])
+    assert 'tick' in events
+
+
+def test_executor_future_resolves_on_loop():
+    loop = EventLoop()
+    threads = []
+    future = loop.run_in_executor(lambda: threading.current_thread())
+    future.add_done_callback(lambda f: threads.append(threading.current_thread()))
+    worker = loop.run_until_complete(future, timeout=5)
+    assert worker is not threading.current_thread()
+    loop.run_once()
+    eq_(threads, [threading.current_thread()])
+
+
+def test_gateway_retry_gives_up():
+    class Trader(object):
+        calls = 0
+
+        def on_trade(self, *args):
+            self.calls += 1
+            return False
+
+    loop = EventLoop()
+    trader = Trader()
+    gateway = GatewayAdapter(loop, trader, retry_interval=0.001, retry_timeout=0.05)
+    gateway.on_trade('EXEC1')
+    for i in range(200):
+        loop.run_once()
+        if not loop.timers:
+            break
+    assert not loop.timers      # dropped instead of retrying forever
+    assert trader.calls > 1
+
+
+@with_setup(setup_func, teardown_func)
+def test_trader_loop():
+    loop = EventLoop()
+    trader = TestTrader('loop', 'loop', 'CNY', 'XX1505:100')
+    trader.set_monitors(publish=False)
+    trader.is_logged = trader.is_ready = True
+    trader_loop = TraderLoop(loop, trader, limit_timeout=10)
+    assert not hasattr(trader_loop, 'untraded_checker')
+    inst = Instrument.objects.filter(secid='XX1505').first()
+    order = trader.open_order(inst, 0.0, 1, True, 'anna1')
+
+    # gateway callbacks arrive on another thread and run on the loop
+    gateway = GatewayAdapter(loop, trader)
+    t = threading.Thread(target=lambda: (
+        gateway.on_new_order(order.local_id, 'XX1505', 'ORDER1', True, 0.0, 1, datetime.now()),
+        gateway.on_trade('EXEC1', 'XX1505', 'ORDER1', 5000, 1, datetime.now())))
+    t.start()
+    t.join()
+    for i in range(10):
+        loop.run_once()
+    eq_(Order.objects.get_by_id(order.id).stoploss, 4900)
+
+    db = redisco.get_client()
+    db.hset('current_price', 'XX1505', 4890)
+    db.publish('checkstop', 'XX1505')
+    for i in range(50):
+        loop.run_once()
+        if Order.objects.get_by_id(order.id).status == Order.OS_CLOSING:
+            break
+    eq_(Order.objects.get_by_id(order.id).status, Order.OS_CLOSING)
+    loop.stop()
+    loop.run()
+
+    # an error in the stop check is logged and does not reach run_once
+    def fail(*args):
+        raise ValueError('boom')
+    trader_loop.stop_checker.prepare = fail
+    trader_loop.on_checkstop('XX1505')
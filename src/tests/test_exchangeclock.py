@@ -0,0 +1,57 @@
+import datetime
+import threading
+
+import numpy as np
+from nose.tools import eq_, with_setup
+
+from ..utils import ExchangeClock, rdb
+
+
+def teardown_func():
+    rdb.hdel(ExchangeClock.KEY, 'XXEX')
+
+
+@with_setup(teardown=teardown_func)
+def test_offset_cache():
+    clock = ExchangeClock(ttl=60)
+    clock.set_offset('XXEX', 1.5)
+    eq_(clock.offset('XXEX'), 1.5)
+    rdb.hset(ExchangeClock.KEY, 'XXEX', 3.0)
+    eq_(clock.offset('XXEX'), 1.5)     # cached
+    clock.invalidate('XXEX')
+    eq_(clock.offset('XXEX'), 3.0)
+    eq_(clock.offset('NOSUCHEX'), 0.0)
+    t = datetime.datetime(2015, 5, 1, 9, 0, 0)
+    eq_(clock.convert('XXEX', t), datetime.datetime(2015, 5, 1, 9, 0, 3))
+    assert abs((clock.now('XXEX') - datetime.datetime.now()).total_seconds() - 3.0) < 0.1
+
+
+@with_setup(teardown=teardown_func)
+def test_convert_array():
+    clock = ExchangeClock(ttl=60)
+    clock.set_offset('XXEX', -0.25)
+    t = [datetime.datetime(2015, 5, 1, 9, 0, 0), datetime.datetime(2015, 5, 1, 9, 0, 1)]
+    result = clock.convert_array('XXEX', t)
+    eq_(list(result), list(np.array(['2015-05-01T08:59:59.750', '2015-05-01T09:00:00.750'], dtype='datetime64[us]')))
+
+
+def test_monotonic():
+    from ..utils import monotonic
+    from time import time
+    assert monotonic is not time
+    t = monotonic()
+    assert monotonic() >= t
+
+
+@with_setup(teardown=teardown_func)
+def test_listener():
+    clock = ExchangeClock(ttl=60, listen=True)
+    eq_(clock.offset('XXEX'), 0.0)
+    assert clock.listener.is_alive()
+    other = ExchangeClock(ttl=60)
+    for i in range(100):    # the listener subscribes asynchronously
+        other.set_offset('XXEX', 2.0)
+        if clock.offset('XXEX') == 2.0:
+            break
+        threading.Event().wait(0.02)
+    eq_(clock.offset('XXEX'), 2.0)
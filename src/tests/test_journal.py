@@ -0,0 +1,130 @@
+import os
+import tempfile
+
+from nose.tools import eq_, with_setup
+
+from .. import journal as journal_module
+from ..journal import Journal, SYNC_ALWAYS
+from ..models import Order, Instrument, Account, Balance
+from ..utils import rdb
+from .utils import TestTrader
+
+path = os.path.join(tempfile.gettempdir(), 'sectradelib-test.journal')
+
+def setup_func():
+    teardown_func()
+
+def teardown_func():
+    journal_module.activate(None)
+    if os.path.exists(path):
+        os.remove(path)
+    rdb.delete('journal:test:applied', 'journal-test')
+
+def crash(journal):
+    # the process dies, leaving the journal file behind
+    journal.fp.close()
+    journal.fp = None
+
+@with_setup(setup_func, teardown_func)
+def test_recover_after_crash():
+    journal = Journal(path, 'test', sync=SYNC_ALWAYS)
+    journal.open()
+    pipeline = journal.pipeline()
+    pipeline.hset('journal-test', 'a', 1)
+    pipeline.hset('journal-test', 'b', 2)
+    eq_(pipeline.execute(), 1)
+    journal.append('fill', ['1', 'EXEC1', 5000.0, 1.0])
+    journal.append('redis', [['hset', 'journal-test', 'a', 3]])
+    assert journal.is_dirty('journal-test')
+    crash(journal)
+    # the process dies before the background writer runs
+    eq_(rdb.hgetall('journal-test'), {})
+
+    journal = Journal(path, 'test')
+    eq_(journal.recover(), 2)
+    eq_(rdb.hgetall('journal-test'), {'a': '3', 'b': '2'})
+    eq_(journal.applied_seq(), 3)
+    eq_(journal.seq, 3)
+    assert not journal.is_dirty('journal-test')
+    eq_([kind for seq, kind, data in journal.read()], ['redis', 'fill', 'redis'])
+    eq_(Journal(path, 'test').recover(), 0)
+
+@with_setup(setup_func, teardown_func)
+def test_torn_record():
+    journal = Journal(path, 'test', sync=SYNC_ALWAYS)
+    journal.open()
+    journal.append('redis', [['hset', 'journal-test', 'a', 1]])
+    size = journal.fp.tell()
+    journal.append('redis', [['hset', 'journal-test', 'a', 2]])
+    crash(journal)
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 3)
+    journal = Journal(path, 'test')
+    eq_(journal.recover(), 1)
+    eq_(rdb.hget('journal-test', 'a'), '1')
+    eq_(os.path.getsize(path), size)
+
+@with_setup(setup_func, teardown_func)
+def test_order_status_through_journal():
+    order = Order(local_id='LOCALJ1')
+    order.save()
+    journal = Journal(path, 'test')
+    journal.open()
+    journal_module.activate(journal)
+    order.update_status(Order.OS_NEW)
+    order.update_float_value('stoploss', 4900)
+    eq_(order.status, Order.OS_NEW)
+    # nothing reached redis yet, but this process reads its own writes
+    eq_(journal.applied_seq(), 0)
+    eq_(rdb.hget(order.key(), 'status'), str(Order.OS_NONE))
+    order2 = Order.objects.get_by_id(order.id)
+    eq_(order2.status, Order.OS_NEW)
+    eq_(order2.stoploss, 4900)
+    # queries computed in redis flush the model's pending writes first
+    eq_(len(Order.objects.filter(status=Order.OS_NEW).filter(local_id='LOCALJ1')), 1)
+    eq_(journal.applied_seq(), 2)
+    eq_([kind for seq, kind, data in journal.read()], ['redis', 'redis'])
+    journal_module.activate(None)
+    journal.close()
+    order.delete()
+
+
+def setup_trader():
+    setup_func()
+    Instrument.objects.create(secid='XX1505', name='XX1505', symbol='XX1505', quoted_currency='CNY',
+                              multiplier=10.0, long_margin_ratio=0.1, short_margin_ratio=0.1)
+
+def teardown_trader():
+    teardown_func()
+    Instrument.objects.filter(secid='XX1505').first().delete()
+    a = Account.objects.filter(code='journal').first()
+    for o in a.orders:
+        o.delete()
+    a.delete()
+
+@with_setup(setup_trader, teardown_trader)
+def test_callback_does_not_touch_redis():
+    trader = TestTrader('journal', 'journal', 'CNY', 'XX1505:100')
+    trader.is_logged = trader.is_ready = True
+    inst = Instrument.objects.filter(secid='XX1505').first()
+    order = trader.open_order(inst, 0.0, 1, True, 'anna1')
+    journal = Journal(path, 'test')
+    journal.open()
+    journal_module.activate(journal)
+    stored = rdb.hgetall(order.key())
+    balance = trader.account.balances[0]
+    value = rdb.hget(balance.key(), 'value')
+
+    trader.on_cancel(order.local_id)
+    trader.account.deposit(100)
+    eq_(rdb.hgetall(order.key()), stored)
+    eq_(rdb.hget(balance.key(), 'value'), value)
+    eq_(Order.objects.get_by_id(order.id).status, Order.OS_CANCELED)
+    eq_(Balance.objects.get_by_id(balance.id).value, float(value) + 100)
+    eq_(journal.applied_seq(), 0)
+
+    journal.flush()
+    eq_(rdb.hget(order.key(), 'status'), str(Order.OS_CANCELED))
+    eq_(float(rdb.hget(balance.key(), 'value')), float(value) + 100)
+    journal_module.activate(None)
+    journal.close()
@@ -0,0 +1,60 @@
+from nose.tools import eq_, with_setup
+
+from ..models import Instrument, Account, Order
+from ..matching import MatchingEngine, MatchingTrader, OrderBook, BookOrder
+
+
+def setup_func():
+    Instrument.objects.create(secid='XX1505', name='XX1505', symbol='XX1505', quoted_currency='CNY', multiplier=1.0)
+
+def teardown_func():
+    Instrument.objects.filter(secid='XX1505').first().delete()
+    a = Account.objects.filter(code='matching').first()
+    for o in a.orders:
+        o.delete()
+    a.delete()
+
+
+def test_price_time_priority():
+    book = OrderBook('XX1505')
+    for local_id, price in [('A', 101.0), ('B', 101.0), ('C', 100.0)]:
+        book.add(BookOrder(local_id, local_id, 'XX1505', price, 2, False, None))
+    eq_(book.best_ask(), 100.0)
+    fills = book.match(BookOrder('X', 'X', 'XX1505', 101.0, 5, True, None))
+    eq_([(o.local_id, p, v) for o, p, v in fills], [('C', 100.0, 2), ('A', 101.0, 2), ('B', 101.0, 1)])
+    eq_(book.depth(False, 101.0), 1)
+    eq_(book.match(BookOrder('Y', 'Y', 'XX1505', 100.5, 1, True, None)), [])
+
+
+@with_setup(setup_func, teardown_func)
+def test_trader_callbacks():
+    engine = MatchingEngine()
+    trader = MatchingTrader(engine, 'matching', 'matching', 'CNY', 'XX1505:100')
+    trader.set_monitors(publish=False)
+    inst = Instrument.objects.filter(secid='XX1505').first()
+    engine.quote('XX1505', 0, 4999.0, 1)
+
+    # partial fill, then cancel the rest
+    order = trader.open_order(inst, 5000.0, 2, True, 'anna1')
+    engine.dispatch()
+    order = Order.objects.get_by_id(order.id)
+    eq_(order.status, Order.OS_FILLED)
+    eq_(order.filled_volume, 1)
+    eq_(trader.cancel_orders([order]), [order])
+    engine.dispatch()
+    order = Order.objects.get_by_id(order.id)
+    eq_(order.volume, 1)
+    eq_(order.stoploss, 4899)
+
+    # cancel race: filled before the fill is reported, so the cancel finds nothing
+    close = trader.close_order(order, 4990.0)
+    engine.submit('XX1505', 4995.0, 1, True)
+    eq_(trader.cancel_orders([close]), [])
+    engine.dispatch()
+    eq_(Order.objects.get_by_id(order.id).status, Order.OS_CLOSED)
+
+    engine.halt('XX1505')
+    rejected = trader.open_order(inst, 5000.0, 1, True, 'anna1')
+    engine.dispatch()
+    eq_(Order.objects.get_by_id(rejected.id).status, Order.OS_REJECTED)
+    eq_(engine.stats['rejects'], 1)
@@ -0,0 +1,63 @@
+import json
+import urllib2
+from datetime import datetime
+
+from nose.tools import eq_, with_setup
+
+from ..models import Instrument, Account
+from ..quoteservice import QuoteService, TickObject
+from ..backtest import ReplayMarketDataApi
+from ..strategy import CheckStopThread
+from ..metrics import Histogram, metrics
+from .utils import TestTrader
+
+
+def setup_func():
+    Instrument.objects.create(secid='XX1505', name='XX1505', symbol='XX1505', quoted_currency='CNY', multiplier=1.0)
+
+def teardown_func():
+    metrics.disable()
+    metrics.stop()
+    metrics.reset()
+    Instrument.objects.filter(secid='XX1505').first().delete()
+    a = Account.objects.filter(code='metrics').first()
+    for o in a.orders:
+        o.delete()
+    a.delete()
+
+
+def test_histogram():
+    h = Histogram()
+    for v in range(1, 1001):
+        h.record(v)
+    assert 500 <= h.percentile(50) <= 500 * 1.04
+    assert 980 <= h.percentile(99) <= 1000 * 1.04
+    eq_(h.percentile(100), 1000)
+    for v in (31, 32, 63, 64, 1000, 123456):
+        assert Histogram.upper_bound(Histogram.index(v)) >= v
+        assert Histogram.upper_bound(Histogram.index(v)) <= v * 1.04
+
+
+@with_setup(setup_func, teardown_func)
+def test_stages():
+    metrics.enable()
+    trader = TestTrader('metrics', 'metrics', 'CNY', 'XX1505:100')
+    trader.set_monitors(publish=False)
+    inst = Instrument.objects.filter(secid='XX1505').first()
+    order = trader.open_order(inst, 0.0, 1, True, 'anna1')
+    trader.on_new_order(order.local_id, 'XX1505', 'ORDER1', True, 0.0, 1, datetime.now())
+    trader.on_trade('EXEC1', 'XX1505', 'ORDER1', 5000, 1, datetime.now())
+
+    mdapi = ReplayMarketDataApi(QuoteService(), [], 10)
+    mdapi.process_tick(TickObject(securityID='XX1505', entry_time=datetime.now(), price=4890,
+                                  b_price=4889, s_price=4891, volume=1))
+    CheckStopThread(trader).check(inst, 4890)
+    close = trader.account.orders.filter(is_open=False).first()
+    trader.on_new_order(close.local_id, 'XX1505', 'ORDER2', False, 0.0, 1, datetime.now())
+    trader.on_trade('EXEC2', 'XX1505', 'ORDER2', 4890, 1, datetime.now())
+
+    port = metrics.start_server()
+    snapshot = json.load(urllib2.urlopen('http://127.0.0.1:{0}/metrics'.format(port)))
+    for stage in ('tick_publish', 'tick_check', 'stop_check', 'tick_submit', 'submit_fill', 'redis:hset'):
+        assert snapshot[stage]['count'] >= 1, stage
+    eq_(snapshot['submit_fill']['count'], 1)
@@ -0,0 +1,58 @@
+from datetime import datetime
+
+from nose.tools import eq_
+
+from ..models import Account, Order, OrderIndex, Trade, order_index
+
+
+def test_lookup():
+    order = Order(local_id='LOCALX1')
+    order.save()
+    eq_(order_index.get_by_local_id('LOCALX1'), order)
+    order.update_sys_id('SYSX1')
+    assert order_index.has_sys_id('SYSX1')
+    eq_(order_index.get_by_sys_id('SYSX1'), order)
+    order.update_local_id('LOCALX2')
+    eq_(order_index.get_by_local_id('LOCALX2'), order)
+    assert 'LOCALX1' not in order_index.by_local_id
+    order.delete()
+    assert not order_index.has_sys_id('SYSX1')
+    assert order_index.get_by_local_id('LOCALX2') is None
+
+
+def test_bounded_exec_ids():
+    index = OrderIndex(max_exec_ids=2)
+    index.mark_loaded()
+    index.add_exec_id('EXEC1')
+    index.add_exec_id('EXEC2')
+    assert index.exec_ids_complete
+    assert not index.has_exec_id('EXEC3')
+    index.add_exec_id('EXEC3')
+    eq_(list(index.exec_ids), ['EXEC2', 'EXEC3'])
+    assert not index.exec_ids_complete
+    assert index.has_exec_id('EXEC3')
+    assert not index.has_exec_id('EXEC1')     # falls back to redis
+
+
+def test_load_per_account():
+    accounts = [Account.objects.get_or_create(code=code, default_currency='CNY') for code in ('idx1', 'idx2')]
+    for n, account in enumerate(accounts):
+        order = Order(local_id='LOADL{0}'.format(n), sys_id='LOADS{0}'.format(n), account=account)
+        order.save()
+        Trade(order=order, exec_id='LOADE{0}'.format(n), trade_time=datetime.now(), price=1.0, volume=1.0).save()
+    index = OrderIndex()
+    index.load(accounts[0])
+    eq_(index.by_local_id, {'LOADL0': accounts[0].orders.first().id})
+    eq_(index.by_sys_id, {'LOADS0': accounts[0].orders.first().id})
+    eq_(list(index.exec_ids), ['LOADE0'])
+    assert not index.has_exec_id('LOADE1', accounts[0].id)
+    assert index.has_exec_id('LOADE1', accounts[1].id)      # not loaded: falls back to redis
+    assert index.has_exec_id('LOADE1')
+    eq_(index.get_by_sys_id('LOADS1', accounts[0].id), None)
+    eq_(index.get_by_sys_id('LOADS1', accounts[1].id), accounts[1].orders.first())
+    for account in accounts:
+        for order in account.orders:
+            for trade in order.trades:
+                trade.delete()
+            order.delete()
+        account.delete()
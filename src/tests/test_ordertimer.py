@@ -0,0 +1,139 @@
+from time import time
+from datetime import datetime
+
+from nose.tools import eq_, with_setup
+
+from ..models import Instrument, Account, Order
+from ..strategy import OrderTimeoutThread
+from .utils import TestTrader, count
+
+
+class DummyTrader(object):
+    name = 'test'
+    order_timer = None
+
+
+class DummyOrder(object):
+    def __init__(self, id):
+        self.id = id
+
+
+def test_deadline_order():
+    trader = DummyTrader()
+    timer = OrderTimeoutThread(trader, 10)
+    eq_(trader.order_timer, timer)
+    now = time()
+    timer.schedule('2', timer.EV_QUERY, now - 1)
+    timer.schedule('1', timer.EV_TIMEOUT, now - 2)
+    timer.schedule('3', timer.EV_TIMEOUT, now + 60)
+    eq_(timer.pop_due(0), ('1', timer.EV_TIMEOUT))
+    eq_(timer.pop_due(0), ('2', timer.EV_QUERY))
+    eq_(timer.pop_due(0), None)
+
+
+def test_remove_and_reschedule():
+    trader = DummyTrader()
+    timer = OrderTimeoutThread(trader, 10)
+    now = time()
+    timer.schedule('1', timer.EV_TIMEOUT, now - 1)
+    timer.schedule('1', timer.EV_QUERY, now - 1)
+    timer.schedule('1', timer.EV_REPLACE, now - 1)
+    timer.remove(DummyOrder('1'))
+    eq_(timer.pop_due(0), ('1', timer.EV_REPLACE))
+    eq_(timer.pop_due(0), None)
+    timer.schedule('2', timer.EV_QUERY, now - 1)
+    timer.touch(DummyOrder('2'))
+    eq_(timer.pop_due(0), None)
+    eq_(timer.deadlines.keys(), [('2', timer.EV_QUERY)])
+
+
+class TimerTrader(TestTrader):
+    """ cancels are confirmed by the gateway right away """
+    def __init__(self, *args):
+        super(TimerTrader, self).__init__(*args)
+        self.is_logged = self.is_ready = True
+        self.cancelled = []
+        self.queried = []
+
+    def open_limit_order(self, inst, price, volume, direction):
+        return 'LOCAL{0}'.format(count.next())
+
+    def close_limit_order(self, order, price, volume):
+        return 'LOCAL{0}'.format(count.next())
+
+    def cancel_orders(self, orders):
+        for order in orders:
+            self.cancelled.append(order.id)
+            self.on_cancel(order.local_id)
+        return [order.sys_id for order in orders]
+
+    def query_order_status(self, order):
+        self.queried.append(order.id)
+
+
+def setup_func():
+    Instrument.objects.create(secid='XX1505', name='XX1505', symbol='XX1505', quoted_currency='CNY',
+                              multiplier=10.0, long_margin_ratio=0.1, short_margin_ratio=0.1)
+
+def teardown_func():
+    Instrument.objects.filter(secid='XX1505').first().delete()
+    a = Account.objects.filter(code='timer').first()
+    for o in a.orders:
+        o.delete()
+    a.delete()
+
+
+def events(timer, order):
+    return sorted(event for order_id, event in timer.deadlines if order_id == order.id)
+
+
+@with_setup(setup_func, teardown_func)
+def test_trader_callbacks():
+    trader = TimerTrader('timer', 'timer', 'CNY', 'XX1505:100')
+    timer = OrderTimeoutThread(trader, 10, cancel_wait_time=0)
+    inst = Instrument.objects.filter(secid='XX1505').first()
+
+    # a new limit order gets a timeout and a status query
+    order = trader.open_order(inst, 5000.0, 2, True, 'anna1')
+    trader.on_new_order(order.local_id, 'XX1505', 'TIMER1', True, 5000.0, 2, datetime.now())
+    eq_(events(timer, order), [timer.EV_TIMEOUT, timer.EV_QUERY])
+    query_at = timer.deadlines[(order.id, timer.EV_QUERY)]
+
+    # a partial fill postpones the query
+    trader.on_trade('TIMEREXEC1', 'XX1505', 'TIMER1', 5000.0, 1, datetime.now())
+    assert timer.deadlines[(order.id, timer.EV_QUERY)] >= query_at
+    timer.fire(order.id, timer.EV_QUERY)
+    eq_(trader.queried, [order.id])
+    eq_(events(timer, order), [timer.EV_TIMEOUT, timer.EV_QUERY])
+
+    # the timeout cancels the rest, and the cancel clears the timers
+    timer.fire(order.id, timer.EV_TIMEOUT)
+    eq_(trader.cancelled, [order.id])
+    eq_(events(timer, order), [])
+    order = Order.objects.get_by_id(order.id)
+    eq_(order.volume, 1)
+
+    # a limit close order that times out is replaced by a market close order
+    close = trader.close_order(order, 5100.0)
+    trader.on_new_order(close.local_id, 'XX1505', 'TIMER2', False, 5100.0, 1, datetime.now())
+    eq_(events(timer, close), [timer.EV_TIMEOUT, timer.EV_QUERY])
+    timer.fire(close.id, timer.EV_TIMEOUT)
+    eq_(events(timer, close), [timer.EV_REPLACE])
+    eq_(Order.objects.get_by_id(close.id).status, Order.OS_CANCELED)
+    closes = len(Order.objects.filter(account_id=trader.account.id, is_open=False))
+    timer.fire(*timer.pop_due(0))
+    eq_(len(Order.objects.filter(account_id=trader.account.id, is_open=False)), closes + 1)
+
+    # a rejected order is removed
+    order = trader.open_order(inst, 5000.0, 1, True, 'anna1')
+    trader.on_new_order(order.local_id, 'XX1505', 'TIMER3', True, 5000.0, 1, datetime.now())
+    eq_(events(timer, order), [timer.EV_TIMEOUT, timer.EV_QUERY])
+    trader.on_reject(order.local_id, 1, 'rejected')
+    eq_(events(timer, order), [])
+
+    # a filled order is removed
+    order = trader.open_order(inst, 0.0, 1, True, 'anna1')
+    trader.on_new_order(order.local_id, 'XX1505', 'TIMER4', True, 0.0, 1, datetime.now())
+    eq_(events(timer, order), [timer.EV_QUERY])
+    trader.on_trade('TIMEREXEC2', 'XX1505', 'TIMER4', 5000.0, 1, datetime.now())
+    eq_(events(timer, order), [])
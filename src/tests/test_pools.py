@@ -0,0 +1,134 @@
+import os
+import time
+
+import redis
+from nose.tools import eq_, raises
+
+from .. import storage, marketdata, trader
+from ..metrics import Metrics
+
+
+class DummyConnection(object):
+    description_format = 'DummyConnection'
+    pings = 0
+
+    def __init__(self, **kwargs):
+        self.pid = os.getpid()
+        self.kwargs = kwargs
+
+    def send_command(self, *args):
+        DummyConnection.pings += 1
+
+    def read_response(self):
+        raise redis.ConnectionError('gone')
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+def make_pool(**kwargs):
+    pool = storage.InstrumentedPool(connection_class=DummyConnection, max_connections=2, timeout=0.05, **kwargs)
+    return pool
+
+
+def test_usage():
+    pool = make_pool()
+    c1 = pool.get_connection('GET')
+    c2 = pool.get_connection('GET')
+    eq_(pool.usage()['in_use'], 2)
+    pool.release(c1)
+    c3 = pool.get_connection('GET')
+    assert c3 is c1
+    pool.release(c2)
+    pool.release(c3)
+    usage = pool.usage()
+    eq_(usage['checkouts'], 3)
+    eq_(usage['in_use'], 0)
+    eq_(usage['peak'], 2)
+    eq_(usage['max_connections'], 2)
+
+
+@raises(redis.ConnectionError)
+def test_timeout():
+    pool = make_pool()
+    pool.get_connection('GET')
+    pool.get_connection('GET')
+    try:
+        pool.get_connection('GET')
+    finally:
+        eq_(pool.usage()['timeouts'], 1)
+
+
+def test_health_check():
+    pool = make_pool(health_check_interval=0.01)
+    c = pool.get_connection('GET')
+    pool.release(c)
+    c.last_used = time.time() - 1
+    assert pool.get_connection('GET') is c
+    eq_(DummyConnection.pings, 1)
+    assert c.disconnected
+    eq_(pool.usage()['reconnects'], 1)
+
+
+def test_roles():
+    client = storage.get_client('model')
+    storage.clients['tick'] = storage.MemoryRedis()
+    try:
+        eq_(storage.get_client('tick'), storage.clients['tick'])
+        eq_(storage.get_client('pubsub'), client)
+        # module rdb proxies follow the current clients without rebinding
+        marketdata.rdb.set('roles', 'tick')
+        trader.rdb.set('roles', 'model')
+        eq_(storage.clients['tick'].get('roles'), 'tick')
+        eq_(client.get('roles'), 'model')
+    finally:
+        storage.clients.clear()
+        client.delete('roles')
+    saved = storage.current_backend()
+    try:
+        storage.use_backend('memory')
+        assert isinstance(marketdata.rdb, storage.LazyClient)
+        assert isinstance(trader.rdb, storage.LazyClient)
+    finally:
+        storage.restore_backend(saved)
+
+
+def test_lazy_client():
+    rdb = storage.lazy_client('tick')
+    storage.clients['tick'] = storage.MemoryRedis()
+    try:
+        rdb.hset('current_price', 'XX1505', 5000)
+        eq_(storage.clients['tick'].hget('current_price', 'XX1505'), '5000')
+    finally:
+        storage.clients.clear()
+
+
+def test_subscriber_pool():
+    saved = storage.current_backend()
+    try:
+        clients = storage.configure_pools(host='localhost', port=6379)
+        pool = clients['pubsub'].connection_pool
+        assert isinstance(pool, storage.SubscriberPool)
+        eq_(pool.usage()['max_connections'], None)
+        eq_(clients['model'].connection_pool.usage()['max_connections'], 16)
+    finally:
+        storage.restore_backend(saved)
+
+
+def test_instrument_all_roles():
+    saved = storage.current_backend()
+    for role in storage.ROLES:
+        storage.clients[role] = storage.MemoryRedis()
+    metrics = Metrics()
+    try:
+        eq_(len(storage.all_clients()), 3)
+        metrics.enable()
+        storage.get_client('tick').hset('current_price', 'XX1505', 5000)
+        storage.get_client('pubsub').publish('checkstop', 'XX1505')
+        snapshot = metrics.snapshot()
+        eq_(snapshot['redis:hset']['count'], 1)
+        eq_(snapshot['redis:publish']['count'], 1)
+    finally:
+        metrics.disable()
+        storage.restore_backend(saved)
+    assert 'execute_command' not in storage.MemoryRedis().__dict__
@@ -0,0 +1,48 @@
+from datetime import datetime
+
+from nose.tools import eq_, with_setup
+
+from ..models import Instrument, Account
+from ..strategy import CheckStopThread
+from ..trader import BaseTrader
+from ..profiler import RedisProfiler
+from .utils import TestTrader
+
+
+def setup_func():
+    Instrument.objects.create(secid='XX1505', name='XX1505', symbol='XX1505', quoted_currency='CNY', multiplier=1.0)
+
+def teardown_func():
+    Instrument.objects.filter(secid='XX1505').first().delete()
+    a = Account.objects.filter(code='profiler').first()
+    for o in a.orders:
+        o.delete()
+    a.delete()
+
+
+@with_setup(setup_func, teardown_func)
+def test_profile():
+    trader = TestTrader('profiler', 'profiler', 'CNY', 'XX1505:100')
+    trader.set_monitors(publish=False)
+    inst = Instrument.objects.filter(secid='XX1505').first()
+    profiler = RedisProfiler()
+    on_trade = BaseTrader.__dict__['on_trade']
+    profiler.start()
+    try:
+        for i in range(2):
+            order = trader.open_order(inst, 0.0, 1, True, 'anna1')
+            trader.on_new_order(order.local_id, 'XX1505', 'ORDER{0}'.format(i), True, 0.0, 1, datetime.now())
+            trader.on_trade('EXEC{0}'.format(i), 'XX1505', 'ORDER{0}'.format(i), 5000, 1, datetime.now())
+        CheckStopThread(trader).check(inst, 4950)
+    finally:
+        profiler.stop()
+    assert BaseTrader.__dict__['on_trade'] is on_trade
+    eq_(profiler.entries['BaseTrader.on_trade'].calls, 2)
+    eq_(profiler.entries['CheckStopThread.check'].calls, 1)
+    stats = profiler.entries['BaseTrader.on_trade']
+    assert stats.commands > 2
+    assert stats.duplicates, 'order.trades/instrument lookups repeat inside one callback'
+    assert any(site.startswith('models/') for command, site in stats.sites)
+    report = profiler.report()
+    assert u'BaseTrader.on_trade' in report
+    assert u'\u91cd\u590d' in report     # duplicate query section
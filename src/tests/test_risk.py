@@ -0,0 +1,149 @@
+import threading
+from datetime import datetime
+
+from nose.tools import eq_, with_setup
+
+from ..models import Instrument, Account
+from ..risk import PreTradeRisk, RiskLimit
+from ..utils import rdb
+from .utils import TestTrader
+
+
+class DummyTrader(object):
+    def __init__(self):
+        self.risk = None
+        self.trade_listeners = []
+        self.lock = threading.RLock()
+
+
+class DummyOrder(object):
+    def __init__(self, instrument, strategy_code, local_id=None, is_open=True):
+        self.instrument = instrument
+        self.strategy_code = strategy_code
+        self.local_id = local_id
+        self.is_open = is_open
+
+
+class DummyTrade(object):
+    def __init__(self, price, volume):
+        self.price = price
+        self.volume = volume
+
+
+def make_instrument():
+    return Instrument(secid='XX1505', name='XX1505', symbol='XX-1505', quoted_currency='CNY', multiplier=10.0)
+
+
+def test_position_and_notional_limits():
+    inst = make_instrument()
+    trader = DummyTrader()
+    risk = PreTradeRisk(trader,
+                        account_limit=RiskLimit(max_notional=120000.0),
+                        instrument_limits={'XX-1505': RiskLimit(max_position=3)},
+                        strategy_limits={'anna': RiskLimit(max_position=2)})
+    eq_(trader.risk, risk)
+    eq_(trader.trade_listeners, [risk])
+    assert risk.check(inst, 5000.0, 2, True, 'anna')
+    risk.on_order(None, inst, 2, True, 'anna')      # not sent
+    assert not risk.check(inst, 5000.0, 3, True, 'anna')
+    eq_(risk.rejects['strategy_position'], 1)
+
+    risk.on_trade(DummyOrder(inst, 'anna'), DummyTrade(5000.0, 2))
+    risk.on_trade(DummyOrder(inst, 'bob'), DummyTrade(5000.0, -1))
+    eq_(risk.inst_positions['XX1505'], 1)
+    eq_(risk.gross[('account',)], 1)
+    eq_(risk.gross[('strategy', 'anna')], 2)
+    eq_(risk.gross_notionals[('account',)], 50000.0)
+    assert not risk.check(inst, 0.0, 1, True, 'anna')
+    assert risk.check(inst, 0.0, 1, False, 'anna')
+    risk.on_order(None, inst, 1, False, 'anna')
+    assert not risk.check(inst, 0.0, 2, True, 'bob')
+    eq_(risk.rejects['account_notional'], 1)
+    assert not risk.check(inst, 0.0, 3, True, 'bob')
+    eq_(risk.rejects['instrument_position'], 1)
+    assert risk.check(inst, 0.0, 1, True, 'bob')
+    eq_(risk.rejects['strategy_position'], 2)
+
+
+def test_working_orders():
+    inst = make_instrument()
+    risk = PreTradeRisk(DummyTrader(), strategy_limits={'anna': RiskLimit(max_position=3)})
+    for i in range(3):
+        assert risk.check(inst, 5000.0, 1, True, 'anna')
+        risk.on_order(DummyOrder(inst, 'anna', 'L{0}'.format(i)), inst, 1, True, 'anna')
+    assert not risk.check(inst, 5000.0, 1, True, 'anna')    # nothing filled yet
+
+    risk.on_trade(DummyOrder(inst, 'anna', 'L0'), DummyTrade(5000.0, 1))
+    eq_(risk.positions[('anna', 'XX1505')], 3)
+    risk.on_order_done(DummyOrder(inst, 'anna', 'L1'))
+    eq_(risk.positions[('anna', 'XX1505')], 2)
+    eq_(sorted(risk.working), ['L2'])
+    assert risk.check(inst, 5000.0, 1, True, 'anna')
+
+
+def test_market_order_without_price():
+    inst = make_instrument()
+    risk = PreTradeRisk(DummyTrader(), account_limit=RiskLimit(max_notional=60000.0))
+    rdb.hdel('last_close_price', 'XX1505')
+    assert not risk.check(inst, 0.0, 1, True, 'anna')
+    eq_(risk.rejects['no_price'], 1)
+    rdb.hset('last_close_price', 'XX1505', 5000)
+    try:
+        assert not risk.check(inst, 0.0, 2, True, 'anna')
+        eq_(risk.rejects['account_notional'], 1)
+        assert risk.check(inst, 0.0, 1, True, 'anna')
+    finally:
+        rdb.hdel('last_close_price', 'XX1505')
+
+
+def test_order_rate_limit():
+    inst = make_instrument()
+    risk = PreTradeRisk(DummyTrader(), strategy_limits={'anna': RiskLimit(max_order_rate=2)}, rate_window=60)
+    assert risk.check(inst, 5000.0, 1, True, 'anna')
+    assert risk.check(inst, 5000.0, 1, True, 'anna')
+    assert not risk.check(inst, 5000.0, 1, True, 'anna')
+    assert risk.check(inst, 5000.0, 1, True, 'bob')
+    eq_(risk.rejects, {'strategy_order_rate': 1})
+
+
+def setup_trader():
+    Instrument.objects.create(secid='XX1505', name='XX1505', symbol='XX1505', quoted_currency='CNY',
+                              multiplier=10.0, long_margin_ratio=0.1, short_margin_ratio=0.1)
+
+
+def teardown_trader():
+    Instrument.objects.filter(secid='XX1505').first().delete()
+    a = Account.objects.filter(code='risk').first()
+    for o in a.orders:
+        o.delete()
+    a.delete()
+
+
+@with_setup(setup_trader, teardown_trader)
+def test_fill_before_order_registered():
+    trader = TestTrader('risk', 'risk', 'CNY', 'XX1505:100')
+    risk = PreTradeRisk(trader, strategy_limits={'anna': RiskLimit(max_position=5)})
+    risk.prices['XX1505'] = 5000.0
+    inst = Instrument.objects.filter(secid='XX1505').first()
+    on_order = risk.on_order
+    threads = []
+
+    def deliver_fill(order, *args):
+        # the fill arrives after create_order but before risk registers the order
+        def fill():
+            trader.on_new_order(order.local_id, 'XX1505', 'RISK1', True, 0.0, 2, datetime.now())
+            trader.on_trade('RISKEXEC1', 'XX1505', 'RISK1', 5000.0, 2, datetime.now())
+        t = threading.Thread(target=fill)
+        t.start()
+        t.join(0.2)
+        threads.append(t)
+        on_order(order, *args)
+    risk.on_order = deliver_fill
+
+    order = trader.open_order(inst, 0.0, 2, True, 'anna')
+    risk.on_order = on_order
+    assert order is not None
+    threads[0].join(5)
+    eq_(risk.working, {})
+    eq_(risk.positions[('anna', 'XX1505')], 2)
+    eq_(risk.gross[('strategy', 'anna')], 2)
@@ -0,0 +1,61 @@
+import Queue
+from datetime import datetime
+
+from nose.tools import eq_
+
+from .. import storage
+from ..quoteservice import QuoteService, TickObject
+from ..marketdata import MarketDataApi
+from ..sharding import HashRing, ShardRouter, ShardWorker, checkstop_channel
+
+
+class DummyMarketDataApi(MarketDataApi):
+    def subscribe(self, instruments):
+        pass
+
+
+def test_hash_ring():
+    secids = ['XX{0}'.format(i) for i in range(1000)]
+    ring = HashRing(4)
+    parts = ring.partition(secids)
+    eq_(sum(len(p) for p in parts.values()), 1000)
+    assert min(len(p) for p in parts.values()) > 150
+    eq_([HashRing(4).shard_for(s) for s in secids], [ring.shard_for(s) for s in secids])
+
+    # adding a shard only moves secids to the new shard
+    bigger = HashRing(5)
+    moved = [s for s in secids if bigger.shard_for(s) != ring.shard_for(s)]
+    assert all(bigger.shard_for(s) == 4 for s in moved)
+    assert len(moved) < 350
+
+
+def test_route_ticks():
+    ring = HashRing(2)
+    queues = {0: Queue.Queue(), 1: Queue.Queue()}
+    service = QuoteService()
+    service.shard_router = ShardRouter(ring, queues)
+    api = DummyMarketDataApi(service, [], 60)
+    shard = ring.shard_for('XX1505')
+    ps = storage.pubsub()
+    ps.subscribe(checkstop_channel(shard))
+    global_ps = storage.pubsub()
+    global_ps.subscribe('checkstop')
+    api.process_tick(TickObject(securityID='XX1505', entry_time=datetime(2015, 5, 4, 9), price=5000.0, volume=1))
+
+    item = ps.get_message(timeout=1)
+    while item and item['type'] != 'message':
+        item = ps.get_message(timeout=1)
+    eq_(item['data'], 'XX1505')
+    # funds checks and TraderLoop still listen on the global channel
+    item = global_ps.get_message(timeout=1)
+    while item and item['type'] != 'message':
+        item = global_ps.get_message(timeout=1)
+    eq_(item['data'], 'XX1505')
+    eq_(service.tickdata['XX1505'], [])
+    eq_(queues[1 - shard].qsize(), 0)
+
+    worker = ShardWorker(shard, queues[shard])
+    worker.setup(60)
+    queues[shard].put(None)
+    eq_(worker.poll(0), False)
+    eq_(worker.quote_service.tickdata['XX1505'][0].price, 5000.0)
@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+import redisco
+from nose.tools import eq_, with_setup
+
+from .. import storage
+from ..models import Instrument, Order, order_index
+from ..snapshot import save_snapshot
+from .utils import TestTrader
+
+saved = {}
+
+
+def setup_func():
+    saved['client'] = redisco.connection
+    saved['dir'] = tempfile.mkdtemp()
+    storage.use_backend('memory')
+    Instrument.objects.create(secid='XX1505', name='XX1505', symbol='XX1505', quoted_currency='CNY', multiplier=1.0)
+
+def teardown_func():
+    storage.use_backend(saved.pop('client'))
+    shutil.rmtree(saved.pop('dir'))
+
+
+def make_trader(path=None):
+    trader = TestTrader('snap', 'snap', 'CNY', 'XX1505:100', snapshot_path=path)
+    trader.set_monitors(publish=False)
+    return trader
+
+
+def open_order(trader, n):
+    inst = trader.monitors['XX1505']
+    order = trader.open_order(inst, 0.0, 1, True, 'anna1')
+    trader.on_new_order(order.local_id, 'XX1505', 'SNAP{0}'.format(n), True, 0.0, 1, datetime.now())
+    trader.on_trade('SNAPEXEC{0}'.format(n), 'XX1505', 'SNAP{0}'.format(n), 5000, 1, datetime.now())
+    return order
+
+
+@with_setup(setup_func, teardown_func)
+def test_warm_start():
+    path = os.path.join(saved['dir'], 'snap.json')
+    trader = make_trader()
+    canceled = trader.open_order(trader.monitors['XX1505'], 0.0, 1, True, 'anna1')
+    trader.on_new_order(canceled.local_id, 'XX1505', 'SNAP0', True, 0.0, 1, datetime.now())
+    trader.on_cancel(canceled.local_id)
+    opened = open_order(trader, 1)
+    snapshot = save_snapshot(trader, path)
+    eq_(snapshot['active_orders'], [opened.id])
+    eq_(snapshot['instruments'], {'XX1505': trader.monitors['XX1505'].id})
+
+    # changes after the snapshot are replayed from redis
+    trader.close_order(Order.objects.get_by_id(opened.id))
+    later = open_order(trader, 2)
+
+    order_index.clear()
+    trader = make_trader(path)
+    assert trader.snapshot
+    assert order_index.is_loaded(trader.account.id)
+    eq_(order_index.get_by_sys_id('SNAP0').status, Order.OS_CANCELED)
+    eq_(order_index.get_by_sys_id('SNAP1').status, Order.OS_CLOSING)
+    eq_(order_index.get_by_sys_id('SNAP2'), later)
+    assert order_index.has_exec_id('SNAPEXEC1')
+    assert order_index.has_exec_id('SNAPEXEC2')
+    assert not order_index.has_exec_id('SNAPEXEC3')
+
+
+@with_setup(setup_func, teardown_func)
+def test_stale_snapshot():
+    path = os.path.join(saved['dir'], 'snap.json')
+    open_order(make_trader(), 1)
+    save_snapshot(make_trader(), path)
+    redisco.get_client().flushdb()
+    order_index.clear()
+    Instrument.objects.create(secid='XX1505', name='XX1505', symbol='XX1505', quoted_currency='CNY', multiplier=1.0)
+    eq_(make_trader(path).snapshot, None)
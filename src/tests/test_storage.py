@@ -0,0 +1,82 @@
+from datetime import datetime
+
+import redis
+import redisco
+from nose.tools import assert_raises, eq_, with_setup
+
+from .. import storage
+from ..models import Instrument, Account, Order
+from ..strategy import CheckStopThread
+from .utils import TestTrader
+
+saved = {}
+
+
+def setup_func():
+    saved['client'] = redisco.connection
+    storage.use_backend('memory')
+    Instrument.objects.create(secid='XX1505', name='XX1505', symbol='XX1505', quoted_currency='CNY', multiplier=1.0)
+
+def teardown_func():
+    storage.use_backend(saved.pop('client'))
+
+
+def test_commands():
+    db = storage.MemoryRedis()
+    db.hmset('h', {'a': 1, 'b': 2.5})
+    eq_(db.hgetall('h'), {'a': '1', 'b': '2.5'})
+    eq_(db.hincrby('h', 'a', 2), 3)
+    db.sadd('s1', 1, 2, 3)
+    db.sadd('s2', 2, 3, 4)
+    eq_(db.sinter(['s1', 's2']), set(['2', '3']))
+    db.sdiffstore('s3', ['s1', 's2'])
+    eq_(db.smembers('s3'), set(['1']))
+    db.zadd('z', 'x', 3, 'y', 1, 'z', 2)
+    eq_(db.zrange('z', 0, -1), ['y', 'z', 'x'])
+    eq_(db.zrangebyscore('z', '(1', '+inf'), ['z', 'x'])
+    for i, v in [(1, 'c'), (2, 'a'), (10, 'b')]:
+        db.sadd('ids', i)
+        db.hset('M:{0}'.format(i), 'name', v)
+    eq_(db.sort('ids'), ['1', '2', '10'])
+    db.sort('ids', by='M:*->name', alpha=True, desc=True, store='sorted')
+    eq_(db.lrange('sorted', 0, -1), ['1', '10', '2'])
+    eq_(db.sort('ids', get='M:*->name'), ['c', 'a', 'b'])
+    eq_(db.sort('ids', by='M:*->name', alpha=True, get=['#', 'M:*->name'], groups=True),
+        [('2', 'a'), ('10', 'b'), ('1', 'c')])
+    assert_raises(redis.DataError, db.sort, 'ids', get='#', groups=True)
+    eq_(db.execute_command('HGET', 'M:1', 'name'), 'c')
+    pipe = db.pipeline()
+    pipe.srem('s1', 1).sadd('s1', 5).scard('s1')
+    eq_(pipe.execute(), [1, 1, 3])
+    db.setex('t', 'v', 10)
+    eq_(db.get('t'), 'v')
+    del db['t']
+    assert not db.exists('t')
+    pubsub = db.pubsub()
+    pubsub.subscribe('ch')
+    eq_(db.publish('ch', 1), 1)
+    eq_(pubsub.get_message(ignore_subscribe_messages=True)['data'], '1')
+
+
+@with_setup(setup_func, teardown_func)
+def test_models():
+    assert isinstance(redisco.get_client(), storage.MemoryRedis)
+    trader = TestTrader('memtest', 'memtest', 'CNY', 'XX1505:100')
+    trader.set_monitors(publish=False)
+    inst = Instrument.objects.filter(secid='XX1505').first()
+    order1 = trader.open_order(inst, 0.0, 1, True, 'anna1')
+    trader.on_new_order(order1.local_id, 'XX1505', 'ORDER1', True, 0.0, 1, datetime.now())
+    trader.on_trade('EXEC1', 'XX1505', 'ORDER1', 5000, 1, datetime.now())
+    order1 = Order.objects.get_by_id(order1.id)
+    eq_(order1.status, Order.OS_FILLED)
+    eq_(order1.sys_id, 'ORDER1')
+    eq_(order1.stoploss, 4900)
+    eq_(Order.objects.filter(sys_id='ORDER1').first(), order1)
+    eq_(list(Order.objects.filter(status=Order.OS_NEW)), [])
+    eq_(list(trader.account.orders.filter(status=Order.OS_FILLED)), [order1])
+
+    CheckStopThread(trader).check(inst, 4890)
+    order1 = Order.objects.get_by_id(order1.id)
+    eq_(order1.status, Order.OS_CLOSING)
+    eq_(len(order1.close_orders), 1)
+    eq_(Account.objects.filter(code='memtest').first().id, trader.account.id)
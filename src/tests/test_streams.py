@@ -0,0 +1,154 @@
+from datetime import datetime, timedelta
+
+from nose.tools import eq_
+
+from .. import storage
+from ..quoteservice import TickObject
+from ..streams import TickStream, StreamConsumer, encode_tick
+
+
+def make_ticks(n, secid='XX1505'):
+    start = datetime(2015, 5, 4, 9)
+    return [TickObject(securityID=secid, entry_time=start + timedelta(milliseconds=500 * i), price=5000.0 + i,
+                       volume=1) for i in range(n)]
+
+
+def test_memory_stream_commands():
+    db = storage.MemoryRedis()
+    db.xgroup_create('s', 'g', mkstream=True)
+    first = db.xadd('s', {'a': 1})
+    db.xadd('s', {'a': 2})
+    [[name, entries]] = db.xreadgroup('g', 'c', {'s': '>'}, count=1)
+    eq_(entries, [(first, {'a': '1'})])
+    eq_(db.xpending('s', 'g')['pending'], 1)
+    eq_(db.xreadgroup('g', 'c', {'s': '0'})[0][1][0][0], first)
+    eq_(db.xack('s', 'g', first), 1)
+    eq_(db.xreadgroup('g', 'c', {'s': '>'})[0][1][0][1], {'a': '2'})
+    db.xadd('s', {'a': 3}, maxlen=1)
+    eq_(db.xlen('s'), 1)
+
+
+def test_consume_batches():
+    db = storage.MemoryRedis()
+    stream = TickStream(maxlen=5, max_lag=3, check_every=1, client=db)
+    received = []
+    consumer = StreamConsumer(stream, 'bars', received.append, consumer='c1', count=10)
+    consumer.ensure_group()
+    for tick in make_ticks(3):
+        stream.append(tick)
+    eq_(consumer.poll(), 3)
+    eq_([t.price for t in received[0]], [5000.0, 5001.0, 5002.0])
+    eq_(received[0][0].entry_time, datetime(2015, 5, 4, 9))
+    eq_(db.hget('ticks:acked', 'bars:c1'), '3')
+
+    # a slow consumer loses trimmed ticks and the producer reports the lag and the drops
+    for tick in make_ticks(7):
+        stream.append(tick)
+    eq_(stream.lagging, {'ticks': {'bars': 7}})
+    eq_(stream.dropped['bars'], 2)
+    eq_(consumer.poll(), 5)
+    stream.check_lag('ticks')
+    eq_(stream.lagging, {})
+    eq_(stream.dropped['bars'], 2)
+
+
+def test_consumers_share_a_group():
+    db = storage.MemoryRedis()
+    stream = TickStream(maxlen=100, client=db)
+    first = StreamConsumer(stream, 'bars', lambda ticks: None, consumer='c1', count=1)
+    second = StreamConsumer(stream, 'bars', lambda ticks: None, consumer='c2', count=1)
+    first.ensure_group()
+    for tick in make_ticks(4):
+        stream.append(tick)
+    for i in range(2):
+        eq_(first.poll(), 1)
+        eq_(second.poll(), 1)
+    eq_(db.hgetall('ticks:acked'), {'bars:c1': '3', 'bars:c2': '4'})
+    eq_(stream.check_lag('ticks'), {})
+    eq_(stream.dropped['bars'], 0)
+    eq_(first.dropped + second.dropped, 0)
+
+
+def test_producer_restart_keeps_seq():
+    db = storage.MemoryRedis()
+    stream = TickStream(maxlen=3, max_lag=1, check_every=1, client=db)
+    consumer = StreamConsumer(stream, 'bars', lambda ticks: None, consumer='c1')
+    consumer.ensure_group()
+    for tick in make_ticks(3):
+        stream.append(tick)
+    eq_(consumer.poll(), 3)
+    eq_(db.xrevrange('ticks', count=1)[0][1]['seq'], '3')
+
+    # a restarted producer continues after the last entry in the stream
+    stream = TickStream(maxlen=3, max_lag=1, check_every=1, client=db)
+    for tick in make_ticks(2):
+        stream.append(tick)
+    eq_(stream.seqs['ticks'], 5)
+    eq_(stream.lagging, {'ticks': {'bars': 2}})
+    eq_(consumer.poll(), 2)
+    eq_(db.hget('ticks:acked', 'bars:c1'), '5')
+    eq_(stream.check_lag('ticks'), {})
+
+
+def test_failed_batch_is_redelivered():
+    db = storage.MemoryRedis()
+    stream = TickStream(client=db)
+    batches = []
+
+    def handler(ticks):
+        batches.append(ticks)
+        if len(batches) == 1:
+            raise ValueError('boom')
+
+    consumer = StreamConsumer(stream, 'checkstop', handler, consumer='c1')
+    consumer.ensure_group()
+    for tick in make_ticks(2):
+        stream.append(tick)
+    eq_(consumer.poll(), 0)
+    eq_(consumer.failures, 1)
+    eq_(consumer.recover(), 2)
+    eq_(len(batches[1]), 2)
+    eq_(consumer.failures, 0)
+    eq_(db.xpending('ticks', 'checkstop')['pending'], 0)
+
+
+def test_failing_batch_is_dropped_after_retries():
+    db = storage.MemoryRedis()
+    stream = TickStream(client=db)
+
+    def handler(ticks):
+        raise ValueError('boom')
+
+    consumer = StreamConsumer(stream, 'checkstop', handler, consumer='c1', max_retries=2)
+    consumer.ensure_group()
+    stream.append(make_ticks(1)[0])
+    eq_(consumer.poll(), 0)
+    eq_(consumer.recover(), 1)
+    eq_(consumer.dropped, 1)
+    eq_(db.xpending('ticks', 'checkstop')['pending'], 0)
+
+
+def test_stale_and_trimmed_entries():
+    db = storage.MemoryRedis()
+    stream = TickStream(client=db)
+    received = []
+    consumer = StreamConsumer(stream, 'checkstop', received.extend, consumer='c1', max_age=5)
+    consumer.ensure_group()
+    ticks = make_ticks(2)
+    # written an hour ago, e.g. replayed after a restart
+    db.xadd('ticks', encode_tick(ticks[0], 1), id='1000-0')
+    stream.seqs['ticks'] = 1
+    stream.append(ticks[1])
+    eq_(consumer.poll(), 2)
+    eq_([t.price for t in received], [5001.0])
+    eq_(consumer.skipped, 1)
+
+    # a pending entry trimmed before it was retried is acked and counted
+    failing = StreamConsumer(stream, 'bars', lambda ticks: 1 / 0, consumer='c2')
+    db.xgroup_create('ticks', 'bars', '0')
+    eq_(failing.poll(), 0)
+    db.xadd('ticks', encode_tick(ticks[1], 3), maxlen=1)
+    failing.handler = received.extend
+    eq_(failing.recover(), 2)
+    eq_(failing.dropped, 2)
+    eq_(db.xpending('ticks', 'bars')['pending'], 0)
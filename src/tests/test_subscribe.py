@@ -0,0 +1,65 @@
+import threading
+
+import redisco
+from nose.tools import eq_, with_setup
+
+from .. import storage
+from ..models import Instrument, Product
+from ..quoteservice import QuoteService
+from ..marketdata import MarketDataApi
+
+saved = {}
+
+
+class RecordingMarketDataApi(MarketDataApi):
+    def __init__(self, *args):
+        super(RecordingMarketDataApi, self).__init__(*args)
+        self.calls = []
+
+    def subscribe(self, instruments):
+        self.calls.append(('subscribe', sorted(instruments)))
+
+    def unsubscribe(self, instruments):
+        self.calls.append(('unsubscribe', sorted(instruments)))
+
+
+def setup_func():
+    saved['client'] = redisco.connection
+    storage.use_backend('memory')
+    product = Product.objects.create(prodid='XX')
+    for secid in ('XX1505', 'XX1506'):
+        Instrument.objects.create(secid=secid, name=secid, symbol=secid, product=product, quoted_currency='CNY')
+    for i in range(20):
+        secid = 'YY{0}'.format(i)
+        Instrument.objects.create(secid=secid, name=secid, symbol=secid, quoted_currency='CNY')
+
+def teardown_func():
+    storage.use_backend(saved.pop('client'))
+
+
+@with_setup(setup_func, teardown_func)
+def test_batched_subscribe():
+    service = QuoteService()
+    service.subscribe_window = 0.2
+    api = RecordingMarketDataApi(service, ['XX1505'], 60)
+    t = threading.Thread(target=service.wait_for_subscribe)
+    t.daemon = True
+    t.start()
+    ps = storage.pubsub()
+    ps.subscribe('mdmonitor')      # wait until the service has subscribed as well
+    db = redisco.get_client()
+    while db.publish('mdmonitor', 'YY0') < 2:
+        pass
+    for i in range(1, 20):
+        db.publish('mdmonitor', 'YY{0}'.format(i))
+    db.publish('mdmonitor', 'XX1506')
+    db.publish('mdmonitor', 'YY0')
+    for i in range(100):
+        if len(api.calls) >= 2:
+            break
+        threading.Event().wait(0.02)
+    service.stop()
+    t.join(2)
+    eq_(api.calls[0], ('unsubscribe', ['XX1505']))
+    eq_(api.calls[1], ('subscribe', sorted(['XX1506'] + ['YY{0}'.format(i) for i in range(20)])))
+    eq_(service.subscribed, set(['XX1506'] + ['YY{0}'.format(i) for i in range(20)]))
@@ -0,0 +1,57 @@
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+from nose.tools import eq_, raises, with_setup
+
+from ..models import Instrument
+from ..quoteservice import TickObject
+from ..sweep import SweepRunner, parameter_grid, max_drawdown
+from ..tickarchive import TickArchive
+
+
+def buy_once(engine, trader, inst):
+    def on_tick(tick):
+        if not trader.account.orders:
+            trader.open_order(inst, 0.0, 1, True, 'sweep')
+    return on_tick
+
+
+def setup_func():
+    Instrument.objects.create(secid='XX1505', name='XX1505', symbol='XX1505', quoted_currency='CNY', multiplier=1.0)
+
+def teardown_func():
+    Instrument.objects.filter(secid='XX1505').first().delete()
+
+
+def test_max_drawdown():
+    eq_(max_drawdown([0, 10, 5, 20, 2, 8]), 18)
+    eq_(max_drawdown([]), 0.0)
+    eq_(max_drawdown([-5, -10, -7]), 5)
+
+
+@raises(ValueError)
+def test_redis_needs_dedicated_server():
+    SweepRunner('/nonexistent', buy_once, datetime.now(), datetime.now(), backend='redis')
+
+
+@with_setup(setup_func, teardown_func)
+def test_sweep():
+    root = tempfile.mkdtemp()
+    try:
+        archive = TickArchive(root)
+        start = datetime(2015, 5, 4, 9, 0)
+        for i, p in enumerate([5000, 5010, 5100, 5050, 4990, 4980, 4970]):
+            archive.append(TickObject(securityID='XX1505', entry_time=start + timedelta(seconds=i),
+                                      price=p, b_price=p - 1, s_price=p + 1, volume=1))
+        archive.close()
+        grid = parameter_grid([100, 200], [0])
+        eq_(grid, [(100, 0), (200, 0)])
+        runner = SweepRunner(root, buy_once, start, start + timedelta(days=1), processes=2)
+        results = runner.run(['XX1505'], grid)
+        eq_(list(results.offset_loss), [100, 200])
+        eq_(list(results.ticks), [7, 7])
+        eq_(list(results.real_profit), [-32, 0])    # 200 offset never stops out
+        eq_(list(results.profit), [-32, 4969 - 5011])
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,78 @@
+import shutil
+import threading
+import tempfile
+from datetime import datetime, date
+
+import numpy as np
+from nose.tools import eq_
+
+from ..quoteservice import QuoteService, TickObject
+from ..tickarchive import TickArchive, to_datetime64
+
+
+def make_tick(secid, entry_time, price, volume=1.0):
+    return TickObject(securityID=secid, entry_time=entry_time, price=price, b_price=price - 1, volume=volume)
+
+
+def test_write_and_read():
+    root = tempfile.mkdtemp()
+    try:
+        archive = TickArchive(root)
+        archive.append(make_tick('XX1505', datetime(2015, 5, 4, 9, 0, 1), 5000))
+        archive.append(make_tick('XX1505', datetime(2015, 5, 4, 9, 0, 3), 5001))
+        archive.append(make_tick('XX1505', datetime(2015, 5, 4, 9, 0, 2, 500000), 5002))
+        archive.append(make_tick('XX1505', datetime(2015, 5, 5, 9, 0, 1), 5003))
+        archive.append(make_tick('YY1505', datetime(2015, 5, 4, 9, 0, 1), 100))
+        archive.flush()
+
+        ticks = archive.load('XX1505', date(2015, 5, 4))
+        assert isinstance(ticks, np.memmap)
+        eq_(list(ticks['price']), [5000, 5001, 5002])
+        eq_(list(ticks['b_price']), [4999, 5000, 5001])
+        assert np.isnan(ticks['s_price']).all()
+        eq_(to_datetime64(ticks)[0], np.datetime64('2015-05-04T09:00:01', 'us'))
+
+        ticks = archive.between('XX1505', datetime(2015, 5, 4, 9, 0, 2), datetime(2015, 5, 5, 10, 0))
+        eq_(list(ticks['price']), [5002, 5001, 5003])
+        eq_(len(archive.between('XX1505', datetime(2015, 5, 6), datetime(2015, 5, 7))), 0)
+        eq_(len(archive.load('YY1505', date(2015, 5, 4))), 1)
+
+        # torn record is ignored by the reader and cut off by the next writer
+        archive.close()
+        path = archive.path('XX1505', date(2015, 5, 5))
+        with open(path, 'ab') as f:
+            f.write('\x00' * 7)
+        eq_(len(archive.load('XX1505', date(2015, 5, 5))), 1)
+        archive.append(make_tick('XX1505', datetime(2015, 5, 5, 9, 0, 2), 5004))
+        archive.close()
+        eq_(list(archive.load('XX1505', date(2015, 5, 5))['price']), [5003, 5004])
+
+        # gateway tick objects may carry only the last price
+        class BareTick(object):
+            securityID = 'ZZ1505'
+            entry_time = datetime(2015, 5, 4, 9, 0, 1)
+            price = 10.0
+        archive.append(BareTick())
+        archive.close()
+        ticks = archive.load('ZZ1505', date(2015, 5, 4))
+        eq_(list(ticks['price']), [10.0])
+        assert np.isnan(ticks['b_price']).all() and np.isnan(ticks['volume']).all()
+    finally:
+        shutil.rmtree(root)
+
+
+def test_quote_service_shutdown():
+    root = tempfile.mkdtemp()
+    try:
+        service = QuoteService()
+        service.tick_archive = TickArchive(root)
+        service.tick_archive.append(make_tick('XX1505', datetime(2015, 5, 4, 9, 0, 1), 5000))
+        t = threading.Thread(target=service.run)
+        t.start()
+        service.stop()
+        t.join(5)
+        assert not t.is_alive()
+        eq_(service.tick_archive.files, {})
+        eq_(list(service.tick_archive.load('XX1505', date(2015, 5, 4))['price']), [5000])
+    finally:
+        shutil.rmtree(root)
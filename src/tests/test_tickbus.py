@@ -0,0 +1,96 @@
+import os
+import time
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+from nose.tools import eq_, with_setup
+
+from .. import storage, utils
+from ..quoteservice import TickObject
+from ..tickbus import TickBus, TickBusReader
+
+tmp = {}
+
+
+def setup_func():
+    tmp['dir'] = tempfile.mkdtemp()
+    tmp['path'] = os.path.join(tmp['dir'], 'ticks')
+
+def teardown_func():
+    utils.use_price_source(None)
+    shutil.rmtree(tmp.pop('dir'))
+
+
+def make_tick(i, secid='XX1505'):
+    return TickObject(securityID=secid, entry_time=datetime(2015, 5, 4, 9) + timedelta(milliseconds=500 * i),
+                      price=5000.0 + i, b_price=4999.0 + i, volume=1)
+
+
+@with_setup(setup_func, teardown_func)
+def test_read_ticks():
+    bus = TickBus.create(tmp['path'], capacity=8)
+    reader = TickBusReader(tmp['path'], from_start=True)
+    for i in range(3):
+        bus.write(make_tick(i))
+    ticks = reader.read()
+    eq_([t.price for t in ticks], [5000.0, 5001.0, 5002.0])
+    eq_(ticks[1].entry_time, datetime(2015, 5, 4, 9, 0, 0, 500000))
+    eq_(ticks[0].s_price, None)
+    eq_(reader.read(), [])
+
+    utils.use_price_source(reader)
+    eq_(utils.current_price('XX1505'), 5002.0)
+    eq_(utils.current_price('XX1505', True), 5001.0)
+    bus.write(make_tick(3))
+    eq_(utils.current_price('XX1505'), 5003.0)
+    eq_([t.price for t in reader.read()], [5003.0])
+
+
+@with_setup(setup_func, teardown_func)
+def test_overrun():
+    bus = TickBus.create(tmp['path'], capacity=4)
+    reader = TickBusReader(tmp['path'], from_start=True)
+    for i in range(10):
+        bus.write(make_tick(i))
+    eq_([t.price for t in reader.read()], [5006.0, 5007.0, 5008.0, 5009.0])
+    eq_(reader.overruns, 1)
+
+
+@with_setup(setup_func, teardown_func)
+def test_writer_restart():
+    bus = TickBus.create(tmp['path'], capacity=8)
+    reader = TickBusReader(tmp['path'], from_start=True)
+    for i in range(5):
+        bus.write(make_tick(i))
+    eq_(len(reader.read()), 5)
+    bus.close()
+
+    # the market-data process restarts: same file, seq back to 0, new epoch
+    bus = TickBus.create(tmp['path'], capacity=8)
+    bus.write(make_tick(10))
+    eq_([t.price for t in reader.read()], [5010.0])
+    eq_(reader.resyncs, 1)
+    eq_(reader.current_price('XX1505'), 5010.0)
+
+    # a bus with a different capacity replaces the file, the reader reopens it once it goes stale
+    bus.close()
+    bus = TickBus.create(tmp['path'], capacity=4)
+    reader.stale_after = 0.001
+    time.sleep(0.01)
+    eq_(reader.read(), [])
+    eq_(reader.capacity, 4)
+    bus.write(make_tick(11))
+    eq_([t.price for t in reader.read()], [5011.0])
+
+
+@with_setup(setup_func, teardown_func)
+def test_stale_bus_falls_back_to_redis():
+    bus = TickBus.create(tmp['path'], capacity=8)
+    reader = TickBusReader(tmp['path'], from_start=True, stale_after=0.001)
+    bus.write(make_tick(0))
+    storage.get_client('tick').hset('current_price', 'XX1505', 4000.0)
+    utils.use_price_source(reader)
+    time.sleep(0.01)
+    eq_(reader.current_price('XX1505'), None)
+    eq_(utils.current_price('XX1505'), 4000.0)
@@ -0,0 +1,125 @@
+# coding:utf8
+""" 二进制tick存档。
+每个合约每天一个文件：<root>/<secid>/<YYYYMMDD>.ticks，
+64字节文件头之后是定长记录，读取时用mmap直接映射为numpy结构化数组。 """
+import os
+import io
+import struct
+import logging
+import threading
+import datetime
+
+import numpy as np
+
+from .utils import EPOCH, to_micros, float_or_nan as _float
+
+logger = logging.getLogger(__name__)
+
+MAGIC = 'STCK'
+VERSION = 1
+HEADER = struct.Struct('<4sHHI16s36x')  # magic, version, 记录长度, 日期YYYYMMDD, secid
+TICK_DTYPE = np.dtype([
+    ('entry_time', '<i8'),     # 1970-01-01起的微秒数（本地时间）
+    ('price', '<f8'),
+    ('b_price', '<f8'),
+    ('s_price', '<f8'),
+    ('volume', '<f8'),
+])
+RECORD = struct.Struct('<qdddd')
+
+
+def to_datetime64(ticks):
+    """ 把entry_time列转换为datetime64[us]，不复制数据 """
+    return ticks['entry_time'].view('datetime64[us]')
+
+
+class TickArchive(object):
+    def __init__(self, root, buffer_size=64 * 1024):
+        self.root = root
+        self.buffer_size = buffer_size
+        self.files = {}     # (secid, date) -> file
+        self.lock = threading.Lock()
+
+    def path(self, secid, date):
+        return os.path.join(self.root, secid, '{0:%Y%m%d}.ticks'.format(date))
+
+    def _open(self, secid, date):
+        path = self.path(secid, date)
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        f = io.open(path, 'ab', buffering=self.buffer_size)
+        if f.tell() == 0:
+            f.write(HEADER.pack(MAGIC, VERSION, TICK_DTYPE.itemsize,
+                                int('{0:%Y%m%d}'.format(date)), secid.encode('utf8')))
+        else:
+            # 上次写入中断时可能留下半条记录
+            extra = (f.tell() - HEADER.size) % TICK_DTYPE.itemsize
+            if extra:
+                f.truncate(f.tell() - extra)
+                f.seek(0, io.SEEK_END)
+        return f
+
+    def append(self, tick):
+        """ 由MarketDataApi.process_tick调用，写入缓冲区。接口的tick对象不一定有买卖价和成交量 """
+        entry_time = tick.entry_time
+        record = RECORD.pack(to_micros(entry_time), _float(tick.price), _float(getattr(tick, 'b_price', None)),
+                             _float(getattr(tick, 's_price', None)), _float(getattr(tick, 'volume', None)))
+        key = (tick.securityID, entry_time.date())
+        with self.lock:
+            f = self.files.get(key)
+            if f is None:
+                self._close(tick.securityID)
+                f = self.files[key] = self._open(*key)
+            f.write(record)
+
+    def flush(self):
+        with self.lock:
+            for f in self.files.values():
+                f.flush()
+
+    def close(self, secid=None):
+        """ 关闭指定合约（None表示全部）的文件 """
+        with self.lock:
+            self._close(secid)
+
+    def _close(self, secid):
+        for key in self.files.keys():
+            if secid is None or key[0] == secid:
+                self.files.pop(key).close()
+
+    def load(self, secid, date):
+        """ 返回指定日期的全部tick（只读numpy.memmap），没有数据时返回空数组 """
+        path = self.path(secid, date)
+        if not os.path.exists(path):
+            return np.empty(0, dtype=TICK_DTYPE)
+        with open(path, 'rb') as f:
+            magic, version, recsize, _, _ = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or recsize != TICK_DTYPE.itemsize:
+            raise ValueError(u'{0}不是有效的tick存档文件'.format(path))
+        count = (os.path.getsize(path) - HEADER.size) // recsize
+        if count == 0:
+            return np.empty(0, dtype=TICK_DTYPE)
+        return np.memmap(path, dtype=TICK_DTYPE, mode='r', offset=HEADER.size, shape=(count,))
+
+    def between(self, secid, start, end):
+        """ 返回entry_time在[start, end)之间的tick。
+        只涉及一天时返回映射数组的切片，不复制数据。"""
+        days = []
+        date = start.date()
+        while date <= end.date():
+            ticks = self.load(secid, date)
+            if len(ticks):
+                times = ticks['entry_time']
+                if np.any(times[1:] < times[:-1]):
+                    ticks = ticks[np.argsort(times, kind='mergesort')]
+                    times = ticks['entry_time']
+                lo, hi = np.searchsorted(times, [to_micros(start), to_micros(end)])
+                if hi > lo:
+                    days.append(ticks[lo:hi])
+            date += datetime.timedelta(days=1)
+        if not days:
+            return np.empty(0, dtype=TICK_DTYPE)
+        if len(days) == 1:
+            return days[0]
+        return np.concatenate(days)
@@ -0,0 +1,271 @@
+# coding:utf8
+""" 同一台机器上的共享内存tick总线。
+行情进程（唯一的写入者）把tick写入mmap文件（默认在/dev/shm）里的环形缓冲区，
+同机的止损检查、策略和utils.current_price直接从共享内存读取，不经过Redis。
+
+文件结构：64字节文件头（含已写入的序号、epoch和最后写入时间），之后是capacity个定长槽位。
+每个槽位以版本号开头：写入前置为2*序号-1（奇数，写入中），写完置为2*序号。
+读取者读版本号、复制记录、再读版本号，两次都等于2*序号才有效，否则说明槽位已被覆盖（读取落后太多），
+计入overruns并跳到最早的有效记录；当前价格错过记录时从Redis重新加载。
+
+行情进程重启时create复用同样大小的文件，序号从0开始并增加epoch，读取者发现epoch改变或已写入的序号
+比自己的读取位置小时从第一条记录重新读取；文件被替换（大小不同）时读取者重新打开。
+超过stale_after秒没有写入时current_price返回None，utils.current_price改从Redis读取。
+
+    bus = TickBus.create(capacity=65536)            # 行情进程
+    quote_service.tick_bus = bus
+
+    reader = TickBusReader()                        # 同机的其他进程
+    utils.use_price_source(reader)                  # current_price先读共享内存
+    TickBusConsumer(reader, checker.check_ticks).start()
+"""
+import os
+import mmap
+import struct
+import logging
+import tempfile
+import threading
+from time import sleep, time
+from datetime import timedelta
+
+from . import storage
+from .quoteservice import TickObject
+from .utils import EPOCH, monotonic, to_micros, float_or_nan as _float
+
+logger = logging.getLogger(__name__)
+
+MAGIC = 'TKBS'
+VERSION = 2
+HEADER = struct.Struct('<4sHHI')        # magic, version, 记录长度, 槽位数
+SEQ = struct.Struct('<Q')               # 文件头中已写入的序号
+SEQ_OFFSET = 16
+EPOCH_OFFSET = 24                       # 每次create加1，格式同SEQ
+UPDATED = struct.Struct('<d')           # 最后写入的时间（time()）
+UPDATED_OFFSET = 32
+HEADER_SIZE = 64
+SLOT = struct.Struct('<Q16sqdddd')      # 版本号, secid, entry_time(微秒), price, b_price, s_price, volume
+DEFAULT_PATH = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                            'sectradelib-ticks')
+
+
+def _value(value):
+    return None if value != value else value    # NaN表示没有该字段
+
+
+def _parse(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class TickBus(object):
+    """ 写入端，只能有一个进程写入 """
+
+    def __init__(self, path, buf, capacity):
+        self.path = path
+        self.buf = buf
+        self.capacity = capacity
+        self.seq = SEQ.unpack_from(buf, SEQ_OFFSET)[0]
+
+    @classmethod
+    def create(cls, path=DEFAULT_PATH, capacity=65536):
+        """ 同样大小的文件原地复用，已打开的读取者不会读到截断的文件；大小不同时写新文件再替换 """
+        size = HEADER_SIZE + capacity * SLOT.size
+        if os.path.exists(path) and os.path.getsize(path) == size:
+            f = open(path, 'r+b')
+        else:
+            f = open(path + '.tmp', 'w+b')
+            f.truncate(size)
+            os.rename(path + '.tmp', path)
+        with f:
+            buf = mmap.mmap(f.fileno(), size)
+        if HEADER.unpack_from(buf, 0)[:3] == (MAGIC, VERSION, SLOT.size):
+            epoch = SEQ.unpack_from(buf, EPOCH_OFFSET)[0] + 1
+        else:
+            epoch = 1
+        HEADER.pack_into(buf, 0, MAGIC, VERSION, SLOT.size, capacity)
+        # 先把序号清零再改epoch，读取者看到任何一个变化都会重新同步
+        SEQ.pack_into(buf, SEQ_OFFSET, 0)
+        SEQ.pack_into(buf, EPOCH_OFFSET, epoch)
+        UPDATED.pack_into(buf, UPDATED_OFFSET, time())
+        return cls(path, buf, capacity)
+
+    def write(self, tick):
+        """ 由MarketDataApi.process_tick调用 """
+        seq = self.seq + 1
+        offset = HEADER_SIZE + (seq - 1) % self.capacity * SLOT.size
+        SLOT.pack_into(self.buf, offset, 2 * seq - 1, tick.securityID.encode('utf8'), to_micros(tick.entry_time),
+                       _float(tick.price), _float(tick.b_price), _float(tick.s_price), _float(tick.volume))
+        SEQ.pack_into(self.buf, offset, 2 * seq)
+        SEQ.pack_into(self.buf, SEQ_OFFSET, seq)
+        UPDATED.pack_into(self.buf, UPDATED_OFFSET, time())
+        self.seq = seq
+
+    def close(self):
+        self.buf.close()
+
+
+class TickBusReader(object):
+    def __init__(self, path=DEFAULT_PATH, from_start=False, stale_after=10, check_interval=1):
+        self.path = path
+        self.stale_after = stale_after
+        self.check_interval = check_interval
+        self.prices = {}        # secid -> (price, b_price, s_price)
+        self.overruns = 0
+        self.resyncs = 0
+        self.next_check = 0     # 下次检查文件是否被替换的时刻（monotonic）
+        self.lock = threading.Lock()
+        self.attach(from_start)
+        if not from_start:
+            self.reload_prices()
+
+    def attach(self, from_start):
+        with open(self.path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.inode = os.fstat(f.fileno()).st_ino
+        magic, version, recsize, capacity = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION or recsize != SLOT.size:
+            buf.close()
+            raise ValueError(u'{0}不是有效的tick总线文件'.format(self.path))
+        self.buf = buf
+        self.capacity = capacity
+        self.epoch = self.current_epoch()
+        self.next_seq = 1 if from_start else self.written() + 1
+        self.price_seq = self.next_seq
+
+    def written(self):
+        return SEQ.unpack_from(self.buf, SEQ_OFFSET)[0]
+
+    def current_epoch(self):
+        return SEQ.unpack_from(self.buf, EPOCH_OFFSET)[0]
+
+    def updated(self):
+        return UPDATED.unpack_from(self.buf, UPDATED_OFFSET)[0]
+
+    def stale(self):
+        return bool(self.stale_after) and time() - self.updated() > self.stale_after
+
+    def sync(self):
+        """ 写入者重启后从新的第一条记录读起，文件被替换时重新打开。调用者持有self.lock """
+        epoch = self.current_epoch()
+        if epoch != self.epoch or self.written() < max(self.next_seq, self.price_seq) - 1:
+            logger.info(u'tick总线写入者已重启，重新同步')
+            self.epoch = epoch
+            self.next_seq = self.price_seq = 1
+            self.resyncs += 1
+            self.reload_prices()
+        elif self.stale() and monotonic() >= self.next_check:
+            self.next_check = monotonic() + self.check_interval
+            try:
+                replaced = os.stat(self.path).st_ino != self.inode
+            except OSError:
+                return
+            if replaced:
+                logger.info(u'tick总线文件已替换，重新打开')
+                old = self.buf
+                self.attach(True)
+                old.close()
+                self.resyncs += 1
+                self.reload_prices()
+
+    def reload_prices(self):
+        """ 错过了部分tick，从Redis重新加载当前价格 """
+        pipe = storage.get_client('tick').pipeline(transaction=False)
+        for key in ('current_price', 'current_b_price', 'current_s_price'):
+            pipe.hgetall(key)
+        prices, b_prices, s_prices = [values or {} for values in pipe.execute()]
+        for secid, price in prices.iteritems():
+            price = _parse(price)
+            if price is not None:
+                self.prices[secid] = (price, _parse(b_prices.get(secid)), _parse(s_prices.get(secid)))
+
+    def read_slot(self, seq):
+        offset = HEADER_SIZE + (seq - 1) % self.capacity * SLOT.size
+        record = SLOT.unpack_from(self.buf, offset)
+        if record[0] != 2 * seq or SEQ.unpack_from(self.buf, offset)[0] != 2 * seq:
+            return None
+        return record
+
+    def scan(self, seq):
+        """ 读取从seq开始的记录，返回(记录列表, 下一个序号, 是否跳过了记录) """
+        records = []
+        written = self.written()
+        overrun = False
+        while seq <= written:
+            if written - seq >= self.capacity:
+                overrun = True
+                seq = written - self.capacity + 1
+            record = self.read_slot(seq)
+            if record is None:
+                # 读取时被写入者覆盖
+                overrun = True
+                written = self.written()
+                seq = max(seq + 1, written - self.capacity + 1)
+                continue
+            seq += 1
+            records.append(record)
+        return records, seq, overrun
+
+    def read(self):
+        """ 返回上次读取之后的新tick列表 """
+        with self.lock:
+            self.sync()
+            records, self.next_seq, overrun = self.scan(self.next_seq)
+            if overrun:
+                self.overruns += 1
+                logger.warning(u'tick总线读取落后，已跳过部分tick')
+        ticks = []
+        for record in records:
+            price, b_price, s_price, volume = [_value(v) for v in record[3:]]
+            ticks.append(TickObject(securityID=record[1].rstrip('\0'), price=price, b_price=b_price,
+                                    s_price=s_price, volume=volume,
+                                    entry_time=EPOCH + timedelta(microseconds=record[2])))
+        return ticks
+
+    def current_price(self, secid, direction=None):
+        """ 与utils.current_price参数相同，没有该合约的价格或总线已停止更新时返回None。
+        价格有单独的读取位置，不影响read()返回的tick """
+        with self.lock:
+            self.sync()
+            if self.stale():
+                return None
+            if self.written() >= self.price_seq:
+                records, self.price_seq, overrun = self.scan(self.price_seq)
+                if overrun:
+                    self.reload_prices()
+                for record in records:
+                    self.prices[record[1].rstrip('\0')] = tuple(_value(v) for v in record[3:6])
+        prices = self.prices.get(secid)
+        if prices is None:
+            return None
+        return prices[0 if direction is None else (1 if direction else 2)]
+
+    def close(self):
+        self.buf.close()
+
+
+class TickBusConsumer(threading.Thread):
+    """ 轮询总线，把新tick批量交给handler(ticks)。poll_interval为0时忙等，延迟最低但占满一个CPU """
+
+    def __init__(self, reader, handler, poll_interval=0.0002, evt_stop=None):
+        super(TickBusConsumer, self).__init__(name='TICKBUS')
+        self.daemon = True
+        self.reader = reader
+        self.handler = handler
+        self.poll_interval = poll_interval
+        self.evt_stop = evt_stop or threading.Event()
+
+    def run(self):
+        while not self.evt_stop.is_set():
+            ticks = self.reader.read()
+            if ticks:
+                try:
+                    self.handler(ticks)
+                except Exception, e:
+                    logger.exception(unicode(e))
+            elif self.poll_interval:
+                sleep(self.poll_interval)
+
+    def stop(self):
+        self.evt_stop.set()
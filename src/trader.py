@@ -5,19 +5,20 @@ from datetime import datetime
 import time
 import json
 
-import redisco
-
+from . import storage
 from .models.instrument import Instrument
 from .models.account import Account, convert_currency
-from .models.order import Order
+from .models.order import Order, order_index
 from .utils import current_price, last_close_price
+from .metrics import metrics
+from .snapshot import read_snapshot, load_snapshot, snapshot_instrument
 
 logger = logging.getLogger(__name__)
-rdb = redisco.get_client()
+rdb = storage.lazy_client()
 
 
 class BaseTrader(object):
-    def __init__(self, name, accountcode, currency, instrumentstr):
+    def __init__(self, name, accountcode, currency, instrumentstr, snapshot_path=None):
         self.name = name
         self.accountcode = accountcode
         self.account = Account.objects.get_or_create(code=accountcode, default_currency=currency)
@@ -25,6 +26,12 @@ class BaseTrader(object):
             self.account.last_trade_time = datetime.utcnow()
         if not self.account.balances:
             self.account.deposit(0.0)
+        # 有可用的快照时只加载增量，见snapshot.py
+        self.snapshot = snapshot_path and read_snapshot(snapshot_path, self.account)
+        if self.snapshot:
+            load_snapshot(self.snapshot, self.account)
+        else:
+            order_index.load(self.account)
         self.max_balance = 0.0  # 本次运行（当天）最高资金余额
         self.monitors = {}
         self.offsets = {}
@@ -47,6 +54,9 @@ class BaseTrader(object):
         self.is_logged = self.is_ready = False
         self.evt_stop = threading.Event()
         self.lock = threading.RLock()
+        self.order_timer = None     # OrderTimeoutThread
+        self.trade_listeners = []   # 成交后调用listener.on_trade(order, trade)
+        self.risk = None            # PreTradeRisk
     
     @property
     def available(self):
@@ -92,18 +102,21 @@ class BaseTrader(object):
         self.max_balance = 0.0  # 最高资金余额每天清零
 
     def get_instrument_from_symbol(self, symbol):
-        return Instrument.objects.filter(symbol=symbol).first()
+        instrument = self.snapshot and snapshot_instrument(self.snapshot, symbol)
+        return instrument or Instrument.objects.filter(symbol=symbol).first()
 
     def set_monitors(self, publish=True):
         self.monitors = {}
+        pipe = rdb.pipeline(transaction=False)
         for symbol, offset in self.offsets.items():
             symbol = symbol.strip()
             instrument = self.get_instrument_from_symbol(symbol)
             if publish:
-                rdb.publish('mdmonitor', instrument.secid)  # Notify quoteservice
-                rdb.publish('strategymonitor', json.dumps((symbol, instrument.id)))      # Notify strategy service
+                pipe.publish('mdmonitor', instrument.secid)  # Notify quoteservice
+                pipe.publish('strategymonitor', json.dumps((symbol, instrument.id)))      # Notify strategy service
             self.monitors[symbol] = instrument
             logger.debug(u'add_instrument: {0}'.format(instrument))
+        pipe.execute()      # 所有合约的通知一次发出，行情服务合并订阅
         logger.debug(u'Set monitors to {0}'.format(self.monitors))
 
     def ready_for_trade(self):
@@ -115,14 +128,18 @@ class BaseTrader(object):
         # 记录最高资金余额
         if self.account.balance > self.max_balance:
             self.max_balance = self.account.balance
-        # 刷新显示
+        # 刷新显示：RowWin只设置刷新标志，由刷新线程绘制
         if hasattr(self, 'infowin'):
-            self.infowin.paint()
+            invalidate = getattr(self.infowin, 'invalidate', None)
+            if invalidate:
+                invalidate()
+            else:
+                self.infowin.paint()
 
     def on_history_trade(self, execid, instid, orderid, local_id, direction, price, volume, exectime):
         with self.lock:
             inst = Instrument.objects.filter(secid=instid).first()
-            order = Order.objects.filter(sys_id=orderid).first()
+            order = order_index.get_by_sys_id(orderid, self.account.id)
             if not order:
                 logger.error(u'收到未知订单的历史成交记录, 订单号：{0}'.format(orderid))
                 return
@@ -135,13 +152,15 @@ class BaseTrader(object):
     def on_new_order(self, local_id, instid, orderid, direction, price, volume, exectime):
         with self.lock:
             # check duplicate
-            if Order.objects.filter(sys_id=orderid):
+            if order_index.has_sys_id(orderid, self.account.id):
                 return
-            order = Order.objects.filter(local_id=local_id).first()
+            order = order_index.get_by_local_id(local_id, self.account.id)
             if order is None:
                 logger.warn(u'找不到本地订单号为{0}的订单'.format(local_id))
                 return False
             order.on_new(orderid, instid, direction, price, volume, exectime)
+            if self.order_timer:
+                self.order_timer.add(order)
             logger.info(u'<策略{0}>下单: {1}{2}仓 合约={3} 数量={4} 价格={5} 订单号={6}'.format(
                     order.strategy_code,
                     u'开' if order.is_open else u'平',
@@ -155,17 +174,21 @@ class BaseTrader(object):
     def on_reject(self, local_id, reason_code, reason_desc):
         with self.lock:
             logger.warning(u'订单(本地订单号：{0})被拒绝，原因：{1} {2}'.format(local_id, reason_code, reason_desc))
-            order = Order.objects.filter(local_id=local_id).first()
+            order = order_index.get_by_local_id(local_id, self.account.id)
             if order is None:
                 logger.error(u'找不到订单号为{0}的订单'.format(local_id))
                 return
             order.update_status(Order.OS_REJECTED)
+            if self.order_timer:
+                self.order_timer.remove(order)
+            if self.risk:
+                self.risk.on_order_done(order)
             if not order.is_open:
                 order.orig_order.update_status(Order.OS_FILLED)
 
     def on_cancel(self, local_id):
         with self.lock:
-            order = Order.objects.filter(local_id=local_id).first()
+            order = order_index.get_by_local_id(local_id, self.account.id)
             if not order:
                 logger.error(u'收到未知订单的撤单回报，本地订单号：{0}'.format(local_id))
                 return
@@ -174,6 +197,10 @@ class BaseTrader(object):
                 order.update_float_value('volume', order.filled_volume)
             else:
                 order.update_status(Order.OS_CANCELED)
+            if self.order_timer:
+                self.order_timer.remove(order)
+            if self.risk:
+                self.risk.on_order_done(order)
             if not order.is_open and order.orig_order.status == Order.OS_CLOSING:
                 # 平仓单撤销后，恢复原开仓单状态
                 order.orig_order.update_status(Order.OS_FILLED)
@@ -181,14 +208,24 @@ class BaseTrader(object):
 
     def on_trade(self, execid, secid, orderid, price, volume, exectime, setstop=True):
         with self.lock:
-            order = Order.objects.filter(sys_id=orderid).first()
+            order = order_index.get_by_sys_id(orderid, self.account.id)
             if order is None:
                 logger.error(u'找不到订单号为{0}的订单'.format(orderid))
                 return
             if order.is_open is None:
                 logger.debug(u'订单(订单号：{0})无法交易，等待重试'.format(orderid))
                 return False
-            self.account.on_trade(order, execid, price, volume, exectime)
+            trade = self.account.on_trade(order, execid, price, volume, exectime)
+            if metrics.enabled and trade:
+                metrics.elapsed('submit_fill', ('order', order.local_id), pop=True)
+            if self.order_timer:
+                if abs(order.filled_volume) >= abs(order.volume):
+                    self.order_timer.remove(order)
+                else:
+                    self.order_timer.touch(order)
+            if trade:
+                for listener in self.trade_listeners:
+                    listener.on_trade(order, trade)
             if order.is_open and setstop:
                 # 补仓或开新仓：按最新价设置止损价
                 try:
@@ -217,13 +254,24 @@ class BaseTrader(object):
 
     def open_order(self, inst, price, volume, direction, strategy_code=''):
         """ 开仓。返回新订单 or None。"""
-        if not price:
-            local_id = self.open_market_order(inst, volume, direction)
-        else:
-            local_id = self.open_limit_order(inst, price, volume, direction)
-        if local_id:
-            with self.lock:
-                return self.account.create_order(local_id, inst, price, volume, True, strategy_code)
+        if self.risk and not self.risk.check(inst, price, volume, direction, strategy_code):
+            return
+        order = None
+        try:
+            if not price:
+                local_id = self.open_market_order(inst, volume, direction)
+            else:
+                local_id = self.open_limit_order(inst, price, volume, direction)
+            if local_id:
+                # 在同一把锁内登记风控，避免回报在两步之间到达
+                with self.lock:
+                    order = self.account.create_order(local_id, inst, price, volume, True, strategy_code)
+                    if self.risk:
+                        self.risk.on_order(order, inst, volume, direction, strategy_code)
+        finally:
+            if self.risk and order is None:
+                self.risk.on_order(None, inst, volume, direction, strategy_code)
+        return order
 
     def close_order(self, order, price=0.0, volume=None, strategy_code=''):
         """ 平仓。返回平仓订单 or None。"""
@@ -1,16 +1,58 @@
 # coding:utf8
 import logging
 import os
+import sys
 import threading
 import time
 import datetime
 
 from decorator import decorator
-import redisco
 from redisco.containers import Hash
 
+from . import storage
+
 logger = logging.getLogger(__name__)
-rdb = redisco.get_client()
+
+
+def _clock_gettime_monotonic():
+    """ python 2没有time.monotonic，通过ctypes调用clock_gettime(CLOCK_MONOTONIC) """
+    import ctypes
+    import ctypes.util
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    clock_id = {'linux': 1, 'darwin': 6, 'freebsd': 4}.get(sys.platform.rstrip('0123456789'))
+    if clock_id is None:
+        raise OSError('CLOCK_MONOTONIC unknown on ' + sys.platform)
+    libc = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+    clock_gettime = libc.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def monotonic():
+        ts = timespec()
+        if clock_gettime(clock_id, ctypes.byref(ts)):
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    monotonic()
+    return monotonic
+
+
+try:
+    from time import monotonic
+except ImportError:     # python 2
+    try:
+        from monotonic import monotonic     # 第三方backport
+    except ImportError:
+        try:
+            monotonic = _clock_gettime_monotonic()
+        except (OSError, AttributeError, TypeError), e:
+            logger.warning(u'没有可用的单调时钟，使用time.time: {0}'.format(e))
+            from time import time as monotonic
+rdb = storage.lazy_client()
+EPOCH = datetime.datetime(1970, 1, 1)
+price_source = None
 
 
 def check_running(PIDFILE):
@@ -55,7 +97,9 @@ def align_digit(volume, tick_size):
     return int(volume / tick_size) * tick_size
 
 
-def send_account_email(interval, app, server, port, username, password, sendtolist):
+def send_account_email(interval, app, server, port, username, password, sendtolist, loop=None):
+    """ 发送资金变动通知email，interval秒后再次发送。
+    loop为EventLoop时由事件循环定时、在其线程池里发送，不再每次新建Timer线程。"""
     logger.info(u'发送资金变动通知email...')
     import smtplib
     from email.mime.text import MIMEText
@@ -75,6 +119,10 @@ def send_account_email(interval, app, server, port, username, password, sendtoli
         smtp.quit()
     except smtplib.SMTPException, e:
         logger.exception(unicode(e))
+    if loop is not None:
+        loop.call_soon_threadsafe(loop.call_later, interval, loop.run_in_executor, send_account_email,
+                                  interval, app, server, port, username, password, sendtolist, loop)
+        return
     t = threading.Timer(
             interval,
             send_account_email,
@@ -125,7 +173,27 @@ def logerror(fn, *args, **kwargs):
         return
 
 
+def to_micros(dt):
+    """ 1970-01-01起的微秒数（本地时间） """
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def float_or_nan(value):
+    return float('nan') if value is None else float(value)
+
+
+def use_price_source(source):
+    """ 设置current_price优先使用的价格来源（例如tickbus.TickBusReader），None表示只用Redis """
+    global price_source
+    price_source = source
+
+
 def current_price(instrumentid, direction=None):
+    if price_source is not None:
+        price = price_source.current_price(instrumentid, direction)
+        if price is not None:
+            return price
     if direction is None:
         price = rdb.hget('current_price', instrumentid)
     elif direction:
@@ -146,14 +214,91 @@ def last_close_price(instid):
         logger.error(u'last_close_price({0}) got {1}'.format(instid, price))
         return None
 
+class ExchangeClock(object):
+    """ 交易所时钟。
+    本地缓存各交易所与本机的时差（秒），超过ttl秒或收到exchangetimedelta频道的通知后才重新读取Redis；
+    当前时间按单调时钟推算，不受系统时间调整影响。"""
+    KEY = 'exchangetimedelta'
+
+    def __init__(self, ttl=60, listen=False):
+        self.ttl = ttl
+        self.offsets = {}   # exchangeid -> (时差, 过期时刻)
+        self.listen_changes = listen    # 第一次读取Redis时启动通知监听线程
+        self.listener = None
+        self.lock = threading.Lock()
+        self.anchor()
+
+    def anchor(self):
+        self.base_time = datetime.datetime.now()
+        self.base_mono = monotonic()
+
+    def offset(self, exchangeid):
+        """ 交易所时间减本地时间的秒数 """
+        t = monotonic()
+        cached = self.offsets.get(exchangeid)
+        if cached is None or cached[1] < t:
+            if self.listen_changes and self.listener is None:
+                self.start_listener()
+            value = rdb.hget(self.KEY, exchangeid)
+            cached = (float(value) if value else 0.0, t + self.ttl)
+            self.offsets[exchangeid] = cached
+        return cached[0]
+
+    def invalidate(self, exchangeid=None):
+        if exchangeid:
+            self.offsets.pop(exchangeid, None)
+        else:
+            self.offsets.clear()
+
+    def set_offset(self, exchangeid, seconds):
+        """ 保存时差并通知其他进程刷新 """
+        rdb.hset(self.KEY, exchangeid, seconds)
+        rdb.publish(self.KEY, exchangeid)
+        self.invalidate(exchangeid)
+
+    def localnow(self):
+        elapsed = monotonic() - self.base_mono
+        if elapsed > self.ttl:
+            self.anchor()
+            elapsed = 0.0
+        return self.base_time + datetime.timedelta(seconds=elapsed)
+
+    def now(self, exchangeid):
+        return self.localnow() + datetime.timedelta(seconds=self.offset(exchangeid))
+
+    def convert(self, exchangeid, localtime):
+        return localtime + datetime.timedelta(seconds=self.offset(exchangeid))
+
+    def convert_array(self, exchangeid, localtimes):
+        """ 批量转换本地时间（datetime序列或datetime64数组）为交易所时间，返回datetime64[us]数组 """
+        import numpy as np
+        delta = np.timedelta64(int(round(self.offset(exchangeid) * 1e6)), 'us')
+        return np.asarray(localtimes, dtype='datetime64[us]') + delta
+
+    def listen(self):
+        ps = storage.pubsub()
+        ps.subscribe(self.KEY)
+        for item in ps.listen():
+            if item['type'] == 'message':
+                self.invalidate(item['data'])
+
+    def start_listener(self):
+        with self.lock:
+            if self.listener is None:
+                self.listener = threading.Thread(target=self.listen, name='EXCHANGECLOCK')
+                self.listener.daemon = True
+                self.listener.start()
+        return self.listener
+
+
+exchange_clock = ExchangeClock(listen=True)
+
+
 def exchange_time(exchangeid, localtime=None):
     """ 计算交易所时间 """
     if not localtime:
-        localtime = datetime.datetime.now()
-    timedelta = Hash('exchangetimedelta')[exchangeid]
-    if timedelta:
-        localtime += datetime.timedelta(seconds=float(timedelta))
-    return localtime
+        return exchange_clock.now(exchangeid)
+    return exchange_clock.convert(exchangeid, localtime)
 
 def get_last_line(fn):
     if not os.path.exists(fn):